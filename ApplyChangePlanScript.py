@@ -0,0 +1,71 @@
+from django.db import IntegrityError
+from extras.scripts import Script, TextVar, FileVar
+from change_plan import StalePlanError, apply_change_plan, check_plan, load_plan, summarize
+
+
+class ApplyChangePlanScript(Script):
+
+    class Meta:
+        name = "Apply change plan"
+        description = "Apply, as-is, the JSON plan produced by a dry run of the interface and device creation scripts"
+        commit_default = False
+
+    plan_file = FileVar(
+        description="Plan file (the JSON output of a dry run)",
+        required=False
+    )
+
+    plan = TextVar(
+        description="Or paste the plan JSON here",
+        required=False
+    )
+
+    def run(self, data, commit):
+        if data.get('plan_file'):
+            text = data['plan_file'].read()
+            if isinstance(text, bytes):
+                text = text.decode('utf-8-sig')
+        else:
+            text = data.get('plan') or ""
+        if not text.strip():
+            self.log_failure("Upload or paste a plan")
+            return
+
+        try:
+            plan = load_plan(text)
+        except ValueError as e:
+            self.log_failure(str(e))
+            return
+
+        summary = summarize(plan)
+        self.log_info(f"Plan from {plan.get('script')} computed at {plan.get('created_at')}: {summary}")
+        for conflict in plan["conflicts"]:
+            self.log_warning(f"Left out by the dry run: {conflict['message']}")
+
+        if not commit:
+            # Só confirma que o plano ainda vale; nada é gravado
+            stale = check_plan(plan)
+            for message in stale:
+                self.log_failure(f"Stale: {message}")
+            if not stale:
+                self.log_info(f"Simulation: {len(plan['creates'])} objects would be created and {len(plan['updates'])} updated")
+            return
+
+        try:
+            apply_change_plan(plan, webhook_callback=self.log_webhook_results)
+        except StalePlanError as e:
+            self.log_failure(f"The plan no longer matches the database, run the dry run again: {e}")
+            return
+        except (ValueError, IntegrityError) as e:
+            self.log_failure(f"The plan could not be applied: {e}")
+            return
+
+        for entry in plan["creates"]:
+            if entry.get("label"):
+                self.log_success(f"Created {entry['label']}")
+        for entry in plan["updates"]:
+            self.log_success(f"Updated {entry.get('label') or entry['pk']}: {', '.join(entry['fields'])}")
+        return f"{len(plan['creates'])} objects created, {len(plan['updates'])} updated."
+
+    def log_webhook_results(self, results):
+        self.log_info(f"{len(results['queued'])} webhook(s) queued for delivery in job {results['job_id']}")
@@ -0,0 +1,326 @@
+import importlib
+import io
+import ipaddress
+import json
+import os
+import time
+import tracemalloc
+import uuid
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from extras.scripts import Script, ChoiceVar, IntegerVar, StringVar
+from dcim.choices import DeviceStatusChoices
+from dcim.models import Device, DeviceRole, DeviceType, Interface, Manufacturer, Site
+from ipam.models import IPAddress, Prefix, VLAN
+from extras.models import ConfigTemplate, Tag, TaggedItem
+from config_render import build_render_context, render_config
+from pop_context import build_pop_context, clear_cache
+
+# Benchmark dos scripts e templates deste repositório contra um inventário
+# sintético. Rode com "Commit changes" desmarcado: o inventário é criado
+# dentro da transação do job e descartado no final, e cada caso roda em um
+# savepoint próprio para não interferir nos seguintes.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BATCH_SIZE = 5000
+BULK_ROWS = 100
+
+
+def load(module_name, class_name):
+    # Os scripts são importados sob demanda: importar as classes no topo faria o
+    # NetBox listá-las também neste módulo, e um script quebrado vira apenas
+    # um caso com erro em vez de impedir o benchmark inteiro
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def chunks(objects, size=BATCH_SIZE):
+    for start in range(0, len(objects), size):
+        yield objects[start:start + size]
+
+
+class UploadedRows(io.BytesIO):
+    # Imita o arquivo recebido por um FileVar
+    def __init__(self, content, name):
+        super().__init__(content.encode())
+        self.name = name
+
+
+class BenchmarkScript(Script):
+
+    class Meta:
+        name = "Benchmark scripts and templates"
+        description = "Seed a synthetic inventory and record wall time, queries and peak memory of every script and template"
+        commit_default = False
+
+    devices = ChoiceVar(
+        description="Number of CPE devices to generate",
+        choices=[('1000', '1k'), ('10000', '10k'), ('100000', '100k')],
+        default='1000'
+    )
+
+    pops = IntegerVar(
+        description="Number of POP devices",
+        default=5,
+        min_value=1
+    )
+
+    pop_interfaces = IntegerVar(
+        description="Tagged interfaces per POP device",
+        default=400,
+        min_value=1
+    )
+
+    output_file = StringVar(
+        description="JSON results file (a timestamp is appended when it is a directory)",
+        default="/tmp/netbox-benchmarks",
+        required=True
+    )
+
+    def seed(self, size, pops, pop_interfaces):
+        suffix = uuid.uuid4().hex[:6]
+        manufacturer = Manufacturer.objects.create(name=f"bench-{suffix}", slug=f"bench-{suffix}")
+        device_type = DeviceType.objects.create(manufacturer=manufacturer, model=f"bench-{suffix}", slug=f"bench-{suffix}")
+        cpe_role = DeviceRole.objects.create(name=f"bench-cpe-{suffix}", slug=f"bench-cpe-{suffix}")
+        pop_role = DeviceRole.objects.create(name=f"bench-pop-{suffix}", slug=f"bench-pop-{suffix}")
+        internet, _ = Tag.objects.get_or_create(name="INTERNET", defaults={"slug": "internet"})
+
+        sites = Site.objects.bulk_create([
+            Site(name=f"bench-{suffix}-{index}", slug=f"bench-{suffix}-{index}")
+            for index in range(max(1, size // 100))
+        ])
+
+        pop_devices = Device.objects.bulk_create([
+            Device(
+                name=f"POP{index:02d}.{index:06d}.P{index % 1000:03d}.PE01",
+                device_type=device_type, device_role=pop_role, site=sites[index % len(sites)],
+                status=DeviceStatusChoices.STATUS_ACTIVE
+            )
+            for index in range(pops)
+        ])
+
+        # Interfaces dos POPs, todas com a tag INTERNET e um /30 cada
+        interface_type = ContentType.objects.get_for_model(Interface)
+        network = ipaddress.ip_network("10.0.0.0/8")
+        interfaces = [
+            Interface(device=pop, name=f"ether{index}", type='virtual', enabled=True)
+            for pop in pop_devices for index in range(pop_interfaces)
+        ]
+        for chunk in chunks(interfaces):
+            Interface.objects.bulk_create(chunk)
+        for chunk in chunks(interfaces):
+            TaggedItem.objects.bulk_create([
+                TaggedItem(tag=internet, content_type=interface_type, object_id=interface.pk) for interface in chunk
+            ])
+        ip_addresses = [
+            IPAddress(
+                address=f"{network.network_address + index * 4 + 1}/30",
+                assigned_object_type=interface_type, assigned_object_id=interface.pk
+            )
+            for index, interface in enumerate(interfaces)
+        ]
+        for chunk in chunks(ip_addresses):
+            IPAddress.objects.bulk_create(chunk)
+
+        contexts = {pop.pk: build_pop_context(pop, use_cache=False) for pop in pop_devices}
+
+        # CPEs: 1 em cada 20 fora do padrão de hostname
+        cpes = []
+        for index in range(size):
+            pop = pop_devices[index % len(pop_devices)]
+            name = f"B{index % 1000:03d}.{index:06d}.A{index % 1000:03d}.PE01"
+            if index % 20 == 0:
+                name = f"cpe-{index}"
+            cpes.append(Device(
+                name=name, device_type=device_type, device_role=cpe_role, site=sites[index % len(sites)],
+                status=DeviceStatusChoices.STATUS_ACTIVE,
+                local_context_data=contexts[pop.pk],
+                custom_field_data={"Connectedto": pop.pk}
+            ))
+        for chunk in chunks(cpes):
+            Device.objects.bulk_create(chunk)
+
+        cpe_interfaces = [
+            Interface(device=cpe, name=name, type='virtual', enabled=name == 'ether1')
+            for cpe in cpes for name in ('ether1', 'ether2')
+        ]
+        for chunk in chunks(cpe_interfaces):
+            Interface.objects.bulk_create(chunk)
+        offset = len(interfaces)
+        cpe_ips = [
+            IPAddress(
+                address=f"{network.network_address + (offset + index) * 4 + 2}/30",
+                assigned_object_type=interface_type, assigned_object_id=interface.pk
+            )
+            for index, interface in enumerate(cpe_interfaces[::2])
+        ]
+        for chunk in chunks(cpe_ips):
+            IPAddress.objects.bulk_create(chunk)
+
+        return {
+            "suffix": suffix,
+            "device_type": device_type,
+            "cpe_role": cpe_role,
+            "sites": sites,
+            "pops": pop_devices,
+            "cpes": cpes,
+            "tag": internet,
+            "vlan": VLAN.objects.create(vid=100, name=f"bench-{suffix}", site=sites[0]),
+            "prefix": Prefix.objects.create(prefix="100.64.0.0/16"),
+        }
+
+    def cases(self, inventory):
+        pop = inventory["pops"][0]
+        cpe = inventory["cpes"][1]
+        site = inventory["sites"][0]
+        suffix = inventory["suffix"]
+
+        def single_device():
+            load('NewSingleDeviceScript', 'NewSingleDeviceScript')().run({
+                "site": site, "device_name": f"NEW.{suffix}.A001.PE01",
+                "device_model": inventory["device_type"], "device_role": inventory["cpe_role"],
+                "tags": inventory["tag"], "config_template": None,
+                "pop_device": pop, "connected_to": pop,
+            }, True)
+
+        def webhook_device():
+            load('NewDeviceWithWebhookScript', 'NewDeviceWithWebhookScript')().run({
+                "site": site, "device_name": f"HOOK.{suffix}.A001.PE01",
+                "device_model": inventory["device_type"], "device_role": inventory["cpe_role"],
+                "tags": inventory["tag"], "config_template": None,
+                "pop_device": pop, "connected_to": pop,
+            }, True)
+
+        def bulk_devices():
+            rows = ["name,site,device_type,role,pop_device,connected_to,tag,config_template"]
+            for index in range(BULK_ROWS):
+                rows.append(
+                    f"BLK{index:03d}.{index:06d}.A001.PE01,{site.name},{inventory['device_type'].slug},"
+                    f"{inventory['cpe_role'].slug},{pop.name},{pop.name},{inventory['tag'].slug},"
+                )
+            load('NewSingleDeviceScript', 'NewBulkDeviceScript')().run({"devices_file": UploadedRows("\n".join(rows), "devices.csv")}, True)
+
+        def create_interfaces():
+            load('CreateInterfaceScript', 'CreateInterfaceScript')().run({
+                "device": cpe, "pop_device": pop, "solution": "EoIP",
+                "tunnel_prefix": inventory["prefix"], "tunnel_prefix_length": "30",
+                "vlan_id": 200, "allocate_vlan": False,
+            }, True)
+
+        def create_eoip():
+            load('CreateEoIPInterfaceScript', 'CreateEoIPInterfaceScript')().run({
+                "device": cpe, "vlan_id": inventory["vlan"], "solucao": "EOIP",
+            }, True)
+
+        def hostname_report():
+            report = load('ValidaNameReport', 'DeviceHostnameReport')()
+            if hasattr(report, 'run_test'):
+                report.run_test('test_device_naming')
+            else:
+                report.test_device_naming()
+
+        def pop_context_cold():
+            clear_cache()
+            build_pop_context(pop)
+
+        def pop_context_warm():
+            build_pop_context(pop)
+
+        def render_mikrotik():
+            with open(os.path.join(REPO_DIR, 'mikrotik')) as template_file:
+                render_config(template_file.read(), build_render_context(cpe))
+
+        def render_base_netbox_jinja():
+            with open(os.path.join(REPO_DIR, 'BASE_NETBOX_JINJA')) as template_file:
+                ConfigTemplate(name="bench", template_code=template_file.read()).render(context={})
+
+        return [
+            ("NewSingleDeviceScript", single_device),
+            ("NewDeviceWithWebhookScript", webhook_device),
+            (f"NewBulkDeviceScript[{BULK_ROWS}]", bulk_devices),
+            ("CreateInterfaceScript", create_interfaces),
+            ("CreateEoIPInterfaceScript", create_eoip),
+            ("DeviceHostnameReport", hostname_report),
+            ("pop_context.cold", pop_context_cold),
+            ("pop_context.warm", pop_context_warm),
+            ("template.mikrotik", render_mikrotik),
+            ("template.BASE_NETBOX_JINJA", render_base_netbox_jinja),
+        ]
+
+    def run_case(self, function, queries=None):
+        # Cada caso roda em um savepoint descartado no final
+        try:
+            with transaction.atomic():
+                if queries is not None:
+                    with queries:
+                        function()
+                else:
+                    function()
+                transaction.set_rollback(True)
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+        return None
+
+    def measure(self, function):
+        # Tempo e queries com o tracemalloc desligado (rastrear cada alocação
+        # deixa o código bem mais lento); o pico de memória sai de uma segunda
+        # passada só para isso
+        result = {}
+        queries = CaptureQueriesContext(connection)
+        started = time.perf_counter()
+        error = self.run_case(function, queries)
+        result["wall_s"] = round(time.perf_counter() - started, 4)
+        result["queries"] = len(queries.captured_queries)
+        if error:
+            result["error"] = error
+            return result
+
+        tracemalloc.start()
+        try:
+            error = self.run_case(function)
+            result["peak_mem_kb"] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+        finally:
+            tracemalloc.stop()
+        if error:
+            result["error"] = error
+        return result
+
+    def run(self, data, commit):
+        # O inventário sintético nunca pode ficar no banco
+        if commit:
+            self.log_failure("The benchmark seeds synthetic devices: run it with commit disabled")
+            return
+
+        size = int(data['devices'])
+        started = time.perf_counter()
+        inventory = self.seed(size, data['pops'], data['pop_interfaces'])
+        seed_time = round(time.perf_counter() - started, 2)
+        self.log_info(f"Seeded {size} devices, {data['pops']} POPs x {data['pop_interfaces']} interfaces in {seed_time}s")
+
+        results = {
+            "started_at": timezone.now().isoformat(),
+            "netbox_version": getattr(settings, 'VERSION', None),
+            "database": connection.vendor,
+            "inventory": {"devices": size, "pops": data['pops'], "pop_interfaces": data['pop_interfaces']},
+            "seed_s": seed_time,
+            "cases": {},
+        }
+        for name, function in self.cases(inventory):
+            result = self.measure(function)
+            results["cases"][name] = result
+            if "error" in result:
+                self.log_failure(f"{name}: {result['error']}")
+            else:
+                self.log_success(f"{name}: {result['wall_s']}s, {result['queries']} queries, {result['peak_mem_kb']} KiB peak")
+
+        path = data['output_file']
+        if os.path.isdir(path) or not path.endswith('.json'):
+            os.makedirs(path, exist_ok=True)
+            path = os.path.join(path, f"results-{size}-{timezone.now():%Y%m%d%H%M%S}.json")
+        with open(path, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+        self.log_info(f"Results written to {path}")
+
+        return json.dumps(results, indent=2)
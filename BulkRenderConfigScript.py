@@ -0,0 +1,135 @@
+from django.db.models import Q
+from extras.scripts import Script, ObjectVar, MultiObjectVar, StringVar, IntegerVar, BooleanVar
+from dcim.models import Device, DeviceRole, Site
+from extras.models import Tag, ConfigTemplate
+from config_render import render_to_directory
+from config_store import CONFIG_STORE_DIR, ConfigStore
+
+
+class BulkRenderConfigScript(Script):
+
+    class Meta:
+        name = "Render configs em lote"
+        description = "Render config templates for a whole site, POP or filter into an artifact directory"
+
+    site = ObjectVar(
+        description="Render every device in this site",
+        model=Site,
+        required=False
+    )
+
+    pop_device = ObjectVar(
+        description="Render every device connected to this POP device",
+        model=Device,
+        required=False
+    )
+
+    device_role = ObjectVar(
+        description="Only devices with this role",
+        model=DeviceRole,
+        required=False
+    )
+
+    tag = ObjectVar(
+        description="Only devices with this tag",
+        model=Tag,
+        required=False
+    )
+
+    devices = MultiObjectVar(
+        description="Explicit list of devices",
+        model=Device,
+        required=False
+    )
+
+    config_template = ObjectVar(
+        description="Config template to use (defaults to each device's config template)",
+        model=ConfigTemplate,
+        required=False
+    )
+
+    output_dir = StringVar(
+        description="Directory for the rendered configs and manifest",
+        default="/opt/netbox/rendered-configs",
+        required=True
+    )
+
+    store_dir = StringVar(
+        description="Content-addressed config store with per-device history (empty to disable)",
+        default=CONFIG_STORE_DIR or "",
+        required=False
+    )
+
+    workers = IntegerVar(
+        description="Number of render processes",
+        default=4,
+        min_value=1,
+        required=False
+    )
+
+    force = BooleanVar(
+        description="Render even when the context hash did not change",
+        default=False
+    )
+
+    def get_devices(self, data):
+        queryset = Device.objects.all()
+        filtered = False
+        if data.get('site'):
+            queryset = queryset.filter(site=data['site'])
+            filtered = True
+        if data.get('pop_device'):
+            pop_device = data['pop_device']
+            queryset = queryset.filter(
+                Q(custom_field_data__Connectedto=pop_device.pk) |
+                Q(local_context_data__pop_device_name=pop_device.name)
+            )
+            filtered = True
+        if data.get('device_role'):
+            queryset = queryset.filter(device_role=data['device_role'])
+            filtered = True
+        if data.get('tag'):
+            queryset = queryset.filter(tags=data['tag'])
+            filtered = True
+        if data.get('devices'):
+            queryset = queryset.filter(pk__in=[device.pk for device in data['devices']])
+            filtered = True
+        if not filtered:
+            return None
+        return list(queryset.order_by('pk').values_list('pk', flat=True).distinct())
+
+    def run(self, data, commit):
+        device_ids = self.get_devices(data)
+        if device_ids is None:
+            self.log_failure("Select at least one filter (site, POP device, role, tag or devices)")
+            return
+        if not device_ids:
+            self.log_info("No devices matched the filter")
+            return
+
+        output_dir = data['output_dir']
+        result = render_to_directory(
+            device_ids, output_dir,
+            config_template=data.get('config_template'),
+            workers=data.get('workers') or 4,
+            force=data.get('force'),
+            commit=commit,
+            store=ConfigStore(data['store_dir']) if data.get('store_dir') else None
+        )
+
+        if result["missing_template"]:
+            self.log_warning(f"{result['missing_template']} devices have no config template and were ignored")
+        for device_id, failure in result["failures"].items():
+            self.log_failure(f"Failed to render device '{failure['name']}' (id {device_id}): {failure['error']}")
+        if not commit:
+            self.log_info(f"Simulation: Would have written {len(result['rendered'])} configs to {output_dir}")
+
+        elapsed = result["elapsed"]
+        throughput = len(device_ids) / elapsed if elapsed else 0
+        self.log_success(
+            f"{len(result['rendered'])} rendered ({result['unchanged_output']} with identical output), "
+            f"{result['skipped']} unchanged, {len(result['failures'])} failed "
+            f"out of {len(device_ids)} devices in {elapsed:.1f}s ({throughput:.1f} devices/sec)"
+        )
+
+        return f"Configs {'written' if commit else 'simulated'} in {output_dir}"
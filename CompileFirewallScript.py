@@ -0,0 +1,56 @@
+from extras.scripts import Script, StringVar
+from extras.models import ConfigContext
+from firewall_compiler import FIREWALL_CONTEXT_NAME, FIREWALL_RULES_FILE, compile_file
+
+class CompileFirewallScript(Script):
+
+    class Meta:
+        name = "Compile firewall rules"
+        description = "Compile firewall_rules_mikrotik_cpe.yaml into optimized RouterOS firewall commands and publish them as a config context"
+        commit_default = False
+
+    rules_file = StringVar(
+        description="Path to the firewall rules YAML",
+        default=FIREWALL_RULES_FILE,
+        required=False
+    )
+
+    def run(self, data, commit):
+        path = data.get('rules_file') or FIREWALL_RULES_FILE
+        try:
+            compiled = compile_file(path)
+        except OSError as e:
+            self.log_failure(f"Failed to read '{path}': {str(e)}")
+            return
+        except Exception as e:
+            self.log_failure(f"Failed to compile '{path}': {str(e)}")
+            return
+
+        rules_before, rules_after = compiled.stats["filter_rules"]
+        entries_before, entries_after = compiled.stats["address_list_entries"]
+        self.log_info(f"Filter rules: {rules_before} -> {rules_after}")
+        self.log_info(f"Address list entries: {entries_before} -> {entries_after}")
+        self.log_success(f"Compiled '{path}'")
+
+        # O config.j2 lê a chave "firewall" do config context no render nativo
+        data = {"firewall": compiled.commands}
+        config_context = ConfigContext.objects.filter(name=FIREWALL_CONTEXT_NAME).first()
+        if config_context is not None and config_context.data == data:
+            self.log_info(f"Config context '{FIREWALL_CONTEXT_NAME}' is up to date")
+        elif commit:
+            if config_context is None:
+                config_context = ConfigContext(
+                    name=FIREWALL_CONTEXT_NAME,
+                    description="Firewall rules compiled from firewall_rules_mikrotik_cpe.yaml",
+                    data=data
+                )
+            else:
+                config_context.snapshot()
+                config_context.data = data
+            config_context.full_clean()
+            config_context.save()
+            self.log_success(f"Config context '{FIREWALL_CONTEXT_NAME}' updated")
+        else:
+            self.log_info(f"Simulation: config context '{FIREWALL_CONTEXT_NAME}' would be updated")
+
+        return compiled.commands
@@ -0,0 +1,98 @@
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from extras.scripts import Script, ObjectVar, StringVar
+from dcim.models import Device
+from config_store import CONFIG_STORE_DIR, ConfigStore
+
+
+class ConfigDiffScript(Script):
+
+    class Meta:
+        name = "Diff rendered configs"
+        description = "Show the diff between two stored versions of a device config, or list the devices changed in a window"
+        commit_default = False
+
+    store_dir = StringVar(
+        description="Content-addressed config store directory",
+        default=CONFIG_STORE_DIR or "/opt/netbox/config-store",
+        required=True
+    )
+
+    device = ObjectVar(
+        description="Device to diff (leave empty to list changed devices)",
+        model=Device,
+        required=False
+    )
+
+    old_version = StringVar(
+        description="Old version: history index (-2 = previous) or content hash",
+        default="-2",
+        required=False
+    )
+
+    new_version = StringVar(
+        description="New version: history index (-1 = current) or content hash",
+        default="-1",
+        required=False
+    )
+
+    since = StringVar(
+        description="Change window start as ISO datetime (e.g. 2024-05-01T22:00:00Z)",
+        required=False
+    )
+
+    until = StringVar(
+        description="Change window end as ISO datetime (default: now)",
+        required=False
+    )
+
+    def parse(self, value):
+        if not value:
+            return None
+        parsed = parse_datetime(value.strip())
+        if parsed is None:
+            raise ValueError(f"Invalid datetime '{value}'")
+        return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+    def run(self, data, commit):
+        store = ConfigStore(data['store_dir'])
+
+        device = data.get('device')
+        if device:
+            history = store.history(device.pk)
+            if not history:
+                self.log_warning(f"No stored configs for device '{device.name}'")
+                return
+            for index, entry in enumerate(history):
+                self.log_info(f"{index - len(history)}: {entry['hash'][:12]} recorded at {entry['recorded_at']}")
+            try:
+                old = store.resolve(device.pk, data.get('old_version') or "-2")
+                new = store.resolve(device.pk, data.get('new_version') or "-1")
+                diff = store.diff_hashes(old, new)
+            except (ValueError, KeyError) as e:
+                self.log_failure(e.args[0])
+                return
+            if diff:
+                self.log_success(f"{device.name}: {(old or 'none')[:12]} -> {(new or 'none')[:12]}")
+            else:
+                self.log_info(f"{device.name}: versions are identical")
+            return diff
+
+        try:
+            since, until = self.parse(data.get('since')), self.parse(data.get('until'))
+        except ValueError as e:
+            self.log_failure(str(e))
+            return
+
+        changes = store.changes(since, until)
+        for device_id, change in sorted(changes.items(), key=lambda item: item[1]["name"] or ""):
+            self.log_info(f"{change['name']}: {(change['old'] or 'new')[:12]} -> {change['new'][:12]}")
+        self.log_success(f"{len(changes)} devices changed. Store: {store.stats()}")
+
+        diffs = []
+        for change in changes.values():
+            try:
+                diffs.append(store.diff_hashes(change["old"], change["new"]))
+            except (ValueError, KeyError) as e:
+                self.log_failure(f"{change['name']}: {e.args[0]}")
+        return "\n".join(diffs)
@@ -1,17 +1,51 @@
-from extras.scripts import Script, StringVar, ObjectVar
+from django.db.models import Exists, OuterRef, Value
+from django.db.models.functions import Concat
+from extras.scripts import Script, ChoiceVar, ObjectVar, MultiObjectVar
 from dcim.choices import InterfaceTypeChoices
-from dcim.models import Device, Interface, VLAN
+from dcim.models import Device, DeviceRole, Interface, Site
+from ipam.models import VLAN
+from extras.models import Tag
+from change_plan import ChangePlan, apply_change_plan
+
+EOIP_PREFIX = "EOIP-"
+# Limite do campo name da Interface no NetBox
+NAME_MAX_LENGTH = Interface._meta.get_field('name').max_length
+
 
 class CreateEoIPInterfaceScript(Script):
 
     class Meta:
         name = "Create EoIP Interface"
-        description = "Create an EoIP interface for a selected device and associate it with a VLAN"
+        description = "Create an EoIP interface on one or many devices and associate it with a VLAN"
 
     device = ObjectVar(
         description="Select the device",
         model=Device,
-        required=True
+        required=False
+    )
+
+    devices = MultiObjectVar(
+        description="Multi-device mode: explicit list of devices",
+        model=Device,
+        required=False
+    )
+
+    site = ObjectVar(
+        description="Multi-device mode: every device in this site",
+        model=Site,
+        required=False
+    )
+
+    device_role = ObjectVar(
+        description="Multi-device mode: only devices with this role",
+        model=DeviceRole,
+        required=False
+    )
+
+    tag = ObjectVar(
+        description="Multi-device mode: only devices with this tag",
+        model=Tag,
+        required=False
     )
 
     vlan_id = ObjectVar(
@@ -20,7 +54,7 @@ class CreateEoIPInterfaceScript(Script):
         required=True
     )
 
-    solucao = StringVar(
+    solucao = ChoiceVar(
         description="Select the solution",
         choices=[
             ('EOIP', 'EoIP'),
@@ -29,30 +63,100 @@ class CreateEoIPInterfaceScript(Script):
         required=True
     )
 
+    def get_devices(self, data):
+        queryset = Device.objects.all()
+        filtered = False
+        selected = [device.pk for device in data.get('devices') or []]
+        if data.get('device'):
+            selected.append(data['device'].pk)
+        if selected:
+            queryset = queryset.filter(pk__in=selected)
+            filtered = True
+        if data.get('site'):
+            queryset = queryset.filter(site=data['site'])
+            filtered = True
+        if data.get('device_role'):
+            queryset = queryset.filter(device_role=data['device_role'])
+            filtered = True
+        if data.get('tag'):
+            queryset = queryset.filter(tags=data['tag'])
+            filtered = True
+        return queryset.distinct() if filtered else None
+
     def run(self, data, commit):
-        device = data['device']
         vlan = data['vlan_id']
         solucao = data['solucao']
 
-        if solucao == 'EOIP':
-            # Criar a interface EoIP
-            eoip_interface_name = f"EOIP-{device.name}"
-            eoip_interface = Interface(
-                device=device,
-                name=eoip_interface_name,
-                type=InterfaceTypeChoices.TYPE_VLAN,
-                mode="access"
-            )
-
-            if commit:
-                eoip_interface.save()
-                eoip_interface.untagged_vlan = vlan
-                eoip_interface.save()
-                self.log_success(f"Interface '{eoip_interface_name}' criada e associada à VLAN '{vlan.name}'")
-            else:
-                self.log_info(f"Simulation: Would have created interface '{eoip_interface_name}' and associated it with VLAN '{vlan.name}'")
-        else:
+        if solucao != 'EOIP':
             self.log_info(f"Solução '{solucao}' selecionada, nenhuma interface EoIP será criada.")
+            return "Script completed successfully."
+
+        queryset = self.get_devices(data)
+        if queryset is None:
+            self.log_failure("Select a device, a list of devices or a filter (site, role or tag)")
+            return
+
+        plan = self.build_plan(queryset, vlan)
+        summary = plan.summary()
+        created = summary["creates"].get("dcim.interface", 0)
+        if not created:
+            self.log_info(f"No interfaces to create: {summary['conflicts']} devices skipped")
+            return f"0 interfaces created, {summary['conflicts']} skipped."
+
+        if commit:
+            # Uma única escrita, já com a VLAN definida
+            try:
+                apply_change_plan(plan.data)
+            except Exception as e:
+                self.log_failure(f"Failed to create EoIP interfaces: {str(e)}")
+                return
+            for entry in plan.data["creates"]:
+                self.log_success(f"Interface '{entry['fields']['name']}' criada e associada à VLAN '{vlan.name}'")
+        else:
+            for entry in plan.data["creates"]:
+                self.log_info(f"Simulation: Would have created interface '{entry['fields']['name']}' and associated it with VLAN '{vlan.name}'")
+
+        self.log_info(
+            f"{created} interfaces {'created' if commit else 'simulated'}, {summary['conflicts']} skipped"
+        )
+        if not commit:
+            return plan.to_json()
+        return f"{created} interfaces created, {summary['conflicts']} skipped."
 
-        return f"Script completed successfully for device {device.name}."
+    def build_plan(self, queryset, vlan):
+        # Uma única query: cada device e se ele já tem a interface EOIP-<nome>
+        rows = queryset.annotate(
+            has_eoip=Exists(Interface.objects.filter(
+                device=OuterRef('pk'),
+                name=Concat(Value(EOIP_PREFIX), OuterRef('name'))
+            ))
+        ).order_by('name').values_list('pk', 'name', 'site_id', 'has_eoip')
 
+        plan = ChangePlan(self)
+        for pk, name, site_id, has_eoip in rows:
+            if not name:
+                # Devices sem nome (permitido pelo NetBox) não têm nome de interface
+                self.log_warning(f"Device {pk} has no name, no EoIP interface name to derive")
+                plan.conflict(Interface, f"Device {pk} has no name", device_id=pk)
+                continue
+            if len(EOIP_PREFIX) + len(name) > NAME_MAX_LENGTH:
+                # Truncar poderia gerar o mesmo nome para dois devices
+                self.log_failure(f"Interface name '{EOIP_PREFIX}{name}' exceeds {NAME_MAX_LENGTH} characters")
+                plan.conflict(Interface, f"Interface name '{EOIP_PREFIX}{name}' exceeds {NAME_MAX_LENGTH} characters on device '{name}'", device_id=pk)
+                continue
+            if has_eoip:
+                plan.conflict(Interface, f"Interface '{EOIP_PREFIX}{name}' already exists on device '{name}'", device_id=pk)
+                continue
+            # Mesma regra do Interface.clean(): a VLAN precisa ser global ou do site do device
+            if vlan.site_id and vlan.site_id != site_id:
+                self.log_warning(f"VLAN '{vlan.name}' is not available at the site of device '{name}'")
+                plan.conflict(Interface, f"VLAN '{vlan.name}' is not available at the site of device '{name}'", device_id=pk)
+                continue
+            plan.create(Interface, {
+                "device_id": pk,
+                "name": f"{EOIP_PREFIX}{name}",
+                "type": InterfaceTypeChoices.TYPE_VIRTUAL,
+                "mode": "access",
+                "untagged_vlan_id": vlan.pk,
+            }, label=f"Interface '{EOIP_PREFIX}{name}' on device '{name}'")
+        return plan
@@ -1,7 +1,15 @@
-from extras.scripts import Script, ChoiceVar, ObjectVar, StringVar, IntegerVar
+import csv
+from netaddr import AddrFormatError, IPNetwork
+from extras.scripts import Script, ChoiceVar, ObjectVar, StringVar, IntegerVar, TextVar, BooleanVar
+from django.db.models import Q
 from dcim.models import Device, Interface, Site
-from ipam.models import IPAddress, VLAN
-from django.contrib.contenttypes.models import ContentType
+from ipam.models import IPAddress, Prefix, VLAN
+from interface_provisioning import SOLUTION_INTERFACES, plan_interfaces
+from prefix_allocator import allocate_tunnel_pairs
+from instrumentation import ScriptMetrics
+from provisioning_queue import submit_interfaces
+from vlan_allocator import allocate_vlans, create_vlans, get_or_create_vlans
+from change_plan import ChangePlan, StalePlanError, apply_change_plan, content_type_ref
 
 class CreateInterfaceScript(Script):
     class Meta:
@@ -11,7 +19,7 @@ class CreateInterfaceScript(Script):
     device = ObjectVar(
         description="Select the device",
         model=Device,
-        required=True
+        required=False
     )
 
     pop_device = ObjectVar(
@@ -36,133 +44,360 @@ class CreateInterfaceScript(Script):
         required=False
     )
 
+    tunnel_prefix = ObjectVar(
+        description="Allocate the device and POP IPs from this prefix when no IP is given",
+        model=Prefix,
+        required=False
+    )
+
+    tunnel_prefix_length = ChoiceVar(
+        description="Size of each allocated tunnel network",
+        choices=[('30', '/30'), ('31', '/31')],
+        default='30',
+        required=False
+    )
+
     vlan_id = IntegerVar(
         description="Enter the VLAN ID",
         required=False
     )
 
+    allocate_vlan = BooleanVar(
+        description="Allocate the next free VLAN ID of the site when no VLAN ID is given",
+        default=False
+    )
+
     serial_number = StringVar(
         description="Enter the device's serial number (optional)",
         required=False
     )
 
-    def run(self, data, commit):
-        device = data['device']
-        pop_device = data.get('pop_device')
-        solution = data['solution']
-        manual_ip = data.get('manual_ip')
-        pop_manual_ip = data.get('pop_manual_ip')
-        vlan_id = data.get('vlan_id')
-        serial_number = data.get('serial_number')
+    queued = BooleanVar(
+        description="Submit through the per-POP provisioning queue (batched with concurrent requests for the same POP)",
+        default=False
+    )
 
-        site = device.site
-        pop_site = pop_device.site if pop_device else None
+    sites = TextVar(
+        description="Multi-site mode: one line per site as device,pop_device,manual_ip,pop_manual_ip,vlan_id (replaces the fields above). Use name@site for device names that exist in more than one site",
+        required=False
+    )
 
-        self.log_info(f"Device: {device}, POP: {pop_device}, Site: {site.name}, POP Site: {pop_site.name if pop_site else 'N/A'}, Solution: {solution}, IP: {manual_ip}, POP IP: {pop_manual_ip}, VLAN ID: {vlan_id}")
+    def resolve_vlans(self, requests, allocate, commit):
+        # Look up VLANs by site and VID (one query per site), creating missing ones
+        # and allocating the next free VIDs for requests without a VLAN ID
+        by_site = {}
+        for request in requests:
+            request["vlan"] = None
+            by_site.setdefault(request["device"].site, []).append(request)
 
-        # Function to create VLAN if it does not exist
-        def get_or_create_vlan(vlan_id, site):
-            vlan = VLAN.objects.filter(id=vlan_id).first()
-            if not vlan:
-                vlan = VLAN(
-                    id=vlan_id,
-                    name=f"VLAN {vlan_id}",
-                    site=site,
-                    vid=vlan_id
-                )
+        for site, site_requests in by_site.items():
+            vids = [request["vlan_id"] for request in site_requests if request["vlan_id"]]
+            if vids:
+                try:
+                    vlans, created = get_or_create_vlans(vids, site=site, commit=commit)
+                except Exception as e:
+                    self.log_failure(f"Failed to create VLAN: {str(e)}")
+                    vlans, created = {}, set()
+                for vid in sorted(created):
+                    if commit:
+                        self.log_success(f"VLAN '{vlans[vid].name}' created and associated with site '{site.name}'.")
+                    else:
+                        self.log_info(f"Simulation: VLAN '{vlans[vid].name}' would be created and associated with site '{site.name}'.")
+                for request in site_requests:
+                    if request["vlan_id"]:
+                        request["vlan"] = vlans.get(request["vlan_id"])
+
+            pending = [request for request in site_requests if not request["vlan_id"]]
+            if not (allocate and pending):
+                continue
+            try:
+                try:
+                    vlans = allocate_vlans(len(pending), site=site, contiguous=len(pending) > 1, commit=commit)
+                except ValueError:
+                    # No contiguous block left, fall back to the lowest free VIDs
+                    vlans = allocate_vlans(len(pending), site=site, commit=commit)
+            except Exception as e:
+                self.log_failure(f"Failed to allocate VLAN for site '{site.name}': {str(e)}")
+                continue
+            for request, vlan in zip(pending, vlans):
+                request["vlan"] = vlan
+                request["vlan_id"] = vlan.vid
                 if commit:
-                    try:
-                        vlan.save()
-                        self.log_success(f"VLAN '{vlan.name}' created and associated with site '{site.name}'.")
-                    except Exception as e:
-                        self.log_failure(f"Failed to create VLAN: {str(e)}")
+                    self.log_success(f"VLAN '{vlan.name}' allocated with the next free VID for site '{site.name}'.")
                 else:
-                    self.log_info(f"Simulation: VLAN '{vlan.name}' would be created and associated with site '{site.name}'.")
-            return vlan
-
-        # Function to create interfaces on a specific device
-        def create_interface(device, interface_name, ip=None, vlan=None):
-            existing_interface = Interface.objects.filter(device=device, name=interface_name).first()
-            if existing_interface:
-                self.log_failure(f"Interface '{interface_name}' already exists on device '{device.name}'.")
+                    self.log_info(f"Simulation: VLAN '{vlan.name}' would be allocated for site '{site.name}'.")
+
+    def allocate_tunnel_ips(self, requests, prefix, prefix_length, commit):
+        # Hand out the next free point-to-point pair for requests without a manual IP
+        pending = [
+            request for request in requests
+            if not request["manual_ip"] and request["solution"] in SOLUTION_INTERFACES
+        ]
+        if not pending:
+            return
+        try:
+            pairs = allocate_tunnel_pairs(prefix, len(pending), prefix_length, lock=commit)
+        except ValueError as e:
+            self.log_failure(f"Failed to allocate tunnel IPs from prefix '{prefix}': {str(e)}")
+            return
+        for request, (device_ip, pop_ip) in zip(pending, pairs):
+            request["manual_ip"] = device_ip
+            message = f"IP '{device_ip}' allocated from prefix '{prefix}' for device '{request['device'].name}'"
+            if request["pop_device"] and not request["pop_manual_ip"]:
+                request["pop_manual_ip"] = pop_ip
+                message += f" and '{pop_ip}' for POP device '{request['pop_device'].name}'"
+            self.log_info(f"{message}.")
+
+    def build_plan(self, requests, serial_number, allocate):
+        # The same steps as a commit run, without writes: one VLAN query for every
+        # site and VID, one existence check for every interface
+        plan = ChangePlan(self)
+        wanted = {(request["device"].site_id, request["vlan_id"]) for request in requests if request["vlan_id"]}
+        vlans = {}
+        if wanted:
+            vlans = {
+                (site_id, vid): pk
+                for pk, site_id, vid in VLAN.objects.filter(
+                    site__in={site_id for site_id, _ in wanted},
+                    vid__in={vid for _, vid in wanted}
+                ).values_list('pk', 'site_id', 'vid')
+            }
+
+        pending = {}
+        for request in requests:
+            site = request["device"].site
+            key = (site.pk, request["vlan_id"])
+            if request["vlan_id"] and key not in vlans:
+                vlan = create_vlans([request["vlan_id"]], site=site, commit=False)[0]
+                vlans[key] = plan.create(VLAN, {"name": vlan.name, "vid": vlan.vid, "site_id": site.pk}, label=f"VLAN '{vlan.name}' at site '{site.name}'")
+            if request["vlan_id"]:
+                request["vlan"] = vlans[key]
+            else:
+                request["vlan"] = None
+                if allocate:
+                    pending.setdefault(site, []).append(request)
+
+        # Next free VIDs from the site bitmaps, without reserving them
+        for site, site_requests in pending.items():
+            allocated = allocate_vlans(len(site_requests), site=site, contiguous=len(site_requests) > 1, commit=False)
+            if len(allocated) < len(site_requests):
+                allocated = allocate_vlans(len(site_requests), site=site, commit=False)
+            for request, vlan in zip(site_requests, allocated):
+                if (site.pk, vlan.vid) in vlans:
+                    plan.conflict(VLAN, f"VID {vlan.vid} is already planned for site '{site.name}'.", site_id=site.pk, vid=vlan.vid)
+                    continue
+                request["vlan_id"] = vlan.vid
+                request["vlan"] = vlans[(site.pk, vlan.vid)] = plan.create(
+                    VLAN, {"name": vlan.name, "vid": vlan.vid, "site_id": site.pk}, label=f"VLAN '{vlan.name}' at site '{site.name}'"
+                )
+            for request in site_requests[len(allocated):]:
+                plan.conflict(VLAN, f"No free VID left for device '{request['device'].name}' in site '{site.name}'.", site_id=site.pk)
+
+        # Planned IPs that already exist: one query for every host, so the dry run
+        # shows the same conflict a commit run would find
+        items = plan_interfaces(requests)
+        hosts = {}
+        for item in items:
+            try:
+                hosts[item["ip"]] = str(IPNetwork(item["ip"]).ip) if item["ip"] else None
+            except (AddrFormatError, ValueError):
+                hosts[item["ip"]] = None
+        existing = set()
+        if any(hosts.values()):
+            query = Q()
+            for host in set(filter(None, hosts.values())):
+                query |= Q(address__net_host=host)
+            existing = {
+                str(address.ip) for address in IPAddress.objects.filter(query, vrf__isnull=True).values_list('address', flat=True)
+            }
+        planned = set()
+
+        for item in items:
+            device = item["device"]
+            if item["conflict"]:
+                plan.conflict(Interface, item["conflict"], device_id=device.pk, name=item["name"])
+                continue
+            fields = {"device_id": device.pk, "name": item["name"], "type": 'virtual', "enabled": True}
+            if item["vlan"]:
+                fields.update(mode='access', untagged_vlan_id=item["vlan"])
+            interface = plan.create(Interface, fields, label=f"Interface '{item['name']}' on device '{device.name}'")
+            if not item["ip"]:
+                continue
+            try:
+                version = IPNetwork(item["ip"]).version
+            except (AddrFormatError, ValueError):
+                plan.conflict(IPAddress, f"Invalid IP '{item['ip']}' for interface '{item['name']}' on device '{device.name}'.", device_id=device.pk)
+                continue
+            host = hosts[item["ip"]]
+            if host in existing or host in planned:
+                plan.conflict(
+                    IPAddress,
+                    f"IP '{item['ip']}' for interface '{item['name']}' on device '{device.name}' "
+                    f"{'already exists' if host in existing else 'is requested more than once'}.",
+                    address=item["ip"]
+                )
+                continue
+            planned.add(host)
+            ip_address = plan.create(IPAddress, {
+                "address": item["ip"],
+                "assigned_object_type_id": content_type_ref(Interface),
+                "assigned_object_id": interface,
+            }, label=f"IP '{item['ip']}' on interface '{item['name']}'")
+            plan.update(device, {f"primary_ip{version}_id": ip_address}, label=f"Device '{device.name}'")
+
+        if serial_number:
+            # A plan only updates devices it creates interfaces on
+            device = requests[0]["device"]
+            if any(entry["model"] == "dcim.interface" and entry["fields"]["device_id"] == device.pk for entry in plan.data["creates"]):
+                plan.update(device, {"serial": serial_number}, label=f"Device '{device.name}'")
             else:
-                interface = Interface(
-                    device=device,
-                    name=interface_name,
-                    type='virtual',
-                    enabled=True
+                plan.conflict(Device, f"Serial number not set: no interface is created on device '{device.name}'.", device_id=device.pk)
+        return plan
+
+    def parse_sites(self, text):
+        # One line per site: device,pop_device,manual_ip,pop_manual_ip,vlan_id
+        rows = []
+        for row in csv.reader(line for line in text.splitlines() if line.strip() and not line.startswith('#')):
+            row = [value.strip() for value in row] + [''] * 5
+            rows.append(row[:5])
+
+        # Resolve every device and POP device with a single query; a name may carry its site as name@site
+        names = {reference.rsplit('@', 1)[0] for row in rows for reference in row[:2] if reference}
+        devices = {}
+        for device in Device.objects.filter(name__in=names).select_related('site'):
+            devices.setdefault(device.name, []).append(device)
+
+        def resolve(number, label, reference):
+            name, site = reference.rsplit('@', 1) if '@' in reference else (reference, None)
+            candidates = [
+                device for device in devices.get(name, [])
+                if not site or site in (device.site.name, device.site.slug)
+            ]
+            if not candidates:
+                self.log_failure(f"Line {number}: {label} '{reference}' not found.")
+                return None
+            if len(candidates) > 1:
+                self.log_failure(
+                    f"Line {number}: {label} '{reference}' exists in more than one site "
+                    f"({', '.join(sorted(device.site.name for device in candidates))}), use name@site."
                 )
-                if commit:
-                    try:
-                        interface.save()
-                        self.log_success(f"Interface '{interface_name}' successfully created on device '{device.name}'.")
-
-                        # Associate IP with the interface
-                        if ip:
-                            ip_address = IPAddress(
-                                address=ip,
-                                assigned_object=interface,
-                                assigned_object_type=ContentType.objects.get_for_model(interface)
-                            )
-                            ip_address.save()
-                            self.log_success(f"IP '{ip_address.address}' successfully created and associated with interface '{interface_name}'.")
-
-                        # Set the IP as primary if necessary
-                        if ip:
-                            device.primary_ip4 = ip_address
-                            device.save()
-                            self.log_success(f"IP '{ip_address.address}' set as primary for device '{device.name}'.")
-
-                        # Associate VLAN with the interface
-                        if vlan:
-                            interface.vlan = vlan
-                            interface.save()
-                            self.log_success(f"VLAN '{vlan.name}' associated with interface '{interface_name}'.")
-
-                    except Exception as e:
-                        self.log_failure(f"Failed to create interface '{interface_name}': {str(e)}")
-                else:
-                    self.log_info(f"Simulation: Interface '{interface_name}' would be created on device '{device.name}'.")
+                return None
+            return candidates[0]
 
-        # Create or get the VLAN
-        vlan = get_or_create_vlan(vlan_id, site)
+        requests = []
+        for number, (device_name, pop_name, manual_ip, pop_manual_ip, vlan_id) in enumerate(rows, start=1):
+            device = resolve(number, "device", device_name)
+            if device is None:
+                continue
+            pop_device = resolve(number, "POP device", pop_name) if pop_name else None
+            if pop_name and pop_device is None:
+                continue
+            if vlan_id and not vlan_id.isdigit():
+                self.log_failure(f"Line {number}: invalid VLAN ID '{vlan_id}'.")
+                continue
+            requests.append({
+                "device": device,
+                "pop_device": pop_device,
+                "manual_ip": manual_ip or None,
+                "pop_manual_ip": pop_manual_ip or None,
+                "vlan_id": int(vlan_id) if vlan_id else None,
+            })
+        return requests
 
-        if solution == "EoIP":
-            # Create EoIP and GRE interfaces on the primary device
-            create_interface(device, f"EoIP-{site.name}")
-            create_interface(device, f"GRE-{site.name}", manual_ip, vlan)
+    def run(self, data, commit):
+        # O resumo da instrumentação é gravado em qualquer saída do run
+        with ScriptMetrics(self) as metrics:
+            return self.run_measured(data, commit, metrics)
 
-            # Create EoIP and GRE interfaces on the POP device, if provided
-            if pop_device:
-                create_interface(pop_device, f"EoIP-{site.name}")
-                create_interface(pop_device, f"GRE-{site.name}", pop_manual_ip, vlan)
+    def run_measured(self, data, commit, metrics):
+        solution = data['solution']
+        serial_number = data.get('serial_number')
 
-            # Create BRIDGE interfaces on the primary device and POP device
-            create_interface(device, f"BRIDGE-{site.name}")
-            if pop_device:
-                create_interface(pop_device, f"BRIDGE-{site.name}")
+        if data.get('sites'):
+            with metrics.phase("parse"):
+                requests = self.parse_sites(data['sites'])
+            serial_number = None
+        elif data.get('device'):
+            requests = [{
+                "device": data['device'],
+                "pop_device": data.get('pop_device'),
+                "manual_ip": data.get('manual_ip'),
+                "pop_manual_ip": data.get('pop_manual_ip'),
+                "vlan_id": data.get('vlan_id'),
+            }]
+        else:
+            self.log_failure("Select a device or fill in the multi-site list.")
+            return
 
-        elif solution == "L2TP":
-            # Create L2TP interface on the primary device
-            create_interface(device, f"L2TP-{site.name}.A001", manual_ip, vlan)
+        for request in requests:
+            device = request["device"]
+            pop_device = request["pop_device"]
+            site = device.site
+            pop_site = pop_device.site if pop_device else None
+            request["solution"] = solution
 
-            # Create L2TP interface on the POP device, if provided
-            if pop_device:
-                create_interface(pop_device, f"L2TP-{site.name}.A001", pop_manual_ip, vlan)
+            self.log_info(f"Device: {device}, POP: {pop_device}, Site: {site.name}, POP Site: {pop_site.name if pop_site else 'N/A'}, Solution: {solution}, IP: {request['manual_ip']}, POP IP: {request['pop_manual_ip']}, VLAN ID: {request['vlan_id']}")
 
-            # Create BRIDGE interfaces on the primary device and POP device
-            create_interface(device, f"BRIDGE-{site.name}")
-            if pop_device:
-                create_interface(pop_device, f"BRIDGE-{site.name}")
+        prefix_length = int(data.get('tunnel_prefix_length') or 30)
 
-        # Set the serial number manually, if provided
-        if serial_number:
-            device.serial = serial_number
-            device.save()
-            self.log_success(f"Serial number '{serial_number}' set for device '{device.name}'.")
+        # Queued mode: the POP batch job re-checks and creates the interfaces under the POP lock,
+        # and allocates the tunnel IPs there, in the same transaction that creates them
+        if commit and data.get('queued'):
+            with metrics.phase("vlans"):
+                self.resolve_vlans(requests, data.get('allocate_vlan'), commit)
+            for index, request in enumerate(requests):
+                request_id = submit_interfaces(
+                    request, serial_number if index == 0 else None,
+                    tunnel_prefix=data.get('tunnel_prefix'), tunnel_prefix_length=prefix_length
+                )
+                pop_device = request["pop_device"]
+                self.log_success(
+                    f"Request {request_id} queued for device '{request['device'].name}'"
+                    f"{f' on POP {pop_device.name}' if pop_device else ''}."
+                )
+            return f"{len(requests)} requests queued."
+
+        # Allocate tunnel IPs for the requests without a manual IP
+        if data.get('tunnel_prefix'):
+            with metrics.phase("ip_allocation"):
+                self.allocate_tunnel_ips(requests, data['tunnel_prefix'], prefix_length, commit)
+
+        # Compute the whole change set in memory; a dry run returns it as a plan,
+        # a commit run applies the very same plan
+        with metrics.phase("plan"):
+            plan = self.build_plan(requests, serial_number, data.get('allocate_vlan'))
+        for conflict in plan.data["conflicts"]:
+            self.log_failure(conflict["message"])
+
+        if not commit:
+            for entry in plan.data["creates"]:
+                self.log_info(f"Simulation: {entry['label']} would be created.")
+            for entry in plan.data["updates"]:
+                self.log_info(f"Simulation: {entry['label']} would be updated ({', '.join(entry['fields'])}).")
+            return plan.to_json()
+
+        try:
+            with metrics.phase("save"):
+                apply_change_plan(plan.data)
+        except StalePlanError as e:
+            self.log_failure(f"Changed while the plan was computed, run the script again: {str(e)}")
+            return
+        except Exception as e:
+            self.log_failure(f"Failed to create interfaces: {str(e)}")
+            return
+        for entry in plan.data["creates"]:
+            self.log_success(f"{entry['label']} created.")
+        for entry in plan.data["updates"]:
+            self.log_success(f"{entry['label']} updated ({', '.join(entry['fields'])}).")
+        if serial_number and any(entry["fields"].get("serial") for entry in plan.data["updates"]):
+            requests[0]["device"].serial = serial_number
 
         # Check and log the serial number of the device
-        if not device.serial:
-            self.log_info("Device does not have a registered serial number.")
+        for request in requests:
+            if not request["device"].serial:
+                self.log_info(f"Device '{request['device'].name}' does not have a registered serial number.")
 
-        return f"Process completed for devices {device.name} and {pop_device.name if pop_device else ''}."
+        if len(requests) == 1:
+            device, pop_device = requests[0]["device"], requests[0]["pop_device"]
+            return f"Process completed for devices {device.name} and {pop_device.name if pop_device else ''}."
+        return f"Process completed for {len(requests)} sites."
@@ -1,10 +1,16 @@
 import json
-import requests
-from extras.scripts import Script, StringVar, ObjectVar
+from django.db import transaction
+from extras.scripts import Script, StringVar, ObjectVar, BooleanVar
 from dcim.choices import DeviceStatusChoices
 from dcim.models import Device, DeviceRole, DeviceType, Site, Interface
 from ipam.models import IPAddress
 from extras.models import Tag, ConfigTemplate
+from pop_context import build_pop_context, shared_reference, sync_shared_context
+from webhook_outbox import WEBHOOK_URL, WebhookOutbox
+from instrumentation import ScriptMetrics
+from reference_cache import attach
+from provisioning_queue import submit_device
+from change_plan import ChangePlan
 
 class NewDeviceWithWebhookScript(Script):
 
@@ -56,47 +62,40 @@ class NewDeviceWithWebhookScript(Script):
         required=True
     )
 
+    shared_pop_context = BooleanVar(
+        description="Store the POP context once in a shared config context and only reference it from the device",
+        default=False
+    )
+
+    queued = BooleanVar(
+        description="Submit through the per-POP provisioning queue (batched with concurrent requests for the same POP)",
+        default=False
+    )
+
     def run(self, data, commit):
+        # O resumo da instrumentação é gravado em qualquer saída do run
+        with ScriptMetrics(self) as metrics:
+            return self.run_measured(data, commit, metrics)
+
+    def run_measured(self, data, commit, metrics):
         site = data['site']
         pop_device = data['pop_device']
         connected_to = data['connected_to']
+        self.script_metrics = metrics
 
         # Obter o dispositivo POP DEVICE
-        try:
-            pop_device_info = Device.objects.get(id=pop_device.id)
-        except Device.DoesNotExist:
-            self.log_failure(f"POP DEVICE '{pop_device.name}' not found in site '{pop_device.site.name}'")
-            return
+        with self.script_metrics.phase("pop_context"):
+            # O POP já vem do formulário; só o role sai do cache de referência
+            pop_device_info = pop_device
+            attach(pop_device_info, 'device_role')
 
-        # Obter todas as interfaces do POP DEVICE que possuem tags e seus endereços IP
-        interfaces_with_tags = Interface.objects.filter(device=pop_device_info, tags__isnull=False)
-
-        # Criar um dicionário para adicionar ao contexto local
-        local_context_dict = {
-            "pop_device_name": pop_device_info.name,
-            "pop_device_role": pop_device_info.device_role.name,
-            "interfaces": []
-        }
-
-        # Adicionar informações das interfaces e IPs ao dicionário
-        if interfaces_with_tags.exists():
-            for interface in interfaces_with_tags:
-                tags = ', '.join([tag.name for tag in interface.tags.all()])
-                # Obter todos os endereços IP associados a essa interface
-                ip_addresses = IPAddress.objects.filter(interface=interface)
-                ip_list = [str(ip) for ip in ip_addresses]
-
-                # Adicionar as informações ao dicionário
-                local_context_dict["interfaces"].append({
-                    "interface_name": interface.name,
-                    "tags": tags,
-                    "ips": ip_list
-                })
-        else:
+            local_context_dict = build_pop_context(pop_device_info)
+        if not local_context_dict["interfaces"]:
             self.log_info("No interfaces with tags found in POP DEVICE")
 
         # Criar o novo dispositivo com o contexto local
-        existing_device = Device.objects.filter(name=data['device_name'], site=site).first()
+        with self.script_metrics.phase("existence_check"):
+            existing_device = Device.objects.filter(name=data['device_name'], site=site).first()
         if existing_device:
             self.log_failure(f"A device with the name '{data['device_name']}' already exists in site '{site.name}'")
             return
@@ -114,46 +113,72 @@ class NewDeviceWithWebhookScript(Script):
             custom_field_data={"Connectedto": connected_to.id}  # Adiciona o ID do dispositivo ao campo customizado
         )
 
+        # Modo compartilhado: o device guarda apenas a referência ao contexto do POP
+        shared = data.get('shared_pop_context')
+        if shared:
+            device.local_context_data = shared_reference(pop_device_info)
+
         # Se um template de configuração foi fornecido, atribuí-lo ao dispositivo
         config_template = data.get('config_template', None)
         if config_template and isinstance(config_template, ConfigTemplate):
             device.config_template = config_template
 
-        if commit:
-            try:
-                device.save()  # Salvar o dispositivo para atribuir a chave primária
+        tag = data.get('tags', None)
 
-                tag = data.get('tags', None)
-                if tag:
-                    device.tags.add(tag)
+        # Dados para enviar no webhook
+        webhook_data = {
+            "device_name": device.name,
+            "site_name": site.name,
+            "pop_device_name": pop_device.name,
+            "local_context_data": local_context_dict,
+            "connected_to": connected_to.name,
+            "tags": tag.name if tag else None
+        }
 
-                self.log_success(f"Created new device: {device.name} at site {site.name} with local context data from {pop_device.name}")
+        if commit and data.get('queued'):
+            # O job do POP refaz a checagem de existência sob o lock do POP
+            request_id = submit_device(
+                pop_device_info, device, tag=data.get('tags'), shared=bool(shared), webhook_url=WEBHOOK_URL
+            )
+            self.log_success(f"Request {request_id} queued for device {device.name} on POP {pop_device.name}")
+            return f"Device {device.name} has been queued for creation at site {site.name}"
+
+        if commit:
+            # O evento é gravado no outbox na mesma transação do device e só é
+            # enfileirado para entrega depois do commit
+            outbox = WebhookOutbox(WEBHOOK_URL, callback=self.log_webhook_results)
 
-                # Dados para enviar no webhook
-                webhook_data = {
-                    "device_name": device.name,
-                    "site_name": site.name,
-                    "pop_device_name": pop_device.name,
-                    "local_context_data": local_context_dict,
-                    "connected_to": connected_to.name,
-                    "tags": tag.name if tag else None
-                }
+            try:
+                with self.script_metrics.phase("save"), transaction.atomic():
+                    device.save()  # Salvar o dispositivo para atribuir a chave primária
 
-                # URL do webhook (substitua pela URL real do seu webhook)
-                webhook_url = "https://seu-endpoint-webhook.com"
+                    if tag:
+                        device.tags.add(tag)
 
-                # Enviando os dados via POST para o webhook
-                response = requests.post(webhook_url, json=webhook_data)
+                    if shared:
+                        _, pop_tag = sync_shared_context(pop_device_info, local_context_dict)
+                        device.tags.add(pop_tag)
 
-                # Verificar se o webhook foi bem-sucedido
-                if response.status_code == 200:
-                    self.log_success("Webhook enviado com sucesso!")
-                else:
-                    self.log_failure(f"Falha ao enviar o webhook: {response.status_code} - {response.text}")
+                    outbox.record(device, webhook_data)
+
+                self.log_success(f"Created new device: {device.name} at site {site.name} with local context data from {pop_device.name}")
+                self.log_info("Webhook registrado no outbox, será enviado após o commit")
 
             except Exception as e:
                 self.log_failure(f"Failed to create device: {str(e)}")
         else:
+            # Plano da simulação: o webhook vai junto e é gravado no outbox
+            # quando o plano for aplicado pelo ApplyChangePlanScript
+            plan = ChangePlan(self)
+            plan.add_device(
+                device, tag=tag, pop_device=pop_device_info, shared=shared, local_context=local_context_dict,
+                webhook={"url": WEBHOOK_URL, "payload": webhook_data}
+            )
             self.log_info(f"Simulation: Would have created new device {device.name} at site {site.name}")
+            return plan.to_json()
+
+        return f"Device {device.name} has been created successfully at site {site.name}"
 
-        return f"Device {device.name} has been {'created' if commit else 'simulated'} successfully at site {site.name}"
+    def log_webhook_results(self, results):
+        # Chamado após o commit: a entrega roda em um job do RQ
+        self.log_info(f"{len(results['queued'])} webhook(s) enfileirados para entrega no job {results['job_id']}")
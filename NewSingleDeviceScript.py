@@ -1,9 +1,20 @@
+import csv
+import io
 import json
-from extras.scripts import Script, StringVar, ObjectVar
+import yaml
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from extras.scripts import Script, StringVar, ObjectVar, BooleanVar, FileVar
 from dcim.choices import DeviceStatusChoices
 from dcim.models import Device, DeviceRole, DeviceType, Site, Interface
 from ipam.models import IPAddress
-from extras.models import Tag, ConfigTemplate, ConfigContext
+from extras.models import Tag, TaggedItem, ConfigTemplate, ConfigContext
+from pop_context import build_pop_context, fetch_pop_contexts, shared_reference, sync_shared_context
+from change_plan import ChangePlan, instantiate_components
+from instrumentation import ScriptMetrics
+import reference_cache
 
 class NewSingleDeviceScript(Script):
 
@@ -55,47 +66,34 @@ class NewSingleDeviceScript(Script):
         required=True
     )
 
+    shared_pop_context = BooleanVar(
+        description="Store the POP context once in a shared config context and only reference it from the device",
+        default=False
+    )
+
     def run(self, data, commit):
+        # O resumo da instrumentação é gravado em qualquer saída do run
+        with ScriptMetrics(self) as metrics:
+            return self.run_measured(data, commit, metrics)
+
+    def run_measured(self, data, commit, metrics):
         site = data['site']
         pop_device = data['pop_device']
         connected_to = data['connected_to']
 
         # Obter o dispositivo POP DEVICE
-        try:
-            pop_device_info = Device.objects.get(id=pop_device.id)
-        except Device.DoesNotExist:
-            self.log_failure(f"POP DEVICE '{pop_device.name}' not found in site '{pop_device.site.name}'")
-            return
+        with metrics.phase("pop_context"):
+            # O POP já vem do formulário; só o role sai do cache de referência
+            pop_device_info = pop_device
+            reference_cache.attach(pop_device_info, 'device_role')
 
-        # Obter todas as interfaces do POP DEVICE que possuem tags e seus endereços IP
-        interfaces_with_tags = Interface.objects.filter(device=pop_device_info, tags__isnull=False)
-
-        # Criar um dicionário para adicionar ao contexto local
-        local_context_dict = {
-            "pop_device_name": pop_device_info.name,
-            "pop_device_role": pop_device_info.device_role.name,
-            "interfaces": []
-        }
-
-        # Adicionar informações das interfaces e IPs ao dicionário
-        if interfaces_with_tags.exists():
-            for interface in interfaces_with_tags:
-                tags = ', '.join([tag.name for tag in interface.tags.all()])
-                # Obter todos os endereços IP associados a essa interface
-                ip_addresses = IPAddress.objects.filter(interface=interface)
-                ip_list = [str(ip) for ip in ip_addresses]
-
-                # Adicionar as informações ao dicionário
-                local_context_dict["interfaces"].append({
-                    "interface_name": interface.name,
-                    "tags": tags,
-                    "ips": ip_list
-                })
-        else:
+            local_context_dict = build_pop_context(pop_device_info)
+        if not local_context_dict["interfaces"]:
             self.log_info("No interfaces with tags found in POP DEVICE")
 
         # Criar o novo dispositivo com o contexto local
-        existing_device = Device.objects.filter(name=data['device_name'], site=site).first()
+        with metrics.phase("existence_check"):
+            existing_device = Device.objects.filter(name=data['device_name'], site=site).first()
         if existing_device:
             self.log_failure(f"A device with the name '{data['device_name']}' already exists in site '{site.name}'")
             return
@@ -113,6 +111,11 @@ class NewSingleDeviceScript(Script):
             custom_field_data={"Connectedto": connected_to.id}  # Adiciona o ID do dispositivo ao campo customizado
         )
 
+        # Modo compartilhado: o device guarda apenas a referência ao contexto do POP
+        shared = data.get('shared_pop_context')
+        if shared:
+            device.local_context_data = shared_reference(pop_device_info)
+
         # Se um template de configuração foi fornecido, atribuí-lo ao dispositivo
         config_template = data.get('config_template', None)
         if config_template and isinstance(config_template, ConfigTemplate):
@@ -120,16 +123,259 @@ class NewSingleDeviceScript(Script):
 
         if commit:
             try:
-                device.save()  # Salvar o dispositivo para atribuir a chave primária
+                with metrics.phase("save"):
+                    device.save()  # Salvar o dispositivo para atribuir a chave primária
 
-                tag = data.get('tags', None)
-                if tag:
-                    device.tags.add(tag)
+                    tag = data.get('tags', None)
+                    if tag:
+                        device.tags.add(tag)
+
+                    if shared:
+                        _, pop_tag = sync_shared_context(pop_device_info, local_context_dict)
+                        device.tags.add(pop_tag)
 
                 self.log_success(f"Created new device: {device.name} at site {site.name} with local context data from {pop_device.name}")
             except Exception as e:
                 self.log_failure(f"Failed to create device: {str(e)}")
         else:
+            # Plano da simulação, aplicável depois pelo ApplyChangePlanScript
+            plan = ChangePlan(self)
+            plan.add_device(device, tag=data.get('tags'), pop_device=pop_device_info, shared=shared, local_context=local_context_dict)
             self.log_info(f"Simulation: Would have created new device {device.name} at site {site.name}")
+        if shared:
+            self.log_info(f"Device references the shared POP context '{device.local_context_data['pop_context']}'")
+
+        if not commit:
+            return plan.to_json()
+        return f"Device {device.name} has been created successfully at site {site.name}"
+
+
+# Colunas esperadas no arquivo de onboarding (CSV com cabeçalho ou lista YAML)
+BULK_COLUMNS = ('name', 'site', 'device_type', 'role', 'pop_device', 'connected_to', 'tag', 'config_template')
+BULK_REQUIRED = ('name', 'site', 'device_type', 'role', 'pop_device', 'connected_to')
+
+def parse_bulk_file(uploaded_file):
+    content = uploaded_file.read()
+    if isinstance(content, bytes):
+        content = content.decode('utf-8-sig')
+    filename = (getattr(uploaded_file, 'name', '') or '').lower()
+
+    if filename.endswith(('.yaml', '.yml')):
+        rows = yaml.safe_load(content) or []
+        if isinstance(rows, dict):
+            rows = rows.get('devices', [])
+    else:
+        rows = list(csv.DictReader(io.StringIO(content)))
+
+    parsed = []
+    for row in rows:
+        parsed.append({
+            column: str(row.get(column) or '').strip()
+            for column in BULK_COLUMNS
+        })
+    return parsed
+
+
+def lookup_by_names(queryset, values, fields=('name', 'slug')):
+    # Uma única query por model, aceitando nome ou slug
+    values = {value for value in values if value}
+    if not values:
+        return {}
+    query = Q()
+    for field in fields:
+        query |= Q(**{f'{field}__in': values})
+    lookup = {}
+    for obj in queryset.filter(query):
+        for field in fields:
+            lookup.setdefault(getattr(obj, field), obj)
+    return lookup
+
+
+class NewBulkDeviceScript(Script):
+
+    class Meta:
+        name = "Cria devices em lote"
+        description = "Create many devices from a CSV/YAML file with local context data from their POP devices"
+
+    devices_file = FileVar(
+        description="CSV ou YAML com as colunas: " + ", ".join(BULK_COLUMNS),
+        required=True
+    )
+
+    shared_pop_context = BooleanVar(
+        description="Store each POP context once in a shared config context and only reference it from the devices",
+        default=False
+    )
+
+    def run(self, data, commit):
+        # O resumo da instrumentação é gravado em qualquer saída do run
+        with ScriptMetrics(self) as metrics:
+            return self.run_measured(data, commit, metrics)
+
+    def run_measured(self, data, commit, metrics):
+        shared = data.get('shared_pop_context')
+        with metrics.phase("parse"):
+            rows = parse_bulk_file(data['devices_file'])
+        if not rows:
+            self.log_failure("Nenhuma linha encontrada no arquivo")
+            return
+
+        # Resolver todos os objetos referenciados com uma query por model
+        with metrics.phase("lookups"):
+            # Objetos de referência vêm do cache do processo
+            sites = reference_cache.lookup(Site, [row['site'] for row in rows])
+            device_types = reference_cache.lookup(DeviceType, [row['device_type'] for row in rows], ('model', 'slug'))
+            roles = reference_cache.lookup(DeviceRole, [row['role'] for row in rows])
+            tags = reference_cache.lookup(Tag, [row['tag'] for row in rows])
+            config_templates = reference_cache.lookup(ConfigTemplate, [row['config_template'] for row in rows], ('name',))
+            devices = lookup_by_names(
+                Device.objects.select_related('site', 'device_role'),
+                [row['pop_device'] for row in rows] + [row['connected_to'] for row in rows],
+                ('name',)
+            )
+
+        # Checagem de duplicados baseada em conjunto: uma única query para todos os nomes
+        with metrics.phase("existence_check"):
+            existing = set(
+                Device.objects.filter(name__in={row['name'] for row in rows}).values_list('name', 'site_id')
+            )
+
+        results = []
+        pending = []
+        pop_contexts = {}
+        seen = set()
+        if not commit:
+            # Simulação: os contextos de todos os POPs com três queries, sem
+            # checagem de versão por POP
+            with metrics.phase("pop_context"):
+                pop_contexts = fetch_pop_contexts(
+                    {devices[row['pop_device']] for row in rows if row['pop_device'] in devices}
+                )
+        for number, row in enumerate(rows, start=1):
+            missing = [column for column in BULK_REQUIRED if not row[column]]
+            if missing:
+                results.append((number, row['name'], False, f"Missing columns: {', '.join(missing)}"))
+                continue
+
+            site = sites.get(row['site'])
+            device_type = device_types.get(row['device_type'])
+            device_role = roles.get(row['role'])
+            pop_device = devices.get(row['pop_device'])
+            connected_to = devices.get(row['connected_to'])
+            tag = tags.get(row['tag']) if row['tag'] else None
+            config_template = config_templates.get(row['config_template']) if row['config_template'] else None
+
+            errors = []
+            for column, value, obj in (
+                ('site', row['site'], site),
+                ('device_type', row['device_type'], device_type),
+                ('role', row['role'], device_role),
+                ('pop_device', row['pop_device'], pop_device),
+                ('connected_to', row['connected_to'], connected_to),
+                ('tag', row['tag'], tag),
+                ('config_template', row['config_template'], config_template),
+            ):
+                if value and obj is None:
+                    errors.append(f"{column} '{value}' not found")
+            if errors:
+                results.append((number, row['name'], False, '; '.join(errors)))
+                continue
+
+            key = (row['name'], site.pk)
+            if key in existing:
+                results.append((number, row['name'], False, f"A device with the name '{row['name']}' already exists in site '{site.name}'"))
+                continue
+            if key in seen:
+                results.append((number, row['name'], False, f"Duplicate row for '{row['name']}' in site '{site.name}'"))
+                continue
+            seen.add(key)
+
+            # Contexto do POP montado uma única vez por POP distinto
+            if pop_device.pk not in pop_contexts:
+                with metrics.phase("pop_context"):
+                    pop_contexts[pop_device.pk] = build_pop_context(pop_device)
+
+            device = Device(
+                name=row['name'],
+                device_type=device_type,
+                site=site,
+                status=DeviceStatusChoices.STATUS_ACTIVE,
+                device_role=device_role,
+                airflow=device_type.airflow,
+                local_context_data=shared_reference(pop_device) if shared else pop_contexts[pop_device.pk],
+                custom_field_data={"Connectedto": connected_to.id},
+                config_template=config_template
+            )
+            # Mesma validação do save() pelo formulário; a unicidade já foi
+            # checada em lote acima
+            try:
+                device.full_clean(validate_unique=False)
+            except ValidationError as e:
+                results.append((number, row['name'], False, '; '.join(e.messages)))
+                continue
+            pending.append((number, device, tag, pop_device))
+
+        if pending and commit:
+            try:
+                with metrics.phase("save"), transaction.atomic():
+                    created = Device.objects.bulk_create([device for _, device, _, _ in pending])
+                    instantiate_components(created)
+
+                    # Modo compartilhado: um ConfigContext e uma tag por POP distinto
+                    pop_tags = {}
+                    if shared:
+                        for _, _, _, pop_device in pending:
+                            if pop_device.pk not in pop_tags:
+                                _, pop_tags[pop_device.pk] = sync_shared_context(pop_device, pop_contexts[pop_device.pk])
+
+                    content_type = reference_cache.content_type(Device)
+                    TaggedItem.objects.bulk_create([
+                        TaggedItem(tag=tag, content_type=content_type, object_id=device.pk)
+                        for _, device, tag, _ in pending if tag
+                    ] + [
+                        TaggedItem(tag=pop_tags[pop_device.pk], content_type=content_type, object_id=device.pk)
+                        for _, device, _, pop_device in pending if shared
+                    ])
+
+                    # O bulk_create não dispara sinais: change log e handlers dos
+                    # devices, já com componentes e tags gravados
+                    for device in created:
+                        post_save.send(sender=Device, instance=device, created=True, raw=False, using='default', update_fields=None)
+            except Exception as e:
+                for number, device, _, _ in pending:
+                    results.append((number, device.name, False, f"Failed to create device: {str(e)}"))
+                pending = []
+
+        if not commit:
+            # Plano da simulação, aplicável depois pelo ApplyChangePlanScript
+            plan = ChangePlan(self)
+            for number, device, tag, pop_device in pending:
+                plan.add_device(device, tag=tag, pop_device=pop_device, shared=shared, local_context=pop_contexts[pop_device.pk])
+            for number, name, _, message in sorted(results):
+                plan.conflict(Device, message, row=number, name=name)
+
+        for number, device, _, pop_device in pending:
+            if commit:
+                message = f"Created new device: {device.name} at site {device.site.name} with local context data from {pop_device.name}"
+            else:
+                message = f"Simulation: Would have created new device {device.name} at site {device.site.name}"
+            results.append((number, device.name, True, message))
+
+        # Relatório por linha
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(('row', 'name', 'status', 'message'))
+        for number, name, success, message in sorted(results):
+            if success:
+                self.log_success(f"Row {number}: {message}")
+            else:
+                self.log_failure(f"Row {number} ({name}): {message}")
+            writer.writerow((number, name, 'ok' if success else 'failed', message))
+
+        succeeded = sum(1 for result in results if result[2])
+        self.log_info(f"{succeeded} of {len(rows)} rows {'created' if commit else 'simulated'}, {len(pop_contexts)} POP contexts built")
+        self.log_info(f"Reference cache: {reference_cache.stats}")
 
-        return f"Device {device.name} has been {'created' if commit else 'simulated'} successfully at site {site.name}"
+        if not commit:
+            return plan.to_json()
+        return output.getvalue()
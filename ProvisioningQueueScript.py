@@ -0,0 +1,44 @@
+from extras.scripts import Script, TextVar
+from dcim.models import Device
+from provisioning_queue import get_result, metrics
+
+
+class ProvisioningQueueScript(Script):
+
+    class Meta:
+        name = "Provisioning queue status"
+        description = "Show the per-POP provisioning queue depth, recent batch sizes and the result of queued requests"
+        commit_default = False
+
+    request_ids = TextVar(
+        description="Request ids to look up, one per line (optional)",
+        required=False
+    )
+
+    def run(self, data, commit):
+        stats = metrics()
+        names = dict(Device.objects.filter(
+            pk__in=set(stats["depth"]) | {batch["pop_id"] for batch in stats["recent"]}
+        ).values_list('pk', 'name'))
+
+        for pop_id, depth in sorted(stats["depth"].items()):
+            self.log_info(f"POP {names.get(pop_id, pop_id)}: {depth} requests waiting")
+        for batch in stats["recent"]:
+            self.log_info(
+                f"{batch['at']} POP {names.get(batch['pop_id'], batch['pop_id'])}: {batch['size']} requests "
+                f"in {batch['seconds']}s after waiting {batch['wait_seconds']}s"
+            )
+        self.log_success(
+            f"{stats['queued']} requests queued; last {stats['batches']} batches: "
+            f"avg size {stats['batch_size_avg']}, p95 {stats['batch_size_p95']}, max {stats['batch_size_max']}"
+        )
+
+        for request_id in (data.get('request_ids') or "").split():
+            result = get_result(request_id)
+            if result is None:
+                self.log_warning(f"Request {request_id}: unknown or expired")
+                continue
+            log = {"done": self.log_success, "queued": self.log_info}.get(result["status"], self.log_failure)
+            log(f"Request {request_id}: {result['status']}")
+            for message in result.get("messages", []):
+                self.log_info(f"Request {request_id}: {message}")
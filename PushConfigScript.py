@@ -0,0 +1,198 @@
+import os
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from extras.choices import JournalEntryKindChoices
+from extras.models import JournalEntry, Tag
+from extras.scripts import Script, ObjectVar, MultiObjectVar, StringVar, IntegerVar, ChoiceVar
+from dcim.models import Device, Site
+from config_push import TRANSPORTS, ConfigPusher
+from config_render import load_manifest, parse_connected_to
+
+# Credenciais dos devices, fora do formulário e do log do job
+PUSH_USERNAME = os.environ.get("NETBOX_PUSH_USERNAME", "admin")
+PUSH_PASSWORD = os.environ.get("NETBOX_PUSH_PASSWORD", "")
+JOURNAL_PREFIX = "[config-push]"
+
+
+class PushConfigScript(Script):
+
+    class Meta:
+        name = "Push rendered configs"
+        description = "Apply rendered configs to MikroTik devices over the RouterOS API or SSH, rate limited per POP"
+        commit_default = False
+
+    site = ObjectVar(
+        description="Push every device in this site",
+        model=Site,
+        required=False
+    )
+
+    pop_device = ObjectVar(
+        description="Push every device connected to this POP device",
+        model=Device,
+        required=False
+    )
+
+    tag = ObjectVar(
+        description="Only devices with this tag",
+        model=Tag,
+        required=False
+    )
+
+    devices = MultiObjectVar(
+        description="Explicit list of devices",
+        model=Device,
+        required=False
+    )
+
+    artifacts_dir = StringVar(
+        description="Directory with the rendered configs and manifest (see the bulk render script)",
+        default=os.environ.get("NETBOX_RENDER_OUTPUT_DIR", "/opt/netbox/rendered-configs"),
+        required=True
+    )
+
+    transport = ChoiceVar(
+        description="How to reach the devices",
+        choices=[(name, name.upper()) for name in TRANSPORTS],
+        default="api"
+    )
+
+    port = IntegerVar(
+        description="Port (default: 8728 for the API, 22 for SSH)",
+        required=False
+    )
+
+    host_override = StringVar(
+        description="Send every push to this host instead of the device primary IP (lab or fake RouterOS endpoint)",
+        required=False
+    )
+
+    workers = IntegerVar(
+        description="Devices pushed in parallel",
+        default=8,
+        min_value=1
+    )
+
+    pop_concurrency = IntegerVar(
+        description="Maximum simultaneous pushes per POP",
+        default=2,
+        min_value=1
+    )
+
+    pop_interval = IntegerVar(
+        description="Minimum milliseconds between push starts in the same POP",
+        default=0,
+        min_value=0,
+        required=False
+    )
+
+    timeout = IntegerVar(
+        description="Per-device connection and command timeout in seconds",
+        default=30,
+        min_value=1
+    )
+
+    def get_devices(self, data):
+        queryset = Device.objects.all()
+        filtered = False
+        if data.get('site'):
+            queryset = queryset.filter(site=data['site'])
+            filtered = True
+        if data.get('pop_device'):
+            pop_device = data['pop_device']
+            queryset = queryset.filter(
+                Q(custom_field_data__Connectedto=pop_device.pk) |
+                Q(local_context_data__pop_device_name=pop_device.name)
+            )
+            filtered = True
+        if data.get('tag'):
+            queryset = queryset.filter(tags=data['tag'])
+            filtered = True
+        if data.get('devices'):
+            queryset = queryset.filter(pk__in=[device.pk for device in data['devices']])
+            filtered = True
+        return queryset.distinct().select_related('primary_ip4', 'primary_ip6') if filtered else None
+
+    def run(self, data, commit):
+        queryset = self.get_devices(data)
+        if queryset is None:
+            self.log_failure("Select at least one filter (site, POP device, tag or devices)")
+            return
+
+        artifacts_dir = data['artifacts_dir']
+        manifest = load_manifest(artifacts_dir).get("devices", {})
+        jobs = []
+        for device in queryset.order_by('name'):
+            entry = manifest.get(str(device.pk))
+            if not entry or not os.path.exists(os.path.join(artifacts_dir, entry["file"])):
+                self.log_warning(f"No rendered config for device '{device.name}'")
+                continue
+            primary_ip = device.primary_ip4 or device.primary_ip6
+            host = data.get('host_override') or (str(primary_ip.address.ip) if primary_ip else None)
+            if not host:
+                self.log_warning(f"Device '{device.name}' has no primary IP")
+                continue
+            with open(os.path.join(artifacts_dir, entry["file"])) as artifact:
+                text = artifact.read()
+            jobs.append({
+                "device": device,
+                "device_id": device.pk,
+                "name": device.name,
+                "host": host,
+                "pop": parse_connected_to(device.custom_field_data),
+                "text": text,
+                "content_hash": entry.get("content_hash"),
+            })
+
+        if not jobs:
+            self.log_info("Nothing to push")
+            return
+
+        if not commit:
+            for job in jobs:
+                self.log_info(f"Simulation: Would push {job['content_hash'][:12] if job['content_hash'] else 'config'} to {job['name']} ({job['host']})")
+            self.log_info(f"Simulation: {len(jobs)} devices in {len({job['pop'] for job in jobs})} POPs")
+            return
+
+        pusher = ConfigPusher(
+            transport=data['transport'],
+            username=PUSH_USERNAME,
+            password=PUSH_PASSWORD,
+            port=data.get('port') or None,
+            timeout=data['timeout'],
+            workers=data['workers'],
+            pop_concurrency=data['pop_concurrency'],
+            pop_interval=(data.get('pop_interval') or 0) / 1000
+        )
+        try:
+            results, stats = pusher.push(jobs)
+        finally:
+            pusher.close()
+
+        # Resultado de cada device gravado no journal em uma única inserção
+        jobs_by_id = {job["device_id"]: job for job in jobs}
+        content_type = ContentType.objects.get_for_model(Device)
+        entries = []
+        for result in sorted(results, key=lambda result: result["name"]):
+            job = jobs_by_id[result["device_id"]]
+            if result["status"] == "ok":
+                self.log_success(f"{result['name']}: config applied in {result['seconds']}s")
+                comments = f"{JOURNAL_PREFIX} ok {job['content_hash'] or ''} in {result['seconds']}s"
+                kind = JournalEntryKindChoices.KIND_SUCCESS
+            else:
+                self.log_failure(f"{result['name']}: {result['error']} after {result['attempts']} attempts")
+                comments = f"{JOURNAL_PREFIX} failed after {result['attempts']} attempts: {result['error']}"
+                kind = JournalEntryKindChoices.KIND_DANGER
+            entries.append(JournalEntry(
+                assigned_object_type=content_type,
+                assigned_object_id=result["device_id"],
+                kind=kind,
+                comments=comments
+            ))
+        JournalEntry.objects.bulk_create(entries)
+
+        self.log_info(
+            f"{stats['ok']} applied, {stats['failed']} failed out of {stats['devices']} devices "
+            f"in {stats['seconds']}s ({stats['devices_per_minute']} devices/minute)"
+        )
+        return f"{stats['ok']} of {stats['devices']} configs applied"
@@ -0,0 +1,42 @@
+from extras.scripts import Script, MultiObjectVar, StringVar, BooleanVar
+from dcim.models import Device
+from dependency_index import RENDER_OUTPUT_DIR, get_index, refresh_dependents
+
+
+class RefreshDependentsScript(Script):
+
+    class Meta:
+        name = "Refresh POP dependents"
+        description = "Refresh the copied POP context and re-render only the CPEs that depend on the selected POP devices"
+        commit_default = False
+
+    pop_devices = MultiObjectVar(
+        description="POP devices whose dependents should be refreshed",
+        model=Device,
+        required=True
+    )
+
+    output_dir = StringVar(
+        description="Directory for the rendered configs (empty to only refresh the context)",
+        default=RENDER_OUTPUT_DIR or "/opt/netbox/rendered-configs",
+        required=False
+    )
+
+    rebuild_index = BooleanVar(
+        description="Rebuild the dependency index before refreshing",
+        default=False
+    )
+
+    def run(self, data, commit):
+        index = get_index(rebuild=data.get('rebuild_index'))
+        self.log_info(f"Dependency index: {index.stats()}")
+
+        pop_ids = [pop.pk for pop in data['pop_devices']]
+        result = refresh_dependents(pop_ids, output_dir=data.get('output_dir') or None, commit=commit)
+
+        for device_id, failure in result["failures"].items():
+            self.log_failure(f"Failed to render device '{failure['name']}' (id {device_id}): {failure['error']}")
+        self.log_success(
+            f"{result['dependents']} dependent devices: {result['context_updated']} contexts "
+            f"{'updated' if commit else 'would be updated'}, {result['rendered']} rendered, {result['skipped']} unchanged"
+        )
@@ -0,0 +1,45 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from extras.scripts import Script, ObjectVar
+from dcim.models import Device
+from extras.models import ConfigTemplate
+from config_render import build_render_context, render_config
+
+class RenderConfigScript(Script):
+
+    class Meta:
+        name = "Render device config"
+        description = "Render a config template for a device from a pre-resolved context (no queries inside the template)"
+        commit_default = False
+
+    device = ObjectVar(
+        description="Select the device",
+        model=Device,
+        required=True
+    )
+
+    config_template = ObjectVar(
+        description="Config template (defaults to the device's config template)",
+        model=ConfigTemplate,
+        required=False
+    )
+
+    def run(self, data, commit):
+        device = data['device']
+        config_template = data.get('config_template') or device.get_config_template()
+        if not config_template:
+            self.log_failure(f"No config template assigned to device '{device.name}'")
+            return
+
+        with CaptureQueriesContext(connection) as context_queries:
+            context = build_render_context(device)
+        with CaptureQueriesContext(connection) as render_queries:
+            rendered = render_config(config_template, context)
+
+        self.log_info(
+            f"Context built with {len(context_queries)} queries, "
+            f"template '{config_template.name}' rendered with {len(render_queries)} queries"
+        )
+        self.log_success(f"Config rendered for device '{device.name}'")
+
+        return rendered
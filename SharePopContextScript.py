@@ -0,0 +1,130 @@
+import json
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+from extras.scripts import Script, MultiObjectVar
+from dcim.models import Device
+from extras.models import TaggedItem
+from pop_context import SHARED_CONTEXT_KEYS, build_pop_context, shared_reference, sync_shared_context
+
+# Devices lidos por rodada do iterator e gravados por bulk_update
+CHUNK_SIZE = 2000
+
+
+def device_chunks(queryset, chunk_size=CHUNK_SIZE):
+    devices = []
+    for device in queryset.order_by('pk').iterator(chunk_size=chunk_size):
+        devices.append(device)
+        if len(devices) == chunk_size:
+            yield devices
+            devices = []
+    if devices:
+        yield devices
+
+
+def context_size(data):
+    return len(json.dumps(data, sort_keys=True)) if data else 0
+
+
+class SharePopContextScript(Script):
+
+    class Meta:
+        name = "Migrate to shared POP context"
+        description = "Replace the POP context copied into each CPE by a reference to one shared config context per POP"
+        commit_default = False
+
+    pop_devices = MultiObjectVar(
+        description="Only migrate the CPEs of these POP devices (default: all)",
+        model=Device,
+        required=False
+    )
+
+    def run(self, data, commit):
+        queryset = Device.objects.filter(
+            local_context_data__has_key="pop_device_name"
+        ).filter(local_context_data__has_key="interfaces")
+        if data.get('pop_devices'):
+            queryset = queryset.filter(local_context_data__pop_device_name__in=[pop.name for pop in data['pop_devices']])
+
+        # Só os nomes dos POPs são carregados de uma vez; os CPEs de cada POP
+        # são lidos em blocos pelo iterator
+        pop_names = sorted(set(
+            queryset.order_by().values_list('local_context_data__pop_device_name', flat=True).distinct()
+        ))
+        if not pop_names:
+            self.log_info("No devices with a copied POP context found")
+            return
+
+        pops = {}
+        for pop in Device.objects.filter(name__in=pop_names).select_related('device_role'):
+            pops.setdefault(pop.name, []).append(pop)
+
+        content_type = ContentType.objects.get_for_model(Device)
+        before = after = shared_bytes = migrated = stale = 0
+        for pop_name in pop_names:
+            cpes = queryset.filter(local_context_data__pop_device_name=pop_name)
+            if len(pops.get(pop_name, [])) != 1:
+                self.log_warning(
+                    f"Skipping {cpes.count()} devices of POP '{pop_name}': "
+                    f"{'no device' if pop_name not in pops else 'more than one device'} with this name"
+                )
+                continue
+            pop = pops[pop_name][0]
+            local_context = build_pop_context(pop)
+            reference = shared_reference(pop)
+            tag = None
+            if commit:
+                _, tag = sync_shared_context(pop, local_context)
+
+            count = 0
+            for devices in device_chunks(cpes):
+                now = timezone.now()
+                for device in devices:
+                    before += context_size(device.local_context_data)
+                    if any(device.local_context_data.get(key) != local_context.get(key) for key in SHARED_CONTEXT_KEYS):
+                        stale += 1
+                    if commit:
+                        # Estado anterior para o change log
+                        device.snapshot()
+                    # Mantém chaves que não fazem parte do contexto do POP
+                    device.local_context_data = {
+                        key: value for key, value in device.local_context_data.items() if key not in SHARED_CONTEXT_KEYS
+                    }
+                    device.local_context_data.update(reference)
+                    device.last_updated = now
+                    after += context_size(device.local_context_data)
+                count += len(devices)
+
+                if commit:
+                    with transaction.atomic():
+                        Device.objects.bulk_update(devices, ['local_context_data', 'last_updated'])
+                        tagged = set(TaggedItem.objects.filter(
+                            tag=tag, content_type=content_type, object_id__in=[device.pk for device in devices]
+                        ).values_list('object_id', flat=True))
+                        TaggedItem.objects.bulk_create([
+                            TaggedItem(tag=tag, content_type=content_type, object_id=device.pk)
+                            for device in devices if device.pk not in tagged
+                        ])
+                        # O bulk_update não dispara sinais: change log e webhooks,
+                        # enviados depois das tags para que apareçam no registro
+                        for device in devices:
+                            post_save.send(
+                                sender=Device, instance=device, created=False, raw=False, using='default',
+                                update_fields=frozenset({'local_context_data', 'last_updated'})
+                            )
+            shared_bytes += context_size(local_context)
+            migrated += count
+            self.log_success(f"{'Migrated' if commit else 'Would migrate'} {count} devices of POP '{pop_name}'")
+
+        reclaimed = before - after - shared_bytes
+        if stale:
+            self.log_warning(f"{stale} devices had an outdated copy and now see the current POP context")
+        self.log_info(
+            f"{migrated} devices: {before} bytes of copied context replaced by {after} bytes of references "
+            f"and {shared_bytes} bytes of shared contexts, {reclaimed} bytes reclaimed"
+        )
+        if commit:
+            self.log_info("The space is returned to the database by the next VACUUM of the device table")
+
+        return f"{reclaimed} bytes {'reclaimed' if commit else 'would be reclaimed'}"
@@ -1,20 +1,93 @@
-import re
+import os
 
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
 from dcim.choices import DeviceStatusChoices
 from dcim.models import Device
 from extras.reports import Report
+from compliance_rules import HOSTNAME_PATTERN, RULES, run_rules
+
+# Number of (id, name) rows fetched per round trip by the server-side cursor
+CHUNK_SIZE = 2000
+
+# Cache key holding the last_updated watermark of the incremental report
+WATERMARK_KEY = "ValidaNameReport.IncrementalDeviceHostnameReport.watermark"
+# Cache key holding the pks that failed the last incremental run
+FAILING_KEY = "ValidaNameReport.IncrementalDeviceHostnameReport.failing"
+
+# Processes used to evaluate the compliance rules
+COMPLIANCE_WORKERS = int(os.environ.get("NETBOX_COMPLIANCE_WORKERS", "4"))
+
 
 class DeviceHostnameReport(Report):
     description = "Verify each device conforms to naming convention Example: ABC.5555.A555.PE05"
 
+    def get_queryset(self):
+        return Device.objects.filter(status=DeviceStatusChoices.STATUS_ACTIVE)
+
     def test_device_naming(self):
-        # Regex pattern to match the naming convention
-        pattern = r"[A-Za-z0-9]{3,4}\.[0-9]{3,6}\.[A-Z][0-9]{3}\.PE[0-9]{1,2}"
-        
-        for device in Device.objects.filter(status=DeviceStatusChoices.STATUS_ACTIVE):
-            # Check if the device name matches the pattern
-            self.info("Cheking", device.name)
-            if re.match(pattern, device.name):
-                self.log_success(device.name)
-            else:
-                self.log_failure(device, "Hostname does not conform to standard!")
+        checked = 0
+        failed = []
+
+        # Stream only (id, name) and log failures only
+        for pk, name in self.get_queryset().values_list('id', 'name').iterator(chunk_size=CHUNK_SIZE):
+            checked += 1
+            if not name or not HOSTNAME_PATTERN.match(name):
+                failed.append(pk)
+                # Lightweight instance so the log entry still links to the device
+                self.log_failure(Device(pk=pk, name=name), "Hostname does not conform to standard!")
+
+        self.log_success(None, f"{checked - len(failed)} of {checked} devices conform to the naming convention")
+        return failed
+
+
+class IncrementalDeviceHostnameReport(DeviceHostnameReport):
+    description = "Verify only devices created or renamed since the last successful run conform to the naming convention"
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        watermark = cache.get(WATERMARK_KEY)
+        if watermark:
+            # Devices that failed last time are re-checked until they pass
+            failing = cache.get(FAILING_KEY) or []
+            self.log_info(None, f"Checking devices changed since {watermark.isoformat()} and {len(failing)} previously failing devices")
+            queryset = queryset.filter(Q(last_updated__gte=watermark) | Q(pk__in=failing))
+        else:
+            self.log_info(None, "No watermark found, checking all devices")
+        return queryset
+
+    def test_device_naming(self):
+        started = timezone.now()
+        failed = super().test_device_naming()
+
+        # Only advance the watermark once the whole pass has completed, keeping
+        # the failing devices so the next run checks them again
+        cache.set(FAILING_KEY, failed, timeout=None)
+        cache.set(WATERMARK_KEY, started, timeout=None)
+
+
+class DeviceComplianceReport(Report):
+    description = "Evaluate every compliance rule (hostname, interface naming, serial, ConnectedTo, primary IP) in a single pass"
+
+    def get_queryset(self):
+        return Device.objects.filter(status=DeviceStatusChoices.STATUS_ACTIVE)
+
+    def test_compliance(self):
+        def log_failure(pk, name, rule, message):
+            self.log_failure(Device(pk=pk, name=name), f"[{rule}] {message}")
+
+        summary = run_rules(self.get_queryset(), log_failure, workers=COMPLIANCE_WORKERS)
+
+        for rule, failures in summary["failures"].items():
+            self.log_info(
+                None,
+                f"{rule}: {summary['devices'] - failures} of {summary['devices']} devices pass "
+                f"({RULES[rule].description}), {summary['seconds'][rule]:.3f}s"
+            )
+        failed = sum(summary["failures"].values())
+        self.log_success(
+            None,
+            f"{summary['devices']} devices checked against {len(summary['failures'])} rules, {failed} failures, "
+            f"{summary['load_seconds']:.1f}s loading"
+        )
@@ -0,0 +1,582 @@
+import json
+
+from django.apps import apps
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from netaddr import AddrFormatError, IPNetwork
+from dcim.models import Device, Interface, Site
+from ipam.models import IPAddress, Prefix, VLAN
+from extras.models import TaggedItem
+from pop_context import fetch_pop_contexts, sync_shared_context
+from webhook_outbox import WEBHOOK_URL, WebhookOutbox
+import reference_cache
+
+# Plano de mudanças dos scripts de provisionamento. A simulação (commit
+# desmarcado) carrega o estado necessário com poucas queries em lote e monta
+# em memória tudo o que seria criado, alterado ou recusado; o plano sai como
+# JSON no output do job e pode ser aplicado como está pelo ApplyChangePlanScript,
+# sem recalcular nada.
+#
+# Formato:
+#   creates: [{"ref", "model", "fields", "label"}] na ordem de aplicação
+#   updates: [{"model", "pk", "fields", "expected", "label"}], com o valor
+#     de cada campo na simulação em expected
+#   shared_contexts: [{"pop_device", "data"}] (modo compartilhado do POP)
+#   conflicts: [{"model", "message", "key"}] apenas informativos
+#   signature: HMAC do restante do plano com a SECRET_KEY
+# Campos de FK listados em MARKER_FIELDS podem ser marcadores resolvidos na aplicação:
+#   {"ref": "dcim.interface:3"}  pk de um objeto criado pelo próprio plano
+#   {"content_type": "dcim.device"}  pk do ContentType do model
+#   {"shared_context": <pop id>}  pk da tag do contexto compartilhado do POP
+#
+# O plano volta pelas mãos do usuário: só é aceito com a assinatura intacta,
+# com os models, campos e marcadores abaixo, e cada objeto passa pelo
+# full_clean() antes de ser gravado. Os únicos devices alterados são os que
+# recebem interfaces do próprio plano.
+
+PLAN_VERSION = 1
+
+# Model -> campos aceitos em creates, na ordem em que os models são gravados
+CREATE_FIELDS = {
+    "ipam.vlan": ("name", "vid", "site_id", "group_id"),
+    "dcim.device": (
+        "name", "site_id", "device_type_id", "device_role_id", "status", "airflow",
+        "local_context_data", "custom_field_data", "config_template_id",
+    ),
+    "dcim.interface": ("device_id", "name", "type", "enabled", "mode", "untagged_vlan_id"),
+    "ipam.ipaddress": ("address", "assigned_object_type_id", "assigned_object_id"),
+    "extras.taggeditem": ("tag_id", "content_type_id", "object_id"),
+}
+UPDATE_FIELDS = {
+    "dcim.device": ("serial", "primary_ip4_id", "primary_ip6_id"),
+}
+# FKs com pk literal: conferidas no banco antes da aplicação
+FOREIGN_KEYS = {
+    "ipam.vlan": {"site_id": "dcim.site", "group_id": "ipam.vlangroup"},
+    "dcim.device": {
+        "site_id": "dcim.site", "device_type_id": "dcim.devicetype",
+        "device_role_id": "dcim.devicerole", "config_template_id": "extras.configtemplate",
+    },
+    "dcim.interface": {"device_id": "dcim.device", "untagged_vlan_id": "ipam.vlan"},
+    "extras.taggeditem": {"tag_id": "extras.tag"},
+}
+# (model, campo) -> marcadores aceitos: ref com o model do objeto apontado,
+# content_type com os models possíveis. Campos fora de FOREIGN_KEYS só
+# aceitam marcador: o plano não liga nada a objetos que ele não criou
+MARKER_FIELDS = {
+    ("dcim.interface", "untagged_vlan_id"): {"ref": "ipam.vlan"},
+    ("ipam.ipaddress", "assigned_object_type_id"): {"content_type": ("dcim.interface",)},
+    ("ipam.ipaddress", "assigned_object_id"): {"ref": "dcim.interface"},
+    ("extras.taggeditem", "tag_id"): {"shared_context": None},
+    ("extras.taggeditem", "content_type_id"): {"content_type": ("dcim.device",)},
+    ("extras.taggeditem", "object_id"): {"ref": "dcim.device"},
+    ("dcim.device", "primary_ip4_id"): {"ref": "ipam.ipaddress"},
+    ("dcim.device", "primary_ip6_id"): {"ref": "ipam.ipaddress"},
+}
+# Campos JSON: gravados como estão, nunca resolvidos
+JSON_FIELDS = {("dcim.device", "local_context_data"), ("dcim.device", "custom_field_data")}
+# Únicos destinos de webhook aceitos em um plano
+WEBHOOK_URLS = (WEBHOOK_URL,)
+SIGNING_SALT = "change_plan"
+# Models cujos objetos disparam post_save após o bulk_create (change log,
+# bitmap de VLANs, cache de referências)
+SIGNAL_MODELS = ("ipam.vlan", "dcim.device", "dcim.interface", "ipam.ipaddress")
+
+# Templates de componentes na mesma ordem usada pelo Device.save() do NetBox
+# (rear ports antes dos front ports, inventory items por último pois são MPTT)
+COMPONENT_TEMPLATES = (
+    'consoleporttemplates',
+    'consoleserverporttemplates',
+    'powerporttemplates',
+    'poweroutlettemplates',
+    'interfacetemplates',
+    'rearporttemplates',
+    'frontporttemplates',
+    'modulebaytemplates',
+    'devicebaytemplates',
+    'inventoryitemtemplates',
+)
+
+
+class StalePlanError(Exception):
+    pass
+
+
+def content_type_ref(model):
+    return {"content_type": model._meta.label_lower}
+
+
+class ChangePlan:
+
+    def __init__(self, script):
+        self.data = {
+            "version": PLAN_VERSION,
+            "script": script if isinstance(script, str) else script.__class__.__name__,
+            "created_at": timezone.now().isoformat(),
+            "creates": [],
+            "updates": [],
+            "shared_contexts": [],
+            "conflicts": [],
+        }
+        self._updates = {}
+        self._counters = {}
+
+    def create(self, model, fields, label=None, **extra):
+        # Devolve o marcador do objeto, para ser usado em outros campos
+        label_lower = model._meta.label_lower
+        self._counters[label_lower] = self._counters.get(label_lower, 0) + 1
+        ref = f"{label_lower}:{self._counters[label_lower]}"
+        self.data["creates"].append({"ref": ref, "model": label_lower, "fields": fields, "label": label, **extra})
+        return {"ref": ref}
+
+    def update(self, obj, fields, label=None):
+        # Uma entrada por objeto, com os campos acumulados e o valor que cada
+        # um tinha na simulação
+        key = (obj._meta.label_lower, obj.pk)
+        if key not in self._updates:
+            self._updates[key] = {"model": key[0], "pk": obj.pk, "fields": {}, "expected": {}, "label": label}
+            self.data["updates"].append(self._updates[key])
+        self._updates[key]["fields"].update(fields)
+        for field in fields:
+            self._updates[key]["expected"].setdefault(field, getattr(obj, field))
+
+    def conflict(self, model, message, **key):
+        self.data["conflicts"].append({"model": model._meta.label_lower, "message": message, "key": key})
+
+    def shared_context(self, pop_device, data):
+        if not any(entry["pop_device"] == pop_device.pk for entry in self.data["shared_contexts"]):
+            self.data["shared_contexts"].append({"pop_device": pop_device.pk, "data": data})
+        return {"shared_context": pop_device.pk}
+
+    def tag(self, ref, tag):
+        # ref: marcador de um device criado pelo plano
+        return self.create(TaggedItem, {
+            "tag_id": tag if isinstance(tag, dict) else tag.pk,
+            "content_type_id": content_type_ref(Device),
+            "object_id": ref,
+        })
+
+    def add_device(self, device, tag=None, pop_device=None, shared=False, local_context=None, webhook=None):
+        # device: Device não salvo montado pelo script de criação
+        ref = self.create(Device, {
+            "name": device.name,
+            "site_id": device.site_id,
+            "device_type_id": device.device_type_id,
+            "device_role_id": device.device_role_id,
+            "status": device.status,
+            "airflow": device.airflow or (device.device_type.airflow if device.device_type_id else None),
+            "local_context_data": device.local_context_data,
+            "custom_field_data": device.custom_field_data,
+            "config_template_id": device.config_template_id,
+        }, label=f"Device '{device.name}' at site '{device.site.name}'", **({"webhook": webhook} if webhook else {}))
+        if tag:
+            self.tag(ref, tag)
+        if shared and pop_device:
+            self.tag(ref, self.shared_context(pop_device, local_context))
+        return ref
+
+    def summary(self):
+        return summarize(self.data)
+
+    def to_json(self):
+        # Assinado: o ApplyChangePlanScript recusa planos editados
+        data = json.loads(json.dumps(self.data, default=str))
+        data["signature"] = sign_plan(data)
+        return json.dumps(data, indent=2)
+
+
+def summarize(plan):
+    creates = {}
+    for entry in plan["creates"]:
+        creates[entry["model"]] = creates.get(entry["model"], 0) + 1
+    return {
+        "creates": creates,
+        "updates": len(plan["updates"]),
+        "shared_contexts": len(plan["shared_contexts"]),
+        "conflicts": len(plan["conflicts"]),
+    }
+
+
+def sign_plan(plan):
+    canonical = json.dumps(
+        {key: value for key, value in plan.items() if key != "signature"},
+        sort_keys=True, separators=(",", ":"), default=str
+    )
+    return signing.Signer(salt=SIGNING_SALT).signature(canonical)
+
+
+def load_plan(text):
+    # Confere a assinatura e valida a estrutura antes de qualquer escrita
+    try:
+        plan = json.loads(text)
+    except ValueError as e:
+        raise ValueError(f"Invalid plan JSON: {e}")
+    if not isinstance(plan, dict):
+        raise ValueError("Invalid plan JSON: expected an object")
+    signature = plan.pop("signature", None)
+    if not isinstance(signature, str) or not constant_time_compare(signature, sign_plan(plan)):
+        raise ValueError("Invalid plan signature: only unedited plans from a dry run on this NetBox can be applied")
+    return validate_plan(plan)
+
+
+def validate_plan(plan):
+    # Models, campos, tipos e marcadores; ValueError no primeiro problema
+    if not isinstance(plan, dict) or plan.get("version") != PLAN_VERSION:
+        raise ValueError(f"Unsupported plan version (expected {PLAN_VERSION})")
+    for section in ("creates", "updates", "shared_contexts", "conflicts"):
+        plan.setdefault(section, [])
+        if not isinstance(plan[section], list) or not all(isinstance(entry, dict) for entry in plan[section]):
+            raise ValueError(f"Invalid plan section '{section}'")
+
+    shared = set()
+    for entry in plan["shared_contexts"]:
+        if not isinstance(entry.get("pop_device"), int) or not isinstance(entry.get("data"), dict) or entry["pop_device"] in shared:
+            raise ValueError(f"Invalid shared context entry for POP {entry.get('pop_device')}")
+        shared.add(entry["pop_device"])
+
+    refs = {}
+    for entry in plan["creates"]:
+        if entry.get("model") not in CREATE_FIELDS:
+            raise ValueError(f"Model '{entry.get('model')}' cannot be created by a plan")
+        if not isinstance(entry.get("fields"), dict) or not isinstance(entry.get("ref"), str) or entry["ref"] in refs:
+            raise ValueError(f"Invalid create entry '{entry.get('ref')}'")
+        refs[entry["ref"]] = entry
+    for entry in plan["creates"]:
+        _check_fields(entry, CREATE_FIELDS[entry["model"]], refs, shared)
+        webhook = entry.get("webhook")
+        if webhook is not None and not (
+            entry["model"] == "dcim.device" and isinstance(webhook, dict)
+            and webhook.get("url") in WEBHOOK_URLS and isinstance(webhook.get("payload"), dict)
+        ):
+            raise ValueError(f"Webhook of '{entry['ref']}' is not allowed")
+
+    # Só devices que recebem interfaces do próprio plano podem ser alterados
+    touched = {entry["fields"].get("device_id") for entry in plan["creates"] if entry["model"] == "dcim.interface"}
+    updated = set()
+    for entry in plan["updates"]:
+        if entry.get("model") not in UPDATE_FIELDS or not isinstance(entry.get("fields"), dict):
+            raise ValueError(f"Model '{entry.get('model')}' cannot be updated by a plan")
+        key = (entry["model"], entry.get("pk"))
+        if not isinstance(entry.get("pk"), int) or entry["pk"] not in touched or key in updated:
+            raise ValueError(f"{entry['model']} {entry.get('pk')} gets no interface from the plan and cannot be updated")
+        updated.add(key)
+        if not isinstance(entry.get("expected"), dict) or set(entry["expected"]) != set(entry["fields"]):
+            raise ValueError(f"Update of {entry['model']} {entry['pk']} has no expected values")
+        _check_fields(entry, UPDATE_FIELDS[entry["model"]], refs, shared)
+        for field, value in entry["fields"].items():
+            if field in ("primary_ip4_id", "primary_ip6_id") and _ip_device(refs, value) != entry["pk"]:
+                raise ValueError(f"IP '{value['ref']}' is not assigned to an interface of device {entry['pk']}")
+    return plan
+
+
+def _check_fields(entry, allowed, refs, shared):
+    model = entry["model"]
+    unknown = set(entry["fields"]) - set(allowed)
+    if unknown:
+        raise ValueError(f"Fields not allowed for {model}: {', '.join(sorted(unknown))}")
+    foreign_keys = FOREIGN_KEYS.get(model, {})
+    for field, value in entry["fields"].items():
+        key = (model, field)
+        if key in JSON_FIELDS:
+            continue
+        if isinstance(value, dict):
+            markers = MARKER_FIELDS.get(key, {})
+            if len(value) != 1 or next(iter(value)) not in markers:
+                raise ValueError(f"Invalid value for {model}.{field}")
+            kind, target = next(iter(value.items()))
+            if kind == "ref" and (not isinstance(target, str) or refs.get(target, {}).get("model") != markers["ref"]):
+                raise ValueError(f"Reference '{target}' in {model}.{field} does not point to a {markers['ref']} created by the plan")
+            if kind == "content_type" and target not in markers["content_type"]:
+                raise ValueError(f"Content type '{target}' is not allowed in {model}.{field}")
+            if kind == "shared_context" and (not isinstance(target, int) or target not in shared):
+                raise ValueError(f"Shared context of POP {target} is not part of the plan")
+        elif key in MARKER_FIELDS and field not in foreign_keys:
+            raise ValueError(f"{model}.{field} must point to an object created by the plan")
+        elif field in foreign_keys and not (value is None or (isinstance(value, int) and not isinstance(value, bool))):
+            raise ValueError(f"Invalid primary key for {model}.{field}: {value!r}")
+        elif isinstance(value, list):
+            raise ValueError(f"Invalid value for {model}.{field}")
+
+
+def _ip_device(refs, value):
+    # Device da interface a que um IP do plano é atribuído
+    interface = refs[value["ref"]]["fields"].get("assigned_object_id")
+    if not isinstance(interface, dict):
+        return None
+    return refs[interface["ref"]]["fields"].get("device_id")
+
+
+def _host(address):
+    try:
+        return str(IPNetwork(str(address)).ip)
+    except (AddrFormatError, ValueError):
+        return None
+
+
+def check_plan(plan):
+    # O estado pode ter mudado desde a simulação: poucas queries em lote
+    # confirmam que as chaves naturais dos objetos a criar continuam livres,
+    # que os objetos referenciados ainda existem e que os devices e contextos
+    # de POP alterados pelo plano continuam como na simulação
+    by_model = {}
+    for entry in plan["creates"]:
+        by_model.setdefault(entry["model"], []).append(entry["fields"])
+
+    conflicts = _missing_references(plan)
+    devices = [fields for fields in by_model.get("dcim.device", []) if isinstance(fields.get("site_id"), int)]
+    if devices:
+        existing = set(Device.objects.filter(
+            name__in={fields["name"] for fields in devices}
+        ).values_list('name', 'site_id'))
+        conflicts += [
+            f"Device '{fields['name']}' already exists in site {fields['site_id']}"
+            for fields in devices if (fields["name"], fields["site_id"]) in existing
+        ]
+    interfaces = [fields for fields in by_model.get("dcim.interface", []) if isinstance(fields.get("device_id"), int)]
+    if interfaces:
+        existing = set(Interface.objects.filter(
+            device__in={fields["device_id"] for fields in interfaces},
+            name__in={fields["name"] for fields in interfaces}
+        ).values_list('device_id', 'name'))
+        conflicts += [
+            f"Interface '{fields['name']}' already exists on device {fields['device_id']}"
+            for fields in interfaces if (fields["device_id"], fields["name"]) in existing
+        ]
+    vlans = [fields for fields in by_model.get("ipam.vlan", []) if fields.get("site_id")]
+    if vlans:
+        existing = set(VLAN.objects.filter(
+            site__in={fields["site_id"] for fields in vlans},
+            vid__in={fields["vid"] for fields in vlans}
+        ).values_list('site_id', 'vid'))
+        conflicts += [
+            f"VLAN {fields['vid']} already exists in site {fields['site_id']}"
+            for fields in vlans if (fields["site_id"], fields["vid"]) in existing
+        ]
+
+    # IPs: os pares de túnel da simulação não foram reservados
+    hosts = set()
+    for fields in by_model.get("ipam.ipaddress", []):
+        host = _host(fields.get("address"))
+        if host in hosts:
+            conflicts.append(f"IP address {host} is planned more than once")
+        if host:
+            hosts.add(host)
+    if hosts:
+        query = Q()
+        for host in hosts:
+            query |= Q(address__net_host=host)
+        conflicts += [
+            f"IP address {address} already exists"
+            for address in IPAddress.objects.filter(query, vrf__isnull=True).values_list('address', flat=True)
+        ]
+
+    conflicts += _changed_objects(plan["updates"])
+
+    if plan["shared_contexts"]:
+        pop_devices = Device.objects.select_related('device_role').filter(
+            pk__in=[entry["pop_device"] for entry in plan["shared_contexts"]]
+        )
+        contexts = fetch_pop_contexts(pop_devices)
+        conflicts += [
+            f"Context of POP {entry['pop_device']} changed since the dry run"
+            for entry in plan["shared_contexts"]
+            if entry["pop_device"] in contexts and contexts[entry["pop_device"]] != entry["data"]
+        ]
+    return conflicts
+
+
+def _missing_references(plan):
+    # Uma query por model para os pks literais do plano
+    wanted = {}
+    for entry in plan["creates"]:
+        for field, label_lower in FOREIGN_KEYS.get(entry["model"], {}).items():
+            value = entry["fields"].get(field)
+            if isinstance(value, int):
+                wanted.setdefault(label_lower, set()).add(value)
+    for entry in plan["updates"]:
+        wanted.setdefault(entry["model"], set()).add(entry["pk"])
+    for entry in plan["shared_contexts"]:
+        wanted.setdefault("dcim.device", set()).add(entry["pop_device"])
+
+    conflicts = []
+    for label_lower, pks in wanted.items():
+        found = set(apps.get_model(label_lower).objects.filter(pk__in=pks).values_list('pk', flat=True))
+        conflicts += [f"{label_lower} {pk} no longer exists" for pk in sorted(pks - found)]
+    return conflicts
+
+
+def _changed_objects(updates):
+    # Os campos alterados precisam ter o valor visto pela simulação
+    by_model = {}
+    for entry in updates:
+        by_model.setdefault(entry["model"], []).append(entry)
+
+    conflicts = []
+    for label_lower, entries in by_model.items():
+        fields = sorted({field for entry in entries for field in entry["expected"]})
+        current = {
+            row["pk"]: row
+            for row in apps.get_model(label_lower).objects.filter(
+                pk__in=[entry["pk"] for entry in entries]
+            ).values('pk', *fields)
+        }
+        for entry in entries:
+            row = current.get(entry["pk"])
+            changed = [field for field, value in entry["expected"].items() if row and row[field] != value]
+            if changed:
+                conflicts.append(f"{entry.get('label') or entry['pk']} changed since the dry run ({', '.join(changed)})")
+    return conflicts
+
+
+def _lock_plan(plan):
+    # Os mesmos locks das alocações, até o fim da transação: a linha do site
+    # das VLANs (vlan_allocator) e os prefixos que contêm os IPs (prefix_allocator)
+    site_ids = {
+        entry["fields"].get("site_id") for entry in plan["creates"]
+        if entry["model"] == "ipam.vlan" and isinstance(entry["fields"].get("site_id"), int)
+    }
+    if site_ids:
+        list(Site.objects.select_for_update().filter(pk__in=site_ids).order_by('pk').values_list('pk', flat=True))
+    query = Q()
+    for entry in plan["creates"]:
+        host = _host(entry["fields"].get("address")) if entry["model"] == "ipam.ipaddress" else None
+        if host:
+            query |= Q(prefix__net_contains_or_equals=host)
+    if query:
+        list(Prefix.objects.select_for_update().filter(query, vrf__isnull=True).order_by('pk').values_list('pk', flat=True))
+
+
+def _clean(instance, entry):
+    try:
+        instance.full_clean(validate_unique=False)
+    except ValidationError as e:
+        raise ValueError(f"{entry.get('label') or entry.get('ref') or entry.get('pk')}: {'; '.join(e.messages)}")
+
+
+def instantiate_components(devices):
+    # Equivalente em lote ao Device._instantiate_components(): uma query por
+    # tipo de template e por device type, e um bulk_create por model
+    templates = {}
+    for device in devices:
+        device_type = device.device_type
+        if device_type.pk not in templates:
+            templates[device_type.pk] = [
+                list(getattr(device_type, relation).all()) for relation in COMPONENT_TEMPLATES
+            ]
+
+    for index, relation in enumerate(COMPONENT_TEMPLATES):
+        components = []
+        for device in devices:
+            for template in templates[device.device_type.pk][index]:
+                components.append(template.instantiate(device=device))
+        if not components:
+            continue
+        model = components[0]._meta.model
+        if relation == 'inventoryitemtemplates':
+            for component in components:
+                component.save()
+            continue
+        model.objects.bulk_create(components)
+        for component in components:
+            post_save.send(sender=model, instance=component, created=True, raw=False, using='default', update_fields=None)
+
+
+def apply_change_plan(plan, webhook_callback=None):
+    # Aplica o plano como está, em uma transação: um bulk_create por model e
+    # um bulk_update por model alterado, com o full_clean() de cada objeto.
+    # Devolve {ref: objeto criado}.
+    validate_plan(plan)
+    objects = {}
+    with transaction.atomic():
+        _lock_plan(plan)
+        conflicts = check_plan(plan)
+        if conflicts:
+            raise StalePlanError("; ".join(conflicts))
+
+        shared_tags = {}
+        if plan["shared_contexts"]:
+            pop_devices = Device.objects.select_related('device_role').in_bulk(
+                [entry["pop_device"] for entry in plan["shared_contexts"]]
+            )
+            for entry in plan["shared_contexts"]:
+                # check_plan já confirmou que data é o contexto atual do POP
+                _, tag = sync_shared_context(pop_devices[entry["pop_device"]], entry["data"])
+                shared_tags[entry["pop_device"]] = tag.pk
+
+        def resolve(label_lower, field, value):
+            # Só campos de marcador são resolvidos; JSON fica como está
+            if (label_lower, field) not in MARKER_FIELDS or not isinstance(value, dict):
+                return value
+            kind, target = next(iter(value.items()))
+            if kind == "ref":
+                return objects[target].pk
+            if kind == "content_type":
+                return reference_cache.content_type(apps.get_model(target)).pk
+            return shared_tags[target]
+
+        created = []
+        for label_lower in CREATE_FIELDS:
+            entries = [entry for entry in plan["creates"] if entry["model"] == label_lower]
+            if not entries:
+                continue
+            model = apps.get_model(label_lower)
+            instances = [
+                model(**{field: resolve(label_lower, field, value) for field, value in entry["fields"].items()})
+                for entry in entries
+            ]
+            for entry, instance in zip(entries, instances):
+                _clean(instance, entry)
+            model.objects.bulk_create(instances)
+            for entry, instance in zip(entries, instances):
+                objects[entry["ref"]] = instance
+
+            if label_lower == "dcim.device":
+                for device in instances:
+                    reference_cache.attach(device, 'device_type')
+                instantiate_components(instances)
+            if label_lower in SIGNAL_MODELS:
+                created.append((model, instances))
+
+        # Os sinais só depois de todos os creates: o change log dos devices
+        # já vê as tags e os componentes gravados
+        for model, instances in created:
+            for instance in instances:
+                post_save.send(sender=model, instance=instance, created=True, raw=False, using='default', update_fields=None)
+
+        for label_lower in UPDATE_FIELDS:
+            entries = [entry for entry in plan["updates"] if entry["model"] == label_lower]
+            if not entries:
+                continue
+            model = apps.get_model(label_lower)
+            instances = model.objects.in_bulk([entry["pk"] for entry in entries])
+            now = timezone.now()
+            fields = {'last_updated'}
+            for entry in entries:
+                instance = instances[entry["pk"]]
+                # Estado anterior para o change log
+                instance.snapshot()
+                for field, value in entry["fields"].items():
+                    setattr(instance, field, resolve(label_lower, field, value))
+                instance.last_updated = now
+                fields.update(entry["fields"])
+                _clean(instance, entry)
+            model.objects.bulk_update(list(instances.values()), sorted(fields))
+            for instance in instances.values():
+                post_save.send(sender=model, instance=instance, created=False, raw=False, using='default', update_fields=frozenset(fields))
+
+        # Webhooks dos devices criados, no outbox da mesma transação
+        outboxes = {}
+        for entry in plan["creates"]:
+            webhook = entry.get("webhook")
+            if not webhook:
+                continue
+            if webhook["url"] not in outboxes:
+                outboxes[webhook["url"]] = WebhookOutbox(webhook["url"], callback=webhook_callback)
+            outboxes[webhook["url"]].record(objects[entry["ref"]], webhook["payload"])
+
+    return objects
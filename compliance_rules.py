@@ -0,0 +1,200 @@
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from dcim.models import Device, Site
+from config_render import parse_connected_to
+
+# Motor de regras de conformidade. As regras são declaradas uma vez com
+# @rule e avaliadas todas juntas em uma única passada pelos devices: os ids
+# são lidos em streaming, cada bloco é carregado com interfaces e IPs em
+# prefetch e convertido em dados simples, e os blocos são avaliados em um
+# pool de processos. Cada regra recebe o registro do device e o contexto
+# compartilhado e devolve uma mensagem de falha ou None.
+
+# Regex pattern to match the naming convention, compiled once per worker
+HOSTNAME_PATTERN = re.compile(r"[A-Za-z0-9]{3,4}\.[0-9]{3,6}\.[A-Z][0-9]{3}\.PE[0-9]{1,2}")
+
+# Nomes criados pelo CreateInterfaceScript (<prefixo>-<site>) e pelo
+# CreateEoIPInterfaceScript (EOIP-<device>)
+SOLUTION_INTERFACE_PATTERN = re.compile(r"^(EoIP|GRE|BRIDGE|L2TP)-(.+?)(\.A001)?$")
+EOIP_INTERFACE_PREFIX = "EOIP-"
+
+# Devices carregados por bloco (número fixo de queries por bloco)
+CHUNK_SIZE = 500
+
+RULES = OrderedDict()
+
+
+def rule(name, description):
+    def register(function):
+        function.description = description
+        RULES[name] = function
+        return function
+    return register
+
+
+@rule("hostname", "Hostname follows the naming convention (e.g. ABC.5555.A555.PE05)")
+def check_hostname(device, context):
+    if not device["name"] or not HOSTNAME_PATTERN.match(device["name"]):
+        return "Hostname does not conform to standard!"
+
+
+@rule("interface_naming", "Solution interfaces are named <EoIP|GRE|BRIDGE|L2TP>-<site> or EOIP-<device>")
+def check_interface_naming(device, context):
+    invalid = []
+    for interface in device["interfaces"]:
+        name = interface["name"]
+        if name.startswith(EOIP_INTERFACE_PREFIX):
+            if name != f"{EOIP_INTERFACE_PREFIX}{device['name']}":
+                invalid.append(name)
+            continue
+        match = SOLUTION_INTERFACE_PATTERN.match(name)
+        if not match:
+            continue
+        site, suffix = match.group(2), match.group(3)
+        # L2TP leva o sufixo .A001; nos POPs o site é o do CPE do outro lado
+        if (match.group(1) == "L2TP") != bool(suffix) or site not in context["sites"]:
+            invalid.append(name)
+    if invalid:
+        return f"Interfaces do not follow the solution naming: {', '.join(invalid)}"
+
+
+@rule("serial", "Device has a serial number")
+def check_serial(device, context):
+    if not device["serial"]:
+        return "Serial number is missing"
+
+
+@rule("connected_to", "The ConnectedTo custom field points to another existing device")
+def check_connected_to(device, context):
+    if not device["connected_to_raw"]:
+        return None
+    if device["connected_to"] is None:
+        return f"ConnectedTo has an invalid value: {device['connected_to_raw']!r}"
+    if device["connected_to"] == device["id"]:
+        return "ConnectedTo points to the device itself"
+    if not device["connected_to_exists"]:
+        return f"ConnectedTo points to device {device['connected_to']} which does not exist"
+
+
+@rule("primary_ip", "Device has a primary IP assigned to one of its own interfaces")
+def check_primary_ip(device, context):
+    primary_ips = [ip for ip in (device["primary_ip4"], device["primary_ip6"]) if ip]
+    if not primary_ips:
+        return "No primary IP"
+    assigned = {ip for interface in device["interfaces"] for ip in interface["ip_ids"]}
+    for ip_id, address in primary_ips:
+        if ip_id not in assigned:
+            return f"Primary IP {address} is not assigned to an interface of this device"
+
+
+def load_records(device_ids):
+    # Um bloco de devices como dados simples: 3 queries de devices,
+    # interfaces e IPs, mais 1 para validar os ConnectedTo do bloco
+    devices = list(
+        Device.objects.filter(pk__in=device_ids)
+        .select_related('primary_ip4', 'primary_ip6')
+        .prefetch_related('interfaces__ip_addresses')
+        .order_by('pk')
+    )
+    connected = {device.pk: parse_connected_to(device.custom_field_data) for device in devices}
+    existing = set(
+        Device.objects.filter(pk__in=set(connected.values()) - {None}).values_list('pk', flat=True)
+    )
+
+    records = []
+    for device in devices:
+        data = device.custom_field_data or {}
+        records.append({
+            "id": device.pk,
+            "name": device.name,
+            "serial": device.serial,
+            "connected_to_raw": data.get("Connectedto") or data.get("ConnectedTo"),
+            "connected_to": connected[device.pk],
+            "connected_to_exists": connected[device.pk] in existing,
+            "primary_ip4": (device.primary_ip4_id, str(device.primary_ip4)) if device.primary_ip4_id else None,
+            "primary_ip6": (device.primary_ip6_id, str(device.primary_ip6)) if device.primary_ip6_id else None,
+            "interfaces": [
+                {
+                    "name": interface.name,
+                    "ip_ids": [ip.pk for ip in interface.ip_addresses.all()],
+                }
+                for interface in device.interfaces.all()
+            ],
+        })
+    return records
+
+
+def evaluate_batch(records, rule_names, context):
+    # Executado nos processos do pool: recebe apenas dados simples
+    failures = []
+    timings = {name: 0.0 for name in rule_names}
+    for record in records:
+        for name in rule_names:
+            started = time.perf_counter()
+            try:
+                message = RULES[name](record, context)
+            except Exception as e:
+                message = f"Rule raised {type(e).__name__}: {e}"
+            timings[name] += time.perf_counter() - started
+            if message:
+                failures.append((record["id"], record["name"], name, message))
+    return len(records), failures, timings
+
+
+def run_rules(queryset, on_failure, rule_names=None, workers=4, chunk_size=CHUNK_SIZE):
+    # Chama on_failure(device_id, nome, regra, mensagem) para cada falha e
+    # devolve o resumo: devices avaliados, falhas e tempo por regra
+    rule_names = list(rule_names or RULES)
+    context = {"sites": set(Site.objects.values_list('name', flat=True))}
+    summary = {
+        "devices": 0,
+        "failures": {name: 0 for name in rule_names},
+        "seconds": {name: 0.0 for name in rule_names},
+        "load_seconds": 0.0,
+    }
+
+    def collect(result):
+        count, failures, timings = result
+        summary["devices"] += count
+        for name, seconds in timings.items():
+            summary["seconds"][name] += seconds
+        for failure in failures:
+            summary["failures"][failure[2]] += 1
+            on_failure(*failure)
+
+    def chunks():
+        ids = []
+        for pk in queryset.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=chunk_size):
+            ids.append(pk)
+            if len(ids) == chunk_size:
+                yield ids
+                ids = []
+        if ids:
+            yield ids
+
+    def load(ids):
+        started = time.perf_counter()
+        records = load_records(ids)
+        summary["load_seconds"] += time.perf_counter() - started
+        return records
+
+    if workers <= 1:
+        for ids in chunks():
+            collect(evaluate_batch(load(ids), rule_names, context))
+        return summary
+
+    # No máximo 2 blocos por worker em voo: memória constante em qualquer tamanho
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for ids in chunks():
+            pending.add(executor.submit(evaluate_batch, load(ids), rule_names, context))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future.result())
+        for future in pending:
+            collect(future.result())
+    return summary
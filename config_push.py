@@ -0,0 +1,296 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import librouteros
+except ImportError:
+    librouteros = None
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+# Envio dos configs renderizados para os MikroTik, sem dependência do Django
+# para poder ser testado contra um RouterOS falso local. Cada job é um dict
+# com "device_id", "name", "host", "pop" e "text"; o resultado volta com
+# "status" ("ok" ou "failed"), "seconds" e "error".
+#
+# Transportes:
+#   - api: RouterOS API (librouteros). O config vira um /system script
+#     temporário que é executado e removido. O run do RouterOS não devolve
+#     erro quando o script falha, então o config roda dentro de um :do com
+#     on-error que grava o resultado em uma variável global, lida em seguida.
+#   - ssh: SSH/SFTP (paramiko). O config é enviado como arquivo .rsc e
+#     aplicado com /import.
+# As duas bibliotecas são opcionais; o transporte só exige a sua.
+#
+# Um config não é idempotente: só se tenta de novo quando a falha aconteceu
+# antes de qualquer parte dele ser executada no device (NotSentError).
+
+SCRIPT_NAME = "netbox-config-push"
+RESULT_GLOBAL = "netboxConfigPush"
+# Host keys desconhecidas são recusadas a menos que isto esteja habilitado
+ACCEPT_UNKNOWN_HOSTS = os.environ.get("NETBOX_PUSH_ACCEPT_UNKNOWN_HOSTS", "").lower() in ("1", "true", "yes")
+
+
+class TransportError(Exception):
+    pass
+
+
+class NotSentError(TransportError):
+    # Conexão ou envio falhou antes de o config começar a ser aplicado
+    pass
+
+
+def wrap_script(text):
+    # Resultado do config em RESULT_GLOBAL: "ok", "failed" ou, se o script
+    # foi interrompido, "running"
+    return (
+        f':global {RESULT_GLOBAL} "running"\n'
+        ':do {\n'
+        f'{text}\n'
+        f':set {RESULT_GLOBAL} "ok"\n'
+        f'}} on-error={{ :set {RESULT_GLOBAL} "failed" }}\n'
+    )
+
+
+class RouterOSAPITransport:
+    default_port = 8728
+
+    def __init__(self, host, username, password, port=None, timeout=10):
+        if librouteros is None:
+            raise TransportError("librouteros is not installed")
+        try:
+            self.api = librouteros.connect(
+                host=host, username=username, password=password, port=port or self.default_port, timeout=timeout
+            )
+        except Exception as e:
+            raise NotSentError(f"{type(e).__name__}: {e}") from e
+
+    def apply(self, text):
+        try:
+            scripts = self.api.path('system', 'script')
+            # Sobra de um envio interrompido
+            for item in tuple(scripts):
+                if item.get('name') == SCRIPT_NAME:
+                    scripts.remove(item['.id'])
+            self._result()
+            script_id = scripts.add(name=SCRIPT_NAME, source=wrap_script(text))
+        except Exception as e:
+            raise NotSentError(f"{type(e).__name__}: {e}") from e
+        try:
+            tuple(scripts('run', **{'.id': script_id}))
+            result = self._result()
+        finally:
+            scripts.remove(script_id)
+        if result != "ok":
+            raise TransportError(
+                "config script failed on the device" if result == "failed" else "config script did not finish"
+            )
+
+    def _result(self):
+        # Lê e remove a variável global com o resultado do último script
+        environment = self.api.path('system', 'script', 'environment')
+        result = None
+        for item in tuple(environment):
+            if item.get('name') == RESULT_GLOBAL:
+                result = item.get('value')
+                environment.remove(item['.id'])
+        return result
+
+    def close(self):
+        self.api.close()
+
+
+class SSHTransport:
+    default_port = 22
+
+    def __init__(self, host, username, password, port=None, timeout=10):
+        if paramiko is None:
+            raise TransportError("paramiko is not installed")
+        self.timeout = timeout
+        self.client = paramiko.SSHClient()
+        self.client.load_system_host_keys()
+        self.client.set_missing_host_key_policy(
+            paramiko.AutoAddPolicy() if ACCEPT_UNKNOWN_HOSTS else paramiko.RejectPolicy()
+        )
+        try:
+            self.client.connect(
+                host, port=port or self.default_port, username=username, password=password,
+                timeout=timeout, banner_timeout=timeout, auth_timeout=timeout, look_for_keys=False, allow_agent=False
+            )
+        except Exception as e:
+            raise NotSentError(f"{type(e).__name__}: {e}") from e
+
+    def run(self, command):
+        _, stdout, stderr = self.client.exec_command(command, timeout=self.timeout)
+        output = stdout.read().decode(errors='replace') + stderr.read().decode(errors='replace')
+        stdout.channel.recv_exit_status()
+        return output
+
+    def apply(self, text):
+        filename = f"{SCRIPT_NAME}.rsc"
+        try:
+            sftp = self.client.open_sftp()
+            try:
+                with sftp.open(filename, 'w') as remote_file:
+                    remote_file.write(text)
+            finally:
+                sftp.close()
+        except Exception as e:
+            raise NotSentError(f"{type(e).__name__}: {e}") from e
+        try:
+            output = self.run(f"/import file-name={filename}")
+        finally:
+            self.run(f"/file remove {filename}")
+        if "successfully" not in output:
+            raise TransportError(" ".join(output.split()) or "import failed")
+
+    def close(self):
+        self.client.close()
+
+
+TRANSPORTS = {
+    "api": RouterOSAPITransport,
+    "ssh": SSHTransport,
+}
+
+
+class PopRateLimit:
+    # Limite por POP: no máximo `concurrency` envios simultâneos e um
+    # intervalo mínimo entre inícios
+    def __init__(self, concurrency=2, interval=0.0):
+        self._semaphore = threading.BoundedSemaphore(concurrency)
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+
+    def __enter__(self):
+        self._semaphore.acquire()
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_start - now
+            self._next_start = max(now, self._next_start) + self._interval
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *exc):
+        self._semaphore.release()
+
+
+class ConfigPusher:
+
+    def __init__(self, transport="api", username=None, password=None, port=None, timeout=30,
+                 workers=8, pop_concurrency=2, pop_interval=0.0, retries=1, max_sessions=64, connect=None):
+        # connect(host) -> transporte; permite apontar para um endpoint falso
+        self.connect = connect or (lambda host: TRANSPORTS[transport](host, username, password, port, timeout))
+        self.workers = workers
+        self.pop_concurrency = pop_concurrency
+        self.pop_interval = pop_interval
+        self.retries = retries
+        self.max_sessions = max_sessions
+        self._idle = OrderedDict()
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, pop):
+        with self._lock:
+            if pop not in self._limits:
+                self._limits[pop] = PopRateLimit(self.pop_concurrency, self.pop_interval)
+            return self._limits[pop]
+
+    def _acquire(self, host):
+        # Sessão persistente por device: reaproveitada entre envios e
+        # execuções do mesmo pusher, e usada por um único worker por vez
+        with self._lock:
+            session = self._idle.pop(host, None)
+        if session is not None:
+            return session
+        try:
+            return self.connect(host)
+        except NotSentError:
+            raise
+        except Exception as e:
+            raise NotSentError(f"{type(e).__name__}: {e}") from e
+
+    def _release(self, host, session, healthy=True):
+        if not healthy:
+            _close(session)
+            return
+        with self._lock:
+            self._idle[host] = session
+            evicted = []
+            while len(self._idle) > self.max_sessions:
+                evicted.append(self._idle.popitem(last=False)[1])
+        for session in evicted:
+            _close(session)
+
+    def _push(self, job):
+        started = time.monotonic()
+        result = {"device_id": job["device_id"], "name": job["name"], "status": "failed", "error": None, "attempts": 0}
+        with self._limit(job.get("pop")):
+            for attempt in range(self.retries + 1):
+                result["attempts"] = attempt + 1
+                session = None
+                try:
+                    session = self._acquire(job["host"])
+                    session.apply(job["text"])
+                except Exception as e:
+                    result["error"] = str(e) if isinstance(e, TransportError) else f"{type(e).__name__}: {e}"
+                    if session is not None:
+                        self._release(job["host"], session, healthy=False)
+                    if isinstance(e, NotSentError):
+                        # Nada foi aplicado: a próxima tentativa abre uma sessão nova
+                        continue
+                    # Parte do config pode ter sido aplicada: repetir não é seguro
+                    break
+                self._release(job["host"], session)
+                result["status"] = "ok"
+                result["error"] = None
+                break
+        result["seconds"] = round(time.monotonic() - started, 3)
+        return result
+
+    def push(self, jobs):
+        # Intercala os POPs para que um POP lento não ocupe todos os workers
+        by_pop = OrderedDict()
+        for job in jobs:
+            by_pop.setdefault(job.get("pop"), []).append(job)
+        ordered = []
+        while by_pop:
+            for pop in list(by_pop):
+                ordered.append(by_pop[pop].pop(0))
+                if not by_pop[pop]:
+                    del by_pop[pop]
+
+        started = time.monotonic()
+        results = []
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='config-push') as executor:
+            for future in as_completed([executor.submit(self._push, job) for job in ordered]):
+                results.append(future.result())
+        elapsed = time.monotonic() - started
+        return results, {
+            "devices": len(results),
+            "ok": sum(1 for result in results if result["status"] == "ok"),
+            "failed": sum(1 for result in results if result["status"] != "ok"),
+            "seconds": round(elapsed, 2),
+            "devices_per_minute": round(len(results) / elapsed * 60, 1) if elapsed else 0,
+        }
+
+    def close(self):
+        with self._lock:
+            sessions, self._idle = list(self._idle.values()), OrderedDict()
+        for session in sessions:
+            _close(session)
+
+
+def _close(session):
+    try:
+        session.close()
+    except Exception:
+        pass
@@ -0,0 +1,311 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.utils import timezone
+from jinja2 import Environment
+from dcim.models import Device, Interface
+from firewall_compiler import compile_file
+
+# Etapa de contexto para os templates de configuração: todo o acesso ao ORM
+# acontece aqui, em um número fixo de queries para qualquer quantidade de
+# devices, e o template recebe apenas dados simples (dicts, listas, strings).
+# Assim a renderização em si é só CPU e não dispara queries.
+
+INTERNET_TAG = "INTERNET"
+CONNECTED_TO_FIELDS = ("Connectedto", "ConnectedTo")
+TEMPLATE_CACHE_SIZE = 64
+
+# Devices por rodada de build_render_contexts (número fixo de queries por rodada)
+CONTEXT_CHUNK_SIZE = 500
+# Devices enviados por tarefa ao pool de processos
+RENDER_BATCH_SIZE = 50
+MANIFEST_NAME = "manifest.json"
+
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+def connected_to_id(device):
+    return parse_connected_to(device.custom_field_data)
+
+
+def parse_connected_to(data):
+    # O custom field pode guardar o id ou o objeto serializado
+    data = data or {}
+    for field in CONNECTED_TO_FIELDS:
+        value = data.get(field)
+        if isinstance(value, dict):
+            value = value.get("id")
+        if value:
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def first_ip(interface):
+    # Equivalente a interface.ip_addresses.first() usando o prefetch
+    ip_addresses = interface.ip_addresses.all()
+    return str(ip_addresses[0]) if ip_addresses else None
+
+
+def build_render_contexts(devices, templates=None):
+    # devices pode ser um queryset, uma lista de Devices ou de ids. Se
+    # templates for um dict, é preenchido com o ConfigTemplate efetivo de cada
+    # device (device, role ou platform) sem queries extras
+    device_ids = [getattr(device, 'pk', device) for device in devices]
+
+    devices = list(
+        Device.objects.filter(pk__in=device_ids)
+        .select_related('site', 'device_type', 'device_role', 'platform', 'config_template',
+                        'device_role__config_template', 'platform__config_template')
+        .annotate_config_context_data()
+    )
+
+    interfaces = {}
+    for interface in Interface.objects.filter(device__in=device_ids).prefetch_related('ip_addresses'):
+        interfaces.setdefault(interface.device_id, []).append(interface)
+
+    uplink_ids = {connected_to_id(device) for device in devices} - {None}
+    uplinks = {
+        uplink.pk: uplink
+        for uplink in Device.objects.filter(pk__in=uplink_ids).select_related('device_type', 'device_role')
+    }
+    internet_ips = {}
+    internet_interfaces = Interface.objects.filter(
+        device__in=uplink_ids, tags__name=INTERNET_TAG
+    ).distinct().prefetch_related('ip_addresses')
+    for interface in internet_interfaces:
+        ip = first_ip(interface)
+        if ip:
+            internet_ips.setdefault(interface.device_id, []).append(ip)
+
+    # Regras de firewall compiladas (em cache pelo hash do YAML)
+    try:
+        firewall = compile_file().commands
+    except OSError:
+        firewall = None
+
+    contexts = {}
+    for device in devices:
+        uplink = uplinks.get(connected_to_id(device))
+        context = device.get_config_context()
+        context.update({
+            "device": device_data(device),
+            "cpe": {
+                "name": device.name,
+                "interfaces": [
+                    {
+                        "name": interface.name,
+                        "enabled": interface.enabled,
+                        "ip": first_ip(interface),
+                    }
+                    for interface in interfaces.get(device.pk, [])
+                ],
+                "connected_to": {
+                    "name": uplink.name,
+                    "device_type": str(uplink.device_type),
+                    "role": str(uplink.device_role),
+                    "internet_ips": internet_ips.get(uplink.pk, []),
+                } if uplink else None,
+            },
+        })
+        if firewall is not None:
+            context.setdefault("firewall", firewall)
+        contexts[device.pk] = context
+        if templates is not None:
+            templates[device.pk] = device.get_config_template()
+
+    return contexts
+
+
+def build_render_context(device):
+    return build_render_contexts([device])[device.pk]
+
+
+def device_data(device):
+    return {
+        "id": device.pk,
+        "name": device.name,
+        "site": device.site.name if device.site_id else None,
+        "device_type": str(device.device_type),
+        "role": str(device.device_role),
+        "serial": device.serial,
+    }
+
+
+def template_source(config_template):
+    # Aceita um ConfigTemplate do NetBox ou o código do template diretamente
+    if isinstance(config_template, str):
+        return config_template, {}
+    return config_template.template_code, config_template.environment_params or {}
+
+
+def get_template(source, environment_params=None):
+    # Cache do template compilado, chaveado pelo hash do código + parâmetros
+    environment_params = environment_params or {}
+    key = hashlib.sha256(
+        (source + json.dumps(environment_params, sort_keys=True)).encode()
+    ).hexdigest()
+    with _templates_lock:
+        if key in _templates:
+            _templates.move_to_end(key)
+            return _templates[key]
+
+    template = Environment(**environment_params).from_string(source)
+
+    with _templates_lock:
+        _templates[key] = template
+        while len(_templates) > TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    return template
+
+
+def render_config(config_template, context):
+    source, environment_params = template_source(config_template)
+    return get_template(source, environment_params).render(**context)
+
+
+def content_hash(value):
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, default=str)
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def render_batch(sources, jobs):
+    # Executado nos processos do pool: recebe apenas dados simples
+    # sources: {template_key: (source, environment_params)}
+    # jobs: [(device_id, template_key, context)]
+    results = []
+    for device_id, template_key, context in jobs:
+        source, environment_params = sources[template_key]
+        try:
+            rendered = get_template(source, environment_params).render(**context)
+        except Exception as e:
+            results.append((device_id, None, f"{type(e).__name__}: {e}"))
+            continue
+        results.append((device_id, rendered, None))
+    return results
+
+
+def artifact_name(device_id, name):
+    # O id entra no nome: devices com o mesmo nome em sites diferentes não
+    # podem compartilhar (nem sobrescrever) o mesmo arquivo
+    if not name:
+        return f"device-{device_id}.rsc"
+    return f"{device_id}-" + re.sub(r'[^A-Za-z0-9._-]', '_', name) + ".rsc"
+
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {"devices": {}}
+
+
+def write_file(path, content):
+    # Escrita atômica para não deixar arquivos pela metade
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as output_file:
+        output_file.write(content)
+    os.replace(tmp_path, path)
+
+
+def render_to_directory(device_ids, output_dir, config_template=None, workers=4, force=False, commit=True, store=None):
+    # Renderiza os devices em output_dir, pulando os que têm o mesmo hash de
+    # contexto no manifest. Usado pelo BulkRenderConfigScript e pela
+    # regeneração incremental do dependency_index. Com store (um
+    # config_store.ConfigStore) cada saída também é registrada no armazém
+    manifest = load_manifest(output_dir)
+    previous = manifest.get("devices", {})
+    started = time.monotonic()
+
+    # Coletar contextos em lote e descartar os que não mudaram
+    sources = {}
+    jobs = []
+    names = {}
+    result = {"rendered": {}, "skipped": 0, "unchanged_output": 0, "missing_template": 0, "failures": {}}
+    for start in range(0, len(device_ids), CONTEXT_CHUNK_SIZE):
+        templates = {}
+        contexts = build_render_contexts(device_ids[start:start + CONTEXT_CHUNK_SIZE], templates)
+        for device_id, context in contexts.items():
+            effective_template = config_template or templates[device_id]
+            if not effective_template:
+                result["missing_template"] += 1
+                continue
+            if effective_template.pk not in sources:
+                sources[effective_template.pk] = template_source(effective_template)
+            names[device_id] = context["device"]["name"]
+
+            context_hash = content_hash([sources[effective_template.pk], context])
+            entry = previous.get(str(device_id))
+            if (
+                not force and entry and entry["context_hash"] == context_hash and
+                os.path.exists(os.path.join(output_dir, entry["file"]))
+            ):
+                result["skipped"] += 1
+                continue
+            jobs.append((device_id, effective_template.pk, context, context_hash))
+
+    # Renderizar em um pool de processos; os workers só recebem dados simples
+    rendered = result["rendered"]
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers or 4) as executor:
+            futures = [
+                executor.submit(
+                    render_batch, sources,
+                    [(device_id, key, context) for device_id, key, context, _ in jobs[start:start + RENDER_BATCH_SIZE]]
+                )
+                for start in range(0, len(jobs), RENDER_BATCH_SIZE)
+            ]
+            for future in as_completed(futures):
+                for device_id, text, error in future.result():
+                    if error:
+                        result["failures"][device_id] = {"name": names[device_id], "error": error}
+                    else:
+                        rendered[device_id] = text
+
+    context_hashes = {device_id: context_hash for device_id, _, _, context_hash in jobs}
+    template_keys = {device_id: key for device_id, key, _, _ in jobs}
+    if commit:
+        os.makedirs(output_dir, exist_ok=True)
+        now = timezone.now().isoformat()
+        for device_id, text in rendered.items():
+            filename = artifact_name(device_id, names[device_id])
+            text_hash = content_hash(text)
+            entry = previous.get(str(device_id))
+            # Contexto mudou mas a saída não: o arquivo não é reescrito
+            if (
+                entry and entry.get("content_hash") == text_hash and entry["file"] == filename and
+                os.path.exists(os.path.join(output_dir, filename))
+            ):
+                result["unchanged_output"] += 1
+            else:
+                write_file(os.path.join(output_dir, filename), text)
+            if store is not None:
+                store.record(
+                    device_id, names[device_id], text,
+                    context_hash=context_hashes[device_id], config_template=template_keys[device_id]
+                )
+            previous[str(device_id)] = {
+                "name": names[device_id],
+                "file": filename,
+                "config_template": template_keys[device_id],
+                "context_hash": context_hashes[device_id],
+                "content_hash": text_hash,
+                "rendered_at": entry["rendered_at"] if entry and entry.get("content_hash") == text_hash else now,
+            }
+        manifest["devices"] = previous
+        manifest["updated_at"] = now
+        write_file(os.path.join(output_dir, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True))
+
+    result["elapsed"] = time.monotonic() - started
+    return result
@@ -0,0 +1,165 @@
+import difflib
+import json
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import timezone as dt_timezone
+
+from django.utils import timezone
+from config_render import content_hash, write_file
+
+# Armazém de configs renderizados endereçado pelo hash do conteúdo:
+#   objects/ab/cdef...   conteúdo comprimido (zlib), gravado uma única vez
+#   devices/<id>.json    ponteiro do device com o histórico de hashes
+#   changes.ndjson       log de mudanças (quando, device, hash antigo e novo)
+# CPEs com a mesma saída compartilham o mesmo objeto, um device só ganha uma
+# nova versão quando o hash muda e o diff entre versões não depende de
+# nenhum arquivo renderizado.
+
+# Armazém usado por padrão pelo render em lote e pela regeneração incremental
+CONFIG_STORE_DIR = os.environ.get("NETBOX_CONFIG_STORE")
+HISTORY_SIZE = 50
+OBJECT_CACHE_SIZE = 256
+COMPRESSION_LEVEL = 6
+# Hash sha256 em hexadecimal: a única forma aceita de endereçar um objeto
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class ConfigStore:
+
+    def __init__(self, root):
+        self.root = root
+        self._objects = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _object_path(self, digest):
+        # O hash pode vir do usuário: nada além de sha256 hex vira caminho
+        if not isinstance(digest, str) or not DIGEST_PATTERN.match(digest):
+            raise ValueError(f"Invalid config hash '{digest}'")
+        return os.path.join(self.root, "objects", digest[:2], digest[2:])
+
+    def _device_path(self, device_id):
+        return os.path.join(self.root, "devices", f"{device_id}.json")
+
+    def put(self, text):
+        # Grava o conteúdo se ainda não existir e devolve o hash
+        digest = content_hash(text)
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as object_file:
+                object_file.write(zlib.compress(text.encode(), COMPRESSION_LEVEL))
+            os.replace(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        with self._lock:
+            if digest in self._objects:
+                self._objects.move_to_end(digest)
+                return self._objects[digest]
+        try:
+            with open(self._object_path(digest), 'rb') as object_file:
+                text = zlib.decompress(object_file.read()).decode()
+        except FileNotFoundError:
+            raise KeyError(f"Config {digest[:12]} not found in the store")
+        with self._lock:
+            self._objects[digest] = text
+            while len(self._objects) > OBJECT_CACHE_SIZE:
+                self._objects.popitem(last=False)
+        return text
+
+    def history(self, device_id):
+        try:
+            with open(self._device_path(device_id)) as device_file:
+                return json.load(device_file)["history"]
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def head(self, device_id):
+        history = self.history(device_id)
+        return history[-1] if history else None
+
+    def record(self, device_id, name, text, **metadata):
+        # Guarda a saída do device; devolve (hash, mudou). Sem mudança no hash
+        # nada é gravado
+        digest = content_hash(text)
+        history = self.history(device_id)
+        previous = history[-1]["hash"] if history else None
+        if digest == previous:
+            return digest, False
+
+        self.put(text)
+        now = timezone.now().isoformat()
+        history.append(dict(metadata, hash=digest, recorded_at=now))
+        os.makedirs(os.path.dirname(self._device_path(device_id)), exist_ok=True)
+        write_file(self._device_path(device_id), json.dumps({
+            "device_id": device_id,
+            "name": name,
+            "history": history[-HISTORY_SIZE:],
+        }, sort_keys=True))
+        with self._lock, open(os.path.join(self.root, "changes.ndjson"), 'a') as changes_file:
+            changes_file.write(json.dumps({
+                "at": now, "device_id": device_id, "name": name, "old": previous, "new": digest,
+            }, sort_keys=True) + "\n")
+        return digest, True
+
+    def resolve(self, device_id, version=-1):
+        # version: índice no histórico (negativo conta do fim) ou um hash
+        if isinstance(version, str) and not version.lstrip('-').isdigit():
+            version = version.strip().lower()
+            if not DIGEST_PATTERN.match(version):
+                raise ValueError(f"Invalid config hash '{version}' (expected a history index or a sha256 hash)")
+            return version
+        history = self.history(device_id)
+        try:
+            return history[int(version)]["hash"]
+        except IndexError:
+            return None
+
+    def diff(self, device_id, old=-2, new=-1, context=3):
+        return self.diff_hashes(self.resolve(device_id, old), self.resolve(device_id, new), context)
+
+    def diff_hashes(self, old, new, context=3):
+        # Hashes iguais não precisam nem ler o conteúdo
+        if old == new:
+            return ""
+        old_text = self.get(old).splitlines(keepends=True) if old else []
+        new_text = self.get(new).splitlines(keepends=True) if new else []
+        return "".join(difflib.unified_diff(
+            old_text, new_text,
+            fromfile=old[:12] if old else "/dev/null",
+            tofile=new[:12] if new else "/dev/null",
+            n=context
+        ))
+
+    def changes(self, since=None, until=None):
+        # Devices que mudaram na janela: {device_id: {name, old, new}} com o
+        # primeiro hash antigo e o último novo de cada device
+        changed = {}
+        try:
+            changes_file = open(os.path.join(self.root, "changes.ndjson"))
+        except OSError:
+            return changed
+        since = since.astimezone(dt_timezone.utc).isoformat() if since else None
+        until = until.astimezone(dt_timezone.utc).isoformat() if until else None
+        with changes_file:
+            for line in changes_file:
+                change = json.loads(line)
+                if (since and change["at"] < since) or (until and change["at"] > until):
+                    continue
+                entry = changed.setdefault(change["device_id"], {"name": change["name"], "old": change["old"]})
+                entry["new"] = change["new"]
+        # Mudanças que voltaram ao conteúdo original não contam
+        return {device_id: entry for device_id, entry in changed.items() if entry["old"] != entry["new"]}
+
+    def stats(self):
+        objects = size = 0
+        for directory, _, files in os.walk(os.path.join(self.root, "objects")):
+            for filename in files:
+                objects += 1
+                size += os.path.getsize(os.path.join(directory, filename))
+        devices = len(os.listdir(os.path.join(self.root, "devices"))) if os.path.isdir(os.path.join(self.root, "devices")) else 0
+        return {"objects": objects, "bytes": size, "devices": devices}
@@ -0,0 +1,299 @@
+import logging
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.utils import timezone
+from django_rq import get_connection, get_queue
+from dcim.models import Device, Interface
+from ipam.models import IPAddress
+from extras.models import ConfigContext, ObjectChange
+from config_render import CONNECTED_TO_FIELDS, parse_connected_to, render_to_directory
+from config_store import CONFIG_STORE_DIR, ConfigStore
+from pop_context import build_pop_context, shared_context_name, sync_shared_context
+
+# Índice de dependências POP -> CPEs para regenerar apenas o que mudou.
+# Um CPE depende de um POP de duas formas:
+#   - render: o custom field Connectedto aponta para o POP e o template usa
+#     os IPs das interfaces INTERNET dele;
+#   - context: o local_context_data do CPE é a cópia do contexto do POP
+#     (pop_device_name), feita pelos scripts de criação, ou a referência ao
+#     contexto compartilhado do POP.
+#
+# O índice é montado com duas queries. As mudanças são lidas do change log
+# (ObjectChange), que o NetBox grava para qualquer processo: UI, API, scripts
+# e outros workers. O job poll_changes roda no RQ a cada POLL_SECONDS, lê as
+# mudanças de Device, Interface (inclusive tags) e IPAddress desde a última
+# leitura e marca os POPs afetados em um set do Redis; a primeira marcação da
+# janela COALESCE_SECONDS agenda (enqueue_in) um único job que drena o set,
+# atualiza o contexto copiado e re-renderiza apenas os CPEs dependentes.
+#
+# O ObjectChange é gravado antes do commit da transação que o criou: cada
+# leitura volta POLL_OVERLAP segundos para não perder transações longas, e
+# uma mudança lida duas vezes só refaz uma regeneração que não altera nada.
+
+COALESCE_SECONDS = float(os.environ.get("NETBOX_DEPENDENCY_COALESCE", "5"))
+POLL_SECONDS = float(os.environ.get("NETBOX_DEPENDENCY_POLL", "60"))
+POLL_OVERLAP = 30
+INDEX_MAX_AGE = 300
+QUEUE_NAME = "default"
+PENDING_KEY = "dependency_index:pending"
+SCHEDULED_KEY = "dependency_index:scheduled"
+POLL_SCHEDULED_KEY = "dependency_index:poll_scheduled"
+# Cache key com o instante da última leitura do change log
+WATERMARK_KEY = "dependency_index.watermark"
+# Diretório dos configs renderizados (o mesmo do BulkRenderConfigScript);
+# sem ele apenas o contexto copiado é atualizado
+RENDER_OUTPUT_DIR = os.environ.get("NETBOX_RENDER_OUTPUT_DIR")
+
+# Linhas do change log lidas por rodada do iterator
+CHUNK_SIZE = 2000
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyIndex:
+
+    def __init__(self):
+        self.render = {}
+        self.context = {}
+        self.edges = {}
+        self.built_at = None
+        self._lock = threading.RLock()
+
+    @property
+    def stale(self):
+        return self.built_at is None or time.monotonic() - self.built_at > INDEX_MAX_AGE
+
+    def build(self):
+        fields = [f"custom_field_data__{field}" for field in CONNECTED_TO_FIELDS]
+        query = Q(local_context_data__has_key="pop_device_name")
+        for field in CONNECTED_TO_FIELDS:
+            query |= Q(custom_field_data__has_key=field)
+        rows = list(
+            Device.objects.filter(query)
+            .values_list('pk', 'local_context_data__pop_device_name', *fields)
+        )
+        pop_names = {row[1] for row in rows if row[1]}
+        pops_by_name = {}
+        for pk, name in Device.objects.filter(name__in=pop_names).values_list('pk', 'name'):
+            pops_by_name.setdefault(name, set()).add(pk)
+
+        with self._lock:
+            self.render.clear()
+            self.context.clear()
+            self.edges.clear()
+            for pk, pop_name, *connected_to in rows:
+                self._link(pk, parse_connected_to(dict(zip(CONNECTED_TO_FIELDS, connected_to))), pops_by_name.get(pop_name, ()))
+            self.built_at = time.monotonic()
+        return self
+
+    def _link(self, pk, render_pop, context_pops):
+        self._unlink(pk)
+        if render_pop:
+            self.render.setdefault(render_pop, set()).add(pk)
+        for pop in context_pops:
+            self.context.setdefault(pop, set()).add(pk)
+        if render_pop or context_pops:
+            self.edges[pk] = (render_pop, frozenset(context_pops))
+
+    def _unlink(self, pk):
+        render_pop, context_pops = self.edges.pop(pk, (None, ()))
+        for pop, mapping in [(render_pop, self.render)] + [(pop, self.context) for pop in context_pops]:
+            if pop in mapping:
+                mapping[pop].discard(pk)
+                if not mapping[pop]:
+                    del mapping[pop]
+
+    def has_dependents(self, pop_id):
+        with self._lock:
+            return pop_id in self.render or pop_id in self.context
+
+    def dependents(self, pop_ids):
+        render = set()
+        context = {}
+        with self._lock:
+            for pop_id in pop_ids:
+                render |= self.render.get(pop_id, set())
+                if pop_id in self.context:
+                    context[pop_id] = set(self.context[pop_id])
+        return render, context
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self.edges),
+                "render_pops": len(self.render),
+                "context_pops": len(self.context),
+                "age": round(time.monotonic() - self.built_at, 1) if self.built_at else None,
+            }
+
+
+_index = DependencyIndex()
+queue_stats = {"changes": 0, "jobs": 0}
+
+
+def get_index(rebuild=False):
+    if rebuild or _index.stale:
+        _index.build()
+    return _index
+
+
+def _queue(pop_ids):
+    index = get_index()
+    pop_ids = {pop_id for pop_id in pop_ids if index.has_dependents(pop_id)}
+    if not pop_ids:
+        return
+    queue_stats["changes"] += 1
+    try:
+        redis = get_connection(QUEUE_NAME)
+        redis.sadd(PENDING_KEY, *pop_ids)
+        # Só a primeira mudança da janela agenda o job
+        if redis.set(SCHEDULED_KEY, 1, nx=True, ex=int(COALESCE_SECONDS * 10) + 60):
+            get_queue(QUEUE_NAME).enqueue_in(timedelta(seconds=COALESCE_SECONDS), flush)
+    except Exception:
+        # Redis indisponível: executa aqui mesmo em vez de perder a mudança
+        logger.exception("Could not enqueue dependency refresh, running it in-process")
+        refresh_dependents(sorted(pop_ids))
+
+
+def flush():
+    # Job do RQ agendado por _queue: drena os POPs marcados na janela
+    redis = get_connection(QUEUE_NAME)
+    # Libera o agendamento antes de drenar: uma mudança que chegar agora
+    # agenda um novo job em vez de ficar esquecida no set
+    redis.delete(SCHEDULED_KEY)
+    pipeline = redis.pipeline()
+    pipeline.smembers(PENDING_KEY)
+    pipeline.delete(PENDING_KEY)
+    members, _ = pipeline.execute()
+    pop_ids = sorted(int(pop_id) for pop_id in members)
+    if not pop_ids:
+        return None
+    queue_stats["jobs"] += 1
+    return refresh_dependents(pop_ids)
+
+
+def refresh_dependents(pop_ids, output_dir=RENDER_OUTPUT_DIR, commit=True):
+    # Job do RQ: atualiza o contexto copiado e re-renderiza os dependentes
+    index = get_index()
+    render, context = index.dependents(pop_ids)
+
+    context_updated = 0
+    pops = list(Device.objects.filter(pk__in=context).select_related('device_role'))
+    shared = set(
+        ConfigContext.objects.filter(name__in=[shared_context_name(pop) for pop in pops]).values_list('name', flat=True)
+    )
+    for pop in pops:
+        local_context = build_pop_context(pop, use_cache=False)
+        if shared_context_name(pop) in shared:
+            sync_shared_context(pop, local_context, commit=commit)
+        # A cópia só é reescrita nos CPEs que ainda guardam o contexto inteiro
+        # e em que ele de fato mudou
+        queryset = Device.objects.filter(
+            pk__in=context[pop.pk], local_context_data__has_key="interfaces"
+        ).exclude(local_context_data=local_context)
+        if not commit:
+            context_updated += queryset.count()
+            continue
+        devices = list(queryset)
+        now = timezone.now()
+        for device in devices:
+            # Estado anterior para o change log
+            device.snapshot()
+            device.local_context_data = local_context
+            device.last_updated = now
+        with transaction.atomic():
+            Device.objects.bulk_update(devices, ['local_context_data', 'last_updated'])
+            for device in devices:
+                post_save.send(
+                    sender=Device, instance=device, created=False, raw=False, using='default',
+                    update_fields=frozenset({'local_context_data', 'last_updated'})
+                )
+        context_updated += len(devices)
+
+    device_ids = sorted(render.union(*context.values()))
+    result = {
+        "pops": len(pop_ids),
+        "dependents": len(device_ids),
+        "context_updated": context_updated,
+        "rendered": 0,
+        "skipped": 0,
+        "failures": {},
+    }
+    if output_dir and device_ids:
+        store = ConfigStore(CONFIG_STORE_DIR) if CONFIG_STORE_DIR else None
+        rendered = render_to_directory(device_ids, output_dir, commit=commit, store=store)
+        result.update(rendered=len(rendered["rendered"]), skipped=rendered["skipped"], failures=rendered["failures"])
+    logger.info("Dependency refresh: %s", {key: value for key, value in result.items() if key != "failures"})
+    return result
+
+
+def changed_pops(since, until):
+    # Devices cujas interfaces ou IPs mudaram no intervalo, e os próprios
+    # devices alterados (nome e role do POP fazem parte do contexto copiado)
+    content_types = ContentType.objects.get_for_models(Device, Interface, IPAddress)
+    device_type, interface_type = content_types[Device].pk, content_types[Interface].pk
+    pop_ids = set()
+    interface_ids = set()
+    rows = ObjectChange.objects.filter(
+        time__gt=since, time__lte=until, changed_object_type__in=content_types.values()
+    ).values_list(
+        'changed_object_type_id', 'changed_object_id', 'prechange_data', 'postchange_data'
+    )
+    for content_type, object_id, before, after in rows.iterator(chunk_size=CHUNK_SIZE):
+        states = [data for data in (before, after) if data]
+        if content_type == device_type:
+            pop_ids.add(object_id)
+        elif content_type == interface_type:
+            pop_ids.update(data.get("device") for data in states)
+        else:
+            # IP movido de interface afeta os dois POPs
+            interface_ids.update(
+                data.get("assigned_object_id") for data in states
+                if data.get("assigned_object_type") == interface_type
+            )
+    interface_ids.discard(None)
+    if interface_ids:
+        pop_ids.update(Interface.objects.filter(pk__in=interface_ids).values_list('device_id', flat=True))
+    return {pop_id for pop_id in pop_ids if isinstance(pop_id, int)}
+
+
+def poll_changes():
+    # Job do RQ que lê o change log e se reagenda a cada POLL_SECONDS
+    now = timezone.now()
+    since = cache.get(WATERMARK_KEY) or now - timedelta(seconds=POLL_SECONDS)
+    try:
+        pop_ids = changed_pops(since - timedelta(seconds=POLL_OVERLAP), now)
+        if pop_ids:
+            # Devices alterados podem ter mudado o Connectedto ou o POP copiado
+            get_index(rebuild=True)
+            _queue(pop_ids)
+        cache.set(WATERMARK_KEY, now, timeout=None)
+        return len(pop_ids)
+    finally:
+        _schedule_poll(force=True)
+
+
+def ensure_polling():
+    # Inicia a leitura periódica se nenhuma estiver agendada (primeira
+    # execução, ou job perdido: a chave expira sem ser renovada)
+    try:
+        _schedule_poll()
+    except Exception:
+        logger.exception("Could not schedule the dependency change poll")
+
+
+def _schedule_poll(force=False):
+    redis = get_connection(QUEUE_NAME)
+    if redis.set(POLL_SCHEDULED_KEY, 1, nx=not force, ex=int(POLL_SECONDS * 3) + 60) or force:
+        get_queue(QUEUE_NAME).enqueue_in(timedelta(seconds=POLL_SECONDS), poll_changes)
+
+
+ensure_polling()
@@ -0,0 +1,220 @@
+import hashlib
+import ipaddress
+import os
+import threading
+
+import yaml
+
+# Compilador das regras de firewall em YAML para comandos RouterOS.
+# O YAML é lido uma vez e o resultado compilado fica em cache pelo hash do
+# conteúdo. No caminho ele:
+#   - junta drops de porta única da mesma chain em uma lista de portas
+#     (apenas dentro de sequências de regras drop, onde a ordem não importa);
+#   - agrega e colapsa os CIDRs de cada address-list.
+
+FIREWALL_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'firewall_rules_mikrotik_cpe.yaml')
+
+# Config context com os comandos compilados (chave "firewall"), gravado pelo
+# CompileFirewallScript para o "Render Config" nativo do NetBox
+FIREWALL_CONTEXT_NAME = "firewall-mikrotik-cpe"
+
+# Limite do RouterOS para portas em um único port/dst-port/src-port
+MAX_PORTS = 15
+
+# Parâmetros de porta do RouterOS; "port" casa origem OU destino e é mantido
+# como está no YAML
+PORT_KEYS = ("port", "dst-port", "src-port")
+
+_cache = {}
+_lock = threading.Lock()
+
+
+class CompiledFirewall:
+
+    def __init__(self, filter_rules, address_list, stats):
+        self.filter_rules = filter_rules
+        self.address_list = address_list
+        self.stats = stats
+
+    @property
+    def commands(self):
+        lines = []
+        if self.address_list:
+            lines.append("/ip firewall address-list")
+            lines.extend(f"add {format_params(entry)}" for entry in self.address_list)
+        if self.filter_rules:
+            lines.append("/ip firewall filter")
+            lines.extend(f"add {format_params(rule)}" for rule in self.filter_rules)
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.commands
+
+
+def format_value(value):
+    if isinstance(value, bool):
+        return "yes" if value else "no"
+    if isinstance(value, (list, tuple)):
+        value = ",".join(str(item) for item in value)
+    value = str(value)
+    if not value or any(char in value for char in ' "\\$;[]{}=#<>'):
+        value = value.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+        return f'"{value}"'
+    return value
+
+
+def format_params(params):
+    return " ".join(
+        f"{key}={format_value(value) if key != 'comment' else quote(value)}"
+        for key, value in params.items()
+    )
+
+
+def quote(value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+    return f'"{value}"'
+
+
+def normalize_rule(rule):
+    normalized = {}
+    for key, value in rule.items():
+        if isinstance(value, (list, tuple)):
+            value = ",".join(str(item) for item in value)
+        normalized[key] = value
+    return normalized
+
+
+def single_port(rule):
+    # (parâmetro, porta) quando a regra tem uma única porta em um único parâmetro
+    keys = [key for key in PORT_KEYS if key in rule]
+    if len(keys) != 1:
+        return None
+    port = str(rule[keys[0]])
+    return (keys[0], port) if port and "," not in port else None
+
+
+def merge_port_drops(rules):
+    merged = []
+    index = 0
+    while index < len(rules):
+        if rules[index].get("action") != "drop":
+            merged.append(rules[index])
+            index += 1
+            continue
+
+        # Sequência de drops consecutivos: a ordem entre eles não altera o resultado
+        end = index
+        while end < len(rules) and rules[end].get("action") == "drop":
+            end += 1
+        groups = {}
+        order = []
+        for rule in rules[index:end]:
+            port = single_port(rule)
+            if port is None:
+                order.append(rule)
+                continue
+            signature = (port[0],) + tuple(sorted(
+                (key, str(value)) for key, value in rule.items() if key not in (port[0], "comment")
+            ))
+            if signature not in groups:
+                groups[signature] = []
+                order.append(signature)
+            groups[signature].append(rule)
+        for item in order:
+            if isinstance(item, dict):
+                merged.append(item)
+                continue
+            group = groups[item]
+            for start in range(0, len(group), MAX_PORTS):
+                chunk = group[start:start + MAX_PORTS]
+                rule = dict(chunk[0])
+                rule[item[0]] = ",".join(dict.fromkeys(single_port(r)[1] for r in chunk))
+                comments = [r["comment"] for r in chunk if r.get("comment")]
+                if comments:
+                    rule["comment"] = "; ".join(dict.fromkeys(comments))
+                merged.append(rule)
+        index = end
+    return merged
+
+
+def parse_networks(address):
+    # Aceita IP, CIDR ou intervalo "a-b"; devolve None para nomes e placeholders
+    address = str(address).strip()
+    try:
+        if "-" in address:
+            first, last = (ipaddress.ip_address(part.strip()) for part in address.split("-", 1))
+            return list(ipaddress.summarize_address_range(first, last))
+        return [ipaddress.ip_network(address, strict=False)]
+    except ValueError:
+        return None
+
+
+def aggregate_address_list(entries):
+    lists = {}
+    order = []
+    for entry in entries:
+        addresses = entry.get("address")
+        if not isinstance(addresses, (list, tuple)):
+            addresses = [addresses]
+        for address in addresses:
+            item = dict(entry, address=address)
+            extra = set(item) - {"list", "address", "comment"}
+            networks = None if extra else parse_networks(address)
+            key = item.get("list")
+            if networks is None:
+                order.append(item)
+                continue
+            if key not in lists:
+                lists[key] = {"comment": item.get("comment"), "networks": []}
+                order.append(key)
+            lists[key]["networks"].extend(networks)
+
+    aggregated = []
+    for item in order:
+        if isinstance(item, dict):
+            aggregated.append(item)
+            continue
+        networks = lists[item]["networks"]
+        for version in (4, 6):
+            for network in ipaddress.collapse_addresses(n for n in networks if n.version == version):
+                address = str(network.network_address) if network.num_addresses == 1 else str(network)
+                entry = {"list": item, "address": address}
+                if lists[item]["comment"]:
+                    entry["comment"] = lists[item]["comment"]
+                aggregated.append(entry)
+    return aggregated
+
+
+def count_entries(entries):
+    total = 0
+    for entry in entries:
+        addresses = entry.get("address")
+        total += len(addresses) if isinstance(addresses, (list, tuple)) else 1
+    return total
+
+
+def compile_rules(content):
+    key = hashlib.sha256(content.encode() if isinstance(content, str) else content).hexdigest()
+    with _lock:
+        if key in _cache:
+            return _cache[key]
+
+    data = (yaml.safe_load(content) or {}).get("firewall", {})
+    filter_rules = [normalize_rule(rule) for rule in data.get("filter", [])]
+    address_list = [dict(entry) for entry in data.get("address-list", [])]
+
+    compiled_filter = merge_port_drops(filter_rules)
+    compiled_address_list = aggregate_address_list(address_list)
+    compiled = CompiledFirewall(compiled_filter, compiled_address_list, {
+        "filter_rules": (len(filter_rules), len(compiled_filter)),
+        "address_list_entries": (count_entries(address_list), len(compiled_address_list)),
+    })
+
+    with _lock:
+        _cache[key] = compiled
+    return compiled
+
+
+def compile_file(path=FIREWALL_RULES_FILE):
+    with open(path, 'rb') as rules_file:
+        return compile_rules(rules_file.read())
@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from django.db import connection
+from django.utils import timezone
+
+# Instrumentação opcional dos scripts: cada fase nomeada do run() registra o
+# tempo gasto, o número e o tempo total das queries SQL e o tempo de HTTP de
+# saída informado com record_http() por quem faz as requisições (o job de
+# entrega dos webhooks soma o tempo medido pelo WebhookDispatcher). O resumo vai para o log do job em uma linha JSON e, se configurado,
+# para um arquivo JSON lines e/ou um arquivo no formato texto do Prometheus
+# (para o textfile collector do node_exporter).
+#
+# Habilitado com NETBOX_SCRIPT_METRICS=1. Desabilitado, phase() devolve um
+# nullcontext compartilhado e nada mais é executado.
+#
+# Usado como context manager: o resumo é gravado na saída do bloco, inclusive
+# em returns antecipados e exceções.
+
+ENABLED = os.environ.get("NETBOX_SCRIPT_METRICS", "").lower() in ("1", "true", "yes")
+METRICS_FILE = os.environ.get("NETBOX_SCRIPT_METRICS_FILE")
+PROMETHEUS_FILE = os.environ.get("NETBOX_SCRIPT_METRICS_PROM")
+
+_NULL_PHASE = nullcontext()
+_lock = threading.Lock()
+
+
+class ScriptMetrics:
+
+    def __init__(self, script, enabled=None):
+        self.script = script if isinstance(script, str) else script.__class__.__name__
+        self._owner = None if isinstance(script, str) else script
+        self.enabled = ENABLED if enabled is None else enabled
+        self.phases = {}
+        self._stack = []
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.report(self._owner)
+        return False
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return self._phase(name)
+
+    def _get(self, name):
+        if name not in self.phases:
+            self.phases[name] = {"seconds": 0.0, "calls": 0, "queries": 0, "query_seconds": 0.0, "http_requests": 0, "http_seconds": 0.0}
+        return self.phases[name]
+
+    @contextmanager
+    def _phase(self, name):
+        with self._lock:
+            stats = self._get(name)
+        self._stack.append(name)
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(self._query_wrapper):
+                yield stats
+        finally:
+            elapsed = time.perf_counter() - started
+            self._stack.pop()
+            with self._lock:
+                stats["seconds"] += elapsed
+                stats["calls"] += 1
+
+    def _query_wrapper(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            # Conta apenas na fase mais interna para não somar duas vezes
+            if self._stack:
+                with self._lock:
+                    stats = self.phases[self._stack[-1]]
+                    stats["queries"] += 1
+                    stats["query_seconds"] += elapsed
+
+    def record_http(self, seconds, count=1, phase=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._get(phase or (self._stack[-1] if self._stack else "http"))
+            stats["http_requests"] += count
+            stats["http_seconds"] += seconds
+
+    def summary(self):
+        with self._lock:
+            phases = {
+                name: {key: round(value, 4) if isinstance(value, float) else value for key, value in stats.items()}
+                for name, stats in self.phases.items()
+            }
+        return {
+            "script": self.script,
+            "timestamp": timezone.now().isoformat(),
+            "total_seconds": round(time.perf_counter() - self._started, 4),
+            "queries": sum(stats["queries"] for stats in phases.values()),
+            "http_requests": sum(stats["http_requests"] for stats in phases.values()),
+            "phases": phases,
+        }
+
+    def report(self, script=None):
+        if not self.enabled:
+            return None
+        summary = self.summary()
+        if script is not None:
+            script.log_info(f"metrics: {json.dumps(summary, sort_keys=True)}")
+        if METRICS_FILE:
+            with _lock, open(METRICS_FILE, 'a') as metrics_file:
+                metrics_file.write(json.dumps(summary, sort_keys=True) + "\n")
+        if PROMETHEUS_FILE:
+            write_prometheus(PROMETHEUS_FILE, summary)
+        return summary
+
+
+def prometheus_lines(summary):
+    script = summary["script"]
+    lines = [f'netbox_script_seconds{{script="{script}"}} {summary["total_seconds"]}']
+    for phase, stats in sorted(summary["phases"].items()):
+        labels = f'script="{script}",phase="{phase}"'
+        lines.extend([
+            f'netbox_script_phase_seconds{{{labels}}} {stats["seconds"]}',
+            f'netbox_script_phase_queries{{{labels}}} {stats["queries"]}',
+            f'netbox_script_phase_query_seconds{{{labels}}} {stats["query_seconds"]}',
+            f'netbox_script_phase_http_requests{{{labels}}} {stats["http_requests"]}',
+            f'netbox_script_phase_http_seconds{{{labels}}} {stats["http_seconds"]}',
+        ])
+    return lines
+
+
+def write_prometheus(path, summary):
+    # Mantém no arquivo a última execução de cada script
+    marker = f'script="{summary["script"]}"'
+    with _lock:
+        try:
+            with open(path) as prometheus_file:
+                lines = [
+                    line.rstrip("\n") for line in prometheus_file
+                    if line.strip() and not line.startswith("#") and marker not in line
+                ]
+        except OSError:
+            lines = []
+        lines.extend(prometheus_lines(summary))
+        metrics = sorted({line.split("{", 1)[0] for line in lines})
+        content = [f"# TYPE {metric} gauge" for metric in metrics] + sorted(lines)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as prometheus_file:
+            prometheus_file.write("\n".join(content) + "\n")
+        os.replace(tmp_path, path)
+
@@ -0,0 +1,137 @@
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+from netaddr import IPNetwork
+from dcim.models import Device, Interface
+from ipam.models import IPAddress
+from reference_cache import content_type
+
+# Plan-then-apply para as interfaces de solução (EoIP/GRE/BRIDGE/L2TP).
+# plan_interfaces() monta todas as interfaces de N requests e checa nomes
+# existentes em uma única query; apply_plan() grava tudo com bulk inserts em
+# uma transação. Como o bulk_create/bulk_update não disparam sinais, o
+# post_save de cada objeto é enviado em seguida: change log, índice de busca
+# e os handlers dos módulos auxiliares continuam vendo cada alteração.
+
+# (lado, nome, recebe IP/VLAN) na mesma ordem em que o script criava
+SOLUTION_INTERFACES = {
+    "EoIP": (
+        ("device", "EoIP-{site}", False),
+        ("device", "GRE-{site}", True),
+        ("pop", "EoIP-{site}", False),
+        ("pop", "GRE-{site}", True),
+        ("device", "BRIDGE-{site}", False),
+        ("pop", "BRIDGE-{site}", False),
+    ),
+    "L2TP": (
+        ("device", "L2TP-{site}.A001", True),
+        ("pop", "L2TP-{site}.A001", True),
+        ("device", "BRIDGE-{site}", False),
+        ("pop", "BRIDGE-{site}", False),
+    ),
+}
+
+
+def plan_interfaces(requests):
+    # requests: lista de dicts com device, pop_device, solution, manual_ip,
+    # pop_manual_ip, vlan e serial_number
+    items = []
+    for request in requests:
+        device = request["device"]
+        for side, name, with_ip in SOLUTION_INTERFACES.get(request["solution"], ()):
+            target = device if side == "device" else request.get("pop_device")
+            if not target:
+                continue
+            ip = None
+            if with_ip:
+                ip = request.get("manual_ip") if side == "device" else request.get("pop_manual_ip")
+            items.append({
+                "device": target,
+                "name": name.format(site=device.site.name),
+                "ip": ip or None,
+                "vlan": request.get("vlan") if with_ip else None,
+                "conflict": None,
+                "request": request,
+            })
+
+    # Uma única query para todos os nomes já existentes
+    existing = set(
+        Interface.objects.filter(
+            device__in={item["device"].pk for item in items},
+            name__in={item["name"] for item in items}
+        ).values_list('device_id', 'name')
+    )
+    seen = set()
+    for item in items:
+        key = (item["device"].pk, item["name"])
+        if key in existing:
+            item["conflict"] = f"Interface '{item['name']}' already exists on device '{item['device'].name}'."
+        elif key in seen:
+            item["conflict"] = f"Interface '{item['name']}' is requested more than once for device '{item['device'].name}'."
+        seen.add(key)
+
+    return items
+
+
+def apply_plan(items, serials=None):
+    # serials: {device_id: serial} a gravar junto com o IP primário
+    items = [item for item in items if not item["conflict"]]
+    serials = serials or {}
+
+    with transaction.atomic():
+        interfaces = []
+        for item in items:
+            interface = Interface(
+                device=item["device"],
+                name=item["name"],
+                type='virtual',
+                enabled=True
+            )
+            if item["vlan"]:
+                interface.mode = 'access'
+                interface.untagged_vlan = item["vlan"]
+            interfaces.append(interface)
+        Interface.objects.bulk_create(interfaces)
+        _send_post_save(Interface, interfaces, created=True)
+
+        interface_type = content_type(Interface)
+        ip_addresses = []
+        for item, interface in zip(items, interfaces):
+            item["interface"] = interface
+            if item["ip"]:
+                item["ip_address"] = IPAddress(
+                    address=IPNetwork(item["ip"]),
+                    assigned_object_type=interface_type,
+                    assigned_object_id=interface.pk
+                )
+                ip_addresses.append(item["ip_address"])
+        IPAddress.objects.bulk_create(ip_addresses)
+        _send_post_save(IPAddress, ip_addresses, created=True)
+
+        # IP primário e serial: um único UPDATE por device
+        updates = {device_id: {"serial": serial} for device_id, serial in serials.items() if serial}
+        for item in items:
+            if item["ip"]:
+                ip_address = item["ip_address"]
+                field = 'primary_ip4' if ip_address.address.version == 4 else 'primary_ip6'
+                updates.setdefault(item["device"].pk, {})[field] = ip_address
+        devices = Device.objects.in_bulk(list(updates))
+        now = timezone.now()
+        for device_id, fields in updates.items():
+            device = devices[device_id]
+            # Estado anterior para o change log
+            device.snapshot()
+            for field, value in fields.items():
+                setattr(device, field, value)
+            device.last_updated = now
+        if devices:
+            update_fields = sorted({field for fields in updates.values() for field in fields} | {'last_updated'})
+            Device.objects.bulk_update(list(devices.values()), update_fields)
+            _send_post_save(Device, devices.values(), created=False, update_fields=frozenset(update_fields))
+
+    return items
+
+
+def _send_post_save(model, instances, created, update_fields=None):
+    for instance in instances:
+        post_save.send(sender=model, instance=instance, created=created, raw=False, using='default', update_fields=update_fields)
@@ -0,0 +1,158 @@
+import csv
+import gzip
+import json
+import os
+
+from django.db.models import F
+from dcim.models import Device, Interface, Site
+from ipam.models import IPAddress
+
+# Export do inventário (sites, devices, interfaces e IPs) em streaming, o
+# mesmo conteúdo listado pelo BASE_NETBOX_JINJA. Cada tipo é lido com um
+# cursor do servidor em blocos de CHUNK_SIZE, com tags em prefetch por bloco
+# e o objeto atribuído aos IPs resolvido por join, então a memória não
+# cresce com o tamanho da base.
+
+CHUNK_SIZE = 2000
+FORMATS = ("ndjson", "csv")
+
+# Colunas do CSV: união dos campos de todos os tipos
+CSV_FIELDS = (
+    "type", "id", "name", "slug", "status", "site", "device", "role", "device_type", "config_template",
+    "enabled", "address", "assigned_object_type", "assigned_object", "tags", "last_updated",
+)
+
+
+def timestamp(value):
+    return value.isoformat() if value else None
+
+
+def tag_names(obj):
+    return sorted(tag.name for tag in obj.tags.all())
+
+
+def export_sites(since=None):
+    queryset = Site.objects.all()
+    if since:
+        queryset = queryset.filter(last_updated__gte=since)
+    for site in queryset.order_by('pk').prefetch_related('tags').iterator(chunk_size=CHUNK_SIZE):
+        yield {
+            "type": "site",
+            "id": site.pk,
+            "name": site.name,
+            "slug": site.slug,
+            "status": site.status,
+            "tags": tag_names(site),
+            "last_updated": timestamp(site.last_updated),
+        }
+
+
+def export_devices(since=None):
+    queryset = Device.objects.select_related('site', 'device_role', 'device_type', 'config_template')
+    if since:
+        queryset = queryset.filter(last_updated__gte=since)
+    for device in queryset.order_by('pk').prefetch_related('tags').iterator(chunk_size=CHUNK_SIZE):
+        yield {
+            "type": "device",
+            "id": device.pk,
+            "name": device.name,
+            "status": device.status,
+            "site": device.site.name if device.site_id else None,
+            "role": device.device_role.name,
+            "device_type": str(device.device_type),
+            "config_template": device.config_template.name if device.config_template_id else None,
+            "tags": tag_names(device),
+            "last_updated": timestamp(device.last_updated),
+        }
+
+
+def export_interfaces(since=None):
+    queryset = Interface.objects.annotate(device_name=F('device__name')).only(
+        'pk', 'name', 'enabled', 'last_updated'
+    )
+    if since:
+        queryset = queryset.filter(last_updated__gte=since)
+    for interface in queryset.order_by('pk').prefetch_related('tags').iterator(chunk_size=CHUNK_SIZE):
+        yield {
+            "type": "interface",
+            "id": interface.pk,
+            "name": interface.name,
+            "device": interface.device_name,
+            "enabled": interface.enabled,
+            "tags": tag_names(interface),
+            "last_updated": timestamp(interface.last_updated),
+        }
+
+
+def export_ip_addresses(since=None):
+    # O objeto atribuído vem por join nas relações reversas (interface de
+    # device ou de VM) em vez de um assigned_object por linha
+    queryset = IPAddress.objects.annotate(
+        interface_name=F('interface__name'),
+        device_name=F('interface__device__name'),
+        vminterface_name=F('vminterface__name'),
+        virtual_machine_name=F('vminterface__virtual_machine__name'),
+    ).only('pk', 'address', 'status', 'last_updated')
+    if since:
+        queryset = queryset.filter(last_updated__gte=since)
+    for ip in queryset.order_by('pk').prefetch_related('tags').iterator(chunk_size=CHUNK_SIZE):
+        if ip.interface_name is not None:
+            assigned_type, assigned, device = "dcim.interface", ip.interface_name, ip.device_name
+        elif ip.vminterface_name is not None:
+            assigned_type, assigned, device = "virtualization.vminterface", ip.vminterface_name, ip.virtual_machine_name
+        else:
+            assigned_type = assigned = device = None
+        yield {
+            "type": "ip_address",
+            "id": ip.pk,
+            "address": str(ip.address),
+            "status": ip.status,
+            "assigned_object_type": assigned_type,
+            "assigned_object": assigned,
+            "device": device,
+            "tags": tag_names(ip),
+            "last_updated": timestamp(ip.last_updated),
+        }
+
+
+EXPORTERS = (
+    ("sites", export_sites),
+    ("devices", export_devices),
+    ("interfaces", export_interfaces),
+    ("ip_addresses", export_ip_addresses),
+)
+
+
+def export_inventory(stream, format="ndjson", since=None, types=None):
+    # Escreve os registros em stream (texto) e devolve a contagem por tipo
+    if format not in FORMATS:
+        raise ValueError(f"Unknown export format '{format}'")
+    writer = None
+    if format == "csv":
+        writer = csv.DictWriter(stream, fieldnames=CSV_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+
+    counts = {}
+    for name, exporter in EXPORTERS:
+        if types and name not in types:
+            continue
+        counts[name] = 0
+        for record in exporter(since):
+            if writer:
+                writer.writerow(dict(record, tags=",".join(record["tags"])))
+            else:
+                stream.write(json.dumps(record, sort_keys=True) + "\n")
+            counts[name] += 1
+    return counts
+
+
+def export_to_file(path, format="ndjson", since=None, types=None, compress=False):
+    # Escrita atômica; com compress=True a saída é gzip (".gz" é acrescentado)
+    if compress and not path.endswith(".gz"):
+        path = f"{path}.gz"
+    tmp_path = f"{path}.tmp"
+    opener = gzip.open if compress else open
+    with opener(tmp_path, 'wt', newline='' if format == "csv" else None) as stream:
+        counts = export_inventory(stream, format, since, types)
+    os.replace(tmp_path, path)
+    return path, counts
@@ -0,0 +1,180 @@
+import copy
+import hashlib
+import threading
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max
+from dcim.models import Interface
+from ipam.models import IPAddress
+from extras.models import ConfigContext, Tag
+
+# Cache do contexto do POP no cache do Django (o Redis do NetBox), compartilhado
+# pelos scripts de todos os workers: o RQ abre um work-horse novo por job, então
+# um cache em memória não passaria de uma execução. A chave inclui o nome e o
+# role do POP e o last_updated das suas interfaces e IPs, então qualquer
+# alteração invalida a entrada sem precisar de sinal.
+CACHE_TTL = 3600
+CACHE_PREFIX = "pop_context"
+
+# Modo compartilhado: o contexto do POP fica uma única vez em um
+# ConfigContext atribuído por uma tag própria do POP, e o CPE guarda apenas a
+# referência em local_context_data. O NetBox junta os dois no config context
+# do device, então templates e API continuam vendo as mesmas chaves.
+SHARED_CONTEXT_PREFIX = "pop-context-"
+SHARED_CONTEXT_KEYS = ("pop_device_role", "interfaces")
+
+_lock = threading.Lock()
+_shared = {}
+stats = {"hits": 0, "misses": 0}
+
+
+def pop_context_version(pop_device):
+    # Duas queries agregadas, baratas mesmo em POPs com centenas de interfaces
+    interfaces = Interface.objects.filter(device=pop_device).aggregate(
+        last_updated=Max('last_updated'),
+        count=Count('pk', distinct=True),
+        tags=Count('tags')
+    )
+    ips = IPAddress.objects.filter(interface__device=pop_device).aggregate(
+        last_updated=Max('last_updated'),
+        count=Count('pk')
+    )
+    # Nome e role do POP também entram no contexto
+    return (
+        pop_device.name, pop_device.device_role.name,
+        interfaces['last_updated'], interfaces['count'], interfaces['tags'],
+        ips['last_updated'], ips['count'],
+    )
+
+
+def fetch_pop_context(pop_device):
+    # Número constante de queries: interfaces, tags e IPs via prefetch
+    interfaces_with_tags = Interface.objects.filter(
+        device=pop_device, tags__isnull=False
+    ).distinct().prefetch_related('tags', 'ip_addresses')
+
+    local_context_dict = {
+        "pop_device_name": pop_device.name,
+        "pop_device_role": pop_device.device_role.name,
+        "interfaces": []
+    }
+
+    for interface in interfaces_with_tags:
+        local_context_dict["interfaces"].append({
+            "interface_name": interface.name,
+            "tags": ', '.join([tag.name for tag in interface.tags.all()]),
+            "ips": [str(ip) for ip in interface.ip_addresses.all()]
+        })
+
+    return local_context_dict
+
+
+def fetch_pop_contexts(pop_devices):
+    # Contexto de vários POPs com as mesmas três queries de um só, para os
+    # planos das simulações; pop_devices precisam vir com o device_role
+    contexts = {
+        pop_device.pk: {
+            "pop_device_name": pop_device.name,
+            "pop_device_role": pop_device.device_role.name,
+            "interfaces": []
+        }
+        for pop_device in pop_devices
+    }
+    interfaces_with_tags = Interface.objects.filter(
+        device__in=list(contexts), tags__isnull=False
+    ).distinct().prefetch_related('tags', 'ip_addresses')
+
+    for interface in interfaces_with_tags:
+        contexts[interface.device_id]["interfaces"].append({
+            "interface_name": interface.name,
+            "tags": ', '.join([tag.name for tag in interface.tags.all()]),
+            "ips": [str(ip) for ip in interface.ip_addresses.all()]
+        })
+
+    return contexts
+
+
+def build_pop_context(pop_device, use_cache=True):
+    if not use_cache:
+        return fetch_pop_context(pop_device)
+
+    version = hashlib.sha1(repr(pop_context_version(pop_device)).encode()).hexdigest()
+    key = f"{CACHE_PREFIX}:{_generation()}:{pop_device.pk}:{version}"
+    # O cache devolve uma cópia nova a cada leitura
+    local_context_dict = cache.get(key)
+    if local_context_dict is not None:
+        with _lock:
+            stats["hits"] += 1
+        return local_context_dict
+
+    local_context_dict = fetch_pop_context(pop_device)
+    with _lock:
+        stats["misses"] += 1
+    # Versões antigas do mesmo POP só expiram: a chave nova nunca as lê
+    cache.set(key, local_context_dict, timeout=CACHE_TTL)
+    return local_context_dict
+
+
+def _generation():
+    return cache.get_or_set(f"{CACHE_PREFIX}:generation", 0, timeout=None)
+
+
+def clear_cache():
+    # Uma geração nova descarta as entradas de todos os processos
+    cache.set(f"{CACHE_PREFIX}:generation", _generation() + 1, timeout=None)
+    with _lock:
+        _shared.clear()
+
+
+def shared_context_name(pop_device):
+    return f"{SHARED_CONTEXT_PREFIX}{pop_device.pk}"
+
+
+def shared_reference(pop_device):
+    # Tudo o que fica no local_context_data do CPE no modo compartilhado
+    return {"pop_device_name": pop_device.name, "pop_context": shared_context_name(pop_device)}
+
+
+def sync_shared_context(pop_device, local_context=None, commit=True):
+    # Cria ou atualiza o ConfigContext e a tag do POP; devolve os dois.
+    # Memoizado por POP: sem mudança no contexto não há nenhuma query
+    if local_context is None:
+        local_context = build_pop_context(pop_device)
+    with _lock:
+        cached = _shared.get(pop_device.pk)
+    if cached and cached[0] == local_context:
+        return cached[1], cached[2]
+
+    name = shared_context_name(pop_device)
+    tag = Tag.objects.filter(slug=name).first()
+    if tag is None:
+        tag = Tag(name=name, slug=name, description=f"Shared context of POP {pop_device.name}")
+        if commit:
+            tag.save()
+
+    config_context = ConfigContext.objects.filter(name=name).first()
+    if config_context is None:
+        config_context = ConfigContext(
+            name=name,
+            description=f"Shared context of POP {pop_device.name}",
+            data=local_context
+        )
+        if commit:
+            config_context.save()
+            config_context.tags.add(tag)
+    elif config_context.data != local_context:
+        config_context.data = local_context
+        if commit:
+            config_context.save()
+
+    if commit:
+        # Só memoiza o que de fato foi gravado
+        entry = (copy.deepcopy(local_context), config_context, tag)
+        transaction.on_commit(lambda: _remember_shared(pop_device.pk, entry))
+    return config_context, tag
+
+
+def _remember_shared(pop_id, entry):
+    with _lock:
+        _shared[pop_id] = entry
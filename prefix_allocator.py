@@ -0,0 +1,94 @@
+from django.db import transaction
+from netaddr import IPAddress as NetAddress, IPNetwork
+from ipam.models import IPAddress, Prefix
+
+# Alocador de pares ponto-a-ponto (/30 ou /31) para túneis device <-> POP.
+# Os endereços já usados dentro do prefixo pai são carregados com uma única
+# query, assim como os prefixos filhos já alocados (ocupados inteiros), e
+# convertidos em uma free-list de intervalos; cada alocação pega o primeiro
+# bloco alinhado livre e recorta o intervalo, sem varrer IPAddress.
+
+
+class TunnelPool:
+
+    def __init__(self, parent, used=(), prefix_length=30, used_networks=()):
+        self.parent = IPNetwork(str(parent))
+        self.prefix_length = prefix_length
+        self.size = 2 ** ((32 if self.parent.version == 4 else 128) - prefix_length)
+        if prefix_length < self.parent.prefixlen:
+            raise ValueError(f"/{prefix_length} does not fit in {self.parent}")
+
+        # /30 (ou maior) usa os dois primeiros hosts; /31 e /127 usam os dois endereços
+        self.offsets = (1, 2) if self.size >= 4 else (0, 1)
+
+        # Free-list: intervalos [início, fim] livres, ordenados e sem sobreposição
+        first, last = self.parent.first, self.parent.last
+        taken = [(int(address), int(address)) for address in used]
+        taken += [(IPNetwork(str(network)).first, IPNetwork(str(network)).last) for network in used_networks]
+        self.free = []
+        start = first
+        for taken_first, taken_last in sorted(taken):
+            if taken_last < start or taken_first > last:
+                continue
+            if taken_first > start:
+                self.free.append([start, taken_first - 1])
+            start = taken_last + 1
+        if start <= last:
+            self.free.append([start, last])
+        self._cursor = 0
+
+    @classmethod
+    def load(cls, prefix, prefix_length=30):
+        # prefix: ipam.Prefix; uma query para os IPs e uma para os prefixos
+        # filhos dentro dele (na mesma VRF)
+        addresses = IPAddress.objects.filter(
+            vrf=prefix.vrf,
+            address__net_host_contained=str(prefix.prefix)
+        ).values_list('address', flat=True)
+        children = Prefix.objects.filter(
+            vrf=prefix.vrf,
+            prefix__net_contained=str(prefix.prefix)
+        ).values_list('prefix', flat=True)
+        return cls(prefix.prefix, [address.ip for address in addresses], prefix_length, used_networks=children)
+
+    def _take(self):
+        # Intervalos antes do cursor já se mostraram pequenos demais e a
+        # free-list só encolhe, então a busca continua de onde parou
+        for index in range(self._cursor, len(self.free)):
+            start, end = self.free[index]
+            # Primeiro bloco alinhado dentro do intervalo livre
+            block = start + (-(start - self.parent.first)) % self.size
+            if block + self.size - 1 > end:
+                continue
+            remainder = []
+            if block > start:
+                remainder.append([start, block - 1])
+            if block + self.size <= end:
+                remainder.append([block + self.size, end])
+            self.free[index:index + 1] = remainder
+            self._cursor = index
+            return block
+        self._cursor = len(self.free)
+        return None
+
+    def allocate(self):
+        block = self._take()
+        if block is None:
+            raise ValueError(f"No free /{self.prefix_length} left in {self.parent}")
+        version = self.parent.version
+        return tuple(
+            f"{NetAddress(block + offset, version)}/{self.prefix_length}"
+            for offset in self.offsets
+        )
+
+    def allocate_many(self, count):
+        return [self.allocate() for _ in range(count)]
+
+
+def allocate_tunnel_pairs(prefix, count=1, prefix_length=30, lock=True):
+    # Com lock=True o prefixo pai fica travado até o fim da transação externa,
+    # então duas execuções concorrentes não recebem o mesmo par
+    with transaction.atomic():
+        if lock:
+            Prefix.objects.select_for_update().filter(pk=prefix.pk).first()
+        return TunnelPool.load(prefix, prefix_length).allocate_many(count)
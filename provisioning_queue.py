@@ -0,0 +1,358 @@
+import json
+import os
+import time
+import uuid
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+from django_rq import get_connection, get_queue
+from dcim.choices import DeviceStatusChoices
+from dcim.models import Device, DeviceRole, DeviceType, Site
+from ipam.models import Prefix, VLAN
+from extras.models import ConfigTemplate, Tag
+from interface_provisioning import SOLUTION_INTERFACES, apply_plan, plan_interfaces
+from prefix_allocator import allocate_tunnel_pairs
+from pop_context import build_pop_context, shared_reference, sync_shared_context
+from webhook_outbox import WebhookOutbox
+
+# Fila de provisionamento agrupada por POP. Os scripts gravam o pedido
+# (apenas ids) em uma lista do Redis por POP e o primeiro pedido de uma
+# janela agenda um job no RQ para daqui a COALESCE_SECONDS. O job drena
+# tudo o que chegou para aquele POP e aplica em uma única transação, sob um
+# advisory lock do PostgreSQL por POP: uma checagem de existência para o
+# lote inteiro e nenhuma corrida entre operadores. POPs diferentes rodam em
+# paralelo em workers diferentes. Um pedido que falha é desfeito no seu
+# savepoint e marcado como failed, sem derrubar os demais pedidos do lote.
+
+COALESCE_SECONDS = float(os.environ.get("NETBOX_PROVISIONING_COALESCE", "3"))
+QUEUE_NAME = "default"
+KEY_PREFIX = "provisioning"
+RESULT_TTL = 24 * 3600
+# Últimos lotes guardados para as métricas
+BATCH_HISTORY = 1000
+# Primeiro argumento do pg_advisory_xact_lock(int, int): separa estes locks
+# de outros advisory locks do banco
+LOCK_NAMESPACE = 7001
+
+
+def _pending_key(pop_id):
+    return f"{KEY_PREFIX}:pop:{pop_id}"
+
+
+def _scheduled_key(pop_id):
+    return f"{KEY_PREFIX}:scheduled:{pop_id}"
+
+
+def _result_key(request_id):
+    return f"{KEY_PREFIX}:result:{request_id}"
+
+
+def lock_pop(pop_id):
+    # Vale até o fim da transação atual
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [LOCK_NAMESPACE, pop_id])
+
+
+def submit(kind, pop_id, payload):
+    # Enfileira um pedido e devolve o id; o lote do POP roda após a janela.
+    # O pedido só chega ao Redis no commit da transação do script: um script
+    # revertido não deixa pedido na fila, e o job nunca lê linhas ainda não gravadas
+    request_id = uuid.uuid4().hex
+    item = json.dumps({
+        "id": request_id,
+        "kind": kind,
+        "payload": payload,
+        "submitted_at": time.time(),
+    })
+
+    def push():
+        redis = get_connection(QUEUE_NAME)
+        redis.rpush(_pending_key(pop_id), item)
+        redis.setex(_result_key(request_id), RESULT_TTL, json.dumps({"status": "queued", "pop_id": pop_id}))
+        # Só o primeiro pedido da janela agenda o job do POP
+        if redis.set(_scheduled_key(pop_id), request_id, nx=True, ex=int(COALESCE_SECONDS * 10) + 60):
+            get_queue(QUEUE_NAME).enqueue_in(timedelta(seconds=COALESCE_SECONDS), process_pop, pop_id)
+
+    transaction.on_commit(push)
+    return request_id
+
+
+def submit_interfaces(request, serial_number=None, tunnel_prefix=None, tunnel_prefix_length=30):
+    # request no formato do CreateInterfaceScript, já com a VLAN resolvida. Os
+    # IPs de túnel saem de tunnel_prefix dentro do lote, sob o lock do prefixo
+    pop_device = request.get("pop_device")
+    payload = {
+        "device": request["device"].pk,
+        "pop_device": pop_device.pk if pop_device else None,
+        "solution": request["solution"],
+        "manual_ip": request.get("manual_ip"),
+        "pop_manual_ip": request.get("pop_manual_ip"),
+        "vlan": request["vlan"].pk if request.get("vlan") else None,
+        "serial_number": serial_number,
+        "tunnel_prefix": tunnel_prefix.pk if tunnel_prefix else None,
+        "tunnel_prefix_length": tunnel_prefix_length,
+    }
+    return submit("interfaces", pop_device.pk if pop_device else request["device"].pk, payload)
+
+
+def submit_device(pop_device, device, tag=None, shared=False, webhook_url=None):
+    # device: Device ainda não salvo, montado pelo script de criação
+    payload = {
+        "name": device.name,
+        "site": device.site_id,
+        "device_type": device.device_type_id,
+        "device_role": device.device_role_id,
+        "config_template": device.config_template_id,
+        "custom_field_data": device.custom_field_data,
+        "tag": tag.pk if tag else None,
+        "shared": shared,
+        "webhook_url": webhook_url,
+    }
+    return submit("device", pop_device.pk, payload)
+
+
+def get_result(request_id):
+    value = get_connection(QUEUE_NAME).get(_result_key(request_id))
+    return json.loads(value) if value else None
+
+
+def _drain(pop_id):
+    redis = get_connection(QUEUE_NAME)
+    # Libera o agendamento antes de drenar: um pedido que chegar agora agenda
+    # um novo job em vez de ficar esquecido na lista
+    redis.delete(_scheduled_key(pop_id))
+    pipeline = redis.pipeline()
+    pipeline.lrange(_pending_key(pop_id), 0, -1)
+    pipeline.delete(_pending_key(pop_id))
+    items, _ = pipeline.execute()
+    return [json.loads(item) for item in items]
+
+
+def process_pop(pop_id):
+    # Job do RQ: aplica em lote tudo o que chegou para o POP
+    requests = _drain(pop_id)
+    if not requests:
+        return None
+    started = time.monotonic()
+    results = {}
+    try:
+        with transaction.atomic():
+            lock_pop(pop_id)
+            interfaces = [request for request in requests if request["kind"] == "interfaces"]
+            devices = [request for request in requests if request["kind"] == "device"]
+            if interfaces:
+                results.update(_apply_interfaces(interfaces))
+            if devices:
+                results.update(_apply_devices(pop_id, devices))
+    except Exception as e:
+        results = {request["id"]: {"status": "failed", "messages": [f"Batch failed: {e}"]} for request in requests}
+
+    elapsed = time.monotonic() - started
+    redis = get_connection(QUEUE_NAME)
+    pipeline = redis.pipeline()
+    for request in requests:
+        result = results.get(request["id"], {"status": "failed", "messages": ["Unknown request kind"]})
+        result.update(pop_id=pop_id, batch_size=len(requests), finished_at=timezone.now().isoformat())
+        pipeline.setex(_result_key(request["id"]), RESULT_TTL, json.dumps(result))
+    pipeline.lpush(f"{KEY_PREFIX}:batches", json.dumps({
+        "pop_id": pop_id,
+        "size": len(requests),
+        "seconds": round(elapsed, 3),
+        "wait_seconds": round(time.time() - min(request["submitted_at"] for request in requests), 3),
+        "at": timezone.now().isoformat(),
+    }))
+    pipeline.ltrim(f"{KEY_PREFIX}:batches", 0, BATCH_HISTORY - 1)
+    pipeline.execute()
+    return {"pop_id": pop_id, "requests": len(requests), "seconds": elapsed}
+
+
+def _apply_interfaces(requests):
+    # Os mesmos passos do CreateInterfaceScript, com uma única checagem de
+    # nomes existentes para o lote inteiro (já sob o lock do POP)
+    payloads = [request["payload"] for request in requests]
+    devices = Device.objects.select_related('site').in_bulk(
+        {payload["device"] for payload in payloads} | {payload["pop_device"] for payload in payloads if payload["pop_device"]}
+    )
+    vlans = VLAN.objects.in_bulk({payload["vlan"] for payload in payloads if payload["vlan"]})
+
+    plan_requests = []
+    failed = {}
+    for request, payload in zip(requests, payloads):
+        # O device pode ter sido apagado enquanto o pedido esperava na fila
+        if payload["device"] not in devices or (payload["pop_device"] and payload["pop_device"] not in devices):
+            failed[request["id"]] = "The device or the POP device no longer exists."
+            continue
+        plan_requests.append({
+            "id": request["id"],
+            "device": devices[payload["device"]],
+            "pop_device": devices.get(payload["pop_device"]),
+            "solution": payload["solution"],
+            "manual_ip": payload["manual_ip"],
+            "pop_manual_ip": payload["pop_manual_ip"],
+            "vlan": vlans.get(payload["vlan"]),
+            "serial_number": payload["serial_number"],
+            "tunnel_prefix": payload.get("tunnel_prefix"),
+            "tunnel_prefix_length": payload.get("tunnel_prefix_length"),
+        })
+    failed.update(_allocate_tunnel_ips(plan_requests))
+    plan_requests = [request for request in plan_requests if request["id"] not in failed]
+
+    # Conflitos com o banco e dentro do lote saem da mesma checagem; o
+    # apply_plan roda em um savepoint, então um erro desfaz só esta tentativa
+    try:
+        items = plan_interfaces(plan_requests)
+        apply_plan(items, _serials(plan_requests))
+    except Exception:
+        # Um pedido inválido não derruba o lote: cada pedido no seu savepoint
+        items = []
+        for request in plan_requests:
+            try:
+                request_items = plan_interfaces([request])
+                apply_plan(request_items, _serials([request]))
+            except Exception as e:
+                failed[request["id"]] = f"Failed to create interfaces: {e}"
+                continue
+            items += request_items
+
+    results = {request["id"]: {"status": "done", "messages": []} for request in requests}
+    for request_id, message in failed.items():
+        results[request_id] = {"status": "failed", "messages": [message]}
+    for item in items:
+        result = results[item["request"]["id"]]
+        if item["conflict"]:
+            result["status"] = "conflict"
+            result["messages"].append(item["conflict"])
+        else:
+            result["messages"].append(f"Interface '{item['name']}' created on device '{item['device'].name}'.")
+    return results
+
+
+def _serials(plan_requests):
+    return {request["device"].pk: request["serial_number"] for request in plan_requests if request["serial_number"]}
+
+
+def _allocate_tunnel_ips(plan_requests):
+    # Próximo par livre de cada prefixo para os pedidos sem IP manual, com o
+    # prefixo travado até o fim da transação do lote; devolve {id: erro}
+    pending = {}
+    for request in plan_requests:
+        if request["tunnel_prefix"] and not request["manual_ip"] and request["solution"] in SOLUTION_INTERFACES:
+            pending.setdefault((request["tunnel_prefix"], request["tunnel_prefix_length"]), []).append(request)
+    prefixes = Prefix.objects.in_bulk({prefix_id for prefix_id, _ in pending})
+
+    failed = {}
+    for (prefix_id, prefix_length), prefix_requests in pending.items():
+        prefix = prefixes.get(prefix_id)
+        try:
+            if prefix is None:
+                raise ValueError("prefix no longer exists")
+            pairs = allocate_tunnel_pairs(prefix, len(prefix_requests), prefix_length, lock=True)
+        except ValueError as e:
+            for request in prefix_requests:
+                failed[request["id"]] = f"Failed to allocate tunnel IPs from prefix '{prefix or prefix_id}': {str(e)}"
+            continue
+        for request, (device_ip, pop_ip) in zip(prefix_requests, pairs):
+            request["manual_ip"] = device_ip
+            if request["pop_device"] and not request["pop_manual_ip"]:
+                request["pop_manual_ip"] = pop_ip
+    return failed
+
+
+def _apply_devices(pop_id, requests):
+    # Um contexto do POP e uma checagem de existência para o lote inteiro
+    payloads = [request["payload"] for request in requests]
+    pop_device = Device.objects.select_related('device_role').get(pk=pop_id)
+    local_context = build_pop_context(pop_device)
+    sites = Site.objects.in_bulk({payload["site"] for payload in payloads})
+    device_types = DeviceType.objects.in_bulk({payload["device_type"] for payload in payloads})
+    roles = DeviceRole.objects.in_bulk({payload["device_role"] for payload in payloads})
+    tags = Tag.objects.in_bulk({payload["tag"] for payload in payloads if payload["tag"]})
+    config_templates = ConfigTemplate.objects.in_bulk({payload["config_template"] for payload in payloads if payload["config_template"]})
+    # Nome do Connectedto para o webhook, como no caminho direto do script
+    connected_to = Device.objects.in_bulk({
+        payload["custom_field_data"].get("Connectedto") for payload in payloads
+        if isinstance(payload["custom_field_data"].get("Connectedto"), int)
+    })
+    existing = set(
+        Device.objects.filter(name__in={payload["name"] for payload in payloads}).values_list('name', 'site_id')
+    )
+
+    # Fora dos savepoints dos pedidos: a tag do POP é compartilhada pelo lote
+    pop_tag = None
+    if any(payload["shared"] for payload in payloads):
+        _, pop_tag = sync_shared_context(pop_device, local_context)
+
+    results = {}
+    outboxes = {}
+    for request, payload in zip(requests, payloads):
+        key = (payload["name"], payload["site"])
+        if key in existing:
+            site = sites.get(payload["site"])
+            results[request["id"]] = {
+                "status": "conflict",
+                "messages": [f"A device with the name '{payload['name']}' already exists in site '{site.name if site else payload['site']}'"],
+            }
+            continue
+
+        # Cada pedido no seu savepoint: um erro desfaz só o device dele
+        try:
+            with transaction.atomic():
+                device = Device(
+                    name=payload["name"],
+                    device_type=device_types[payload["device_type"]],
+                    site=sites[payload["site"]],
+                    status=DeviceStatusChoices.STATUS_ACTIVE,
+                    device_role=roles[payload["device_role"]],
+                    local_context_data=shared_reference(pop_device) if payload["shared"] else local_context,
+                    custom_field_data=payload["custom_field_data"],
+                    config_template=config_templates.get(payload["config_template"])
+                )
+                device.save()
+                if payload["tag"]:
+                    device.tags.add(tags[payload["tag"]])
+                if payload["shared"]:
+                    device.tags.add(pop_tag)
+
+                if payload["webhook_url"]:
+                    url = payload["webhook_url"]
+                    if url not in outboxes:
+                        outboxes[url] = WebhookOutbox(url)
+                    connected = connected_to.get(payload["custom_field_data"].get("Connectedto"))
+                    outboxes[url].record(device, {
+                        "device_name": device.name,
+                        "site_name": device.site.name,
+                        "pop_device_name": pop_device.name,
+                        "local_context_data": local_context,
+                        "connected_to": connected.name if connected else None,
+                        "tags": tags[payload["tag"]].name if payload["tag"] else None,
+                    })
+        except Exception as e:
+            results[request["id"]] = {"status": "failed", "messages": [f"Failed to create device '{payload['name']}': {e}"]}
+            continue
+        existing.add(key)
+        results[request["id"]] = {
+            "status": "done",
+            "messages": [f"Created new device: {device.name} at site {device.site.name} with local context data from {pop_device.name}"],
+        }
+    return results
+
+
+def metrics():
+    # Profundidade da fila por POP e tamanho dos últimos lotes
+    redis = get_connection(QUEUE_NAME)
+    depth = {}
+    for key in redis.scan_iter(match=f"{KEY_PREFIX}:pop:*"):
+        key = key.decode() if isinstance(key, bytes) else key
+        depth[int(key.rsplit(":", 1)[1])] = redis.llen(key)
+    batches = [json.loads(batch) for batch in redis.lrange(f"{KEY_PREFIX}:batches", 0, BATCH_HISTORY - 1)]
+    sizes = sorted(batch["size"] for batch in batches)
+    return {
+        "depth": depth,
+        "queued": sum(depth.values()),
+        "batches": len(batches),
+        "batch_size_avg": round(sum(sizes) / len(sizes), 2) if sizes else 0,
+        "batch_size_p95": sizes[min(len(sizes) - 1, int(len(sizes) * 0.95))] if sizes else 0,
+        "batch_size_max": sizes[-1] if sizes else 0,
+        "recent": batches[:20],
+    }
@@ -0,0 +1,202 @@
+import copy
+import os
+import threading
+import time
+import uuid
+from functools import partial
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from dcim.models import DeviceRole, DeviceType, Site
+from extras.models import ConfigTemplate, Tag
+
+# Cache dos objetos de referência que quase nunca mudam (roles, device types,
+# tags, config templates, sites e content types). Cada model é carregado
+# inteiro com uma query e guardado no cache do Django (o Redis do NetBox),
+# então a carga é reaproveitada entre jobs e workers, mesmo com o RQ abrindo
+# um work-horse novo por job. As entradas expiram após TTL segundos.
+#
+# Cada model tem um contador de versão no cache, que faz parte da chave das
+# entradas: os sinais de save/delete trocam a versão no commit e todas as
+# cópias antigas deixam de ser lidas, em qualquer processo. Dentro do mesmo
+# job as tabelas ficam também em memória, conferidas contra a versão a cada
+# leitura (uma ida ao Redis em vez da tabela inteira).
+#
+# Uma transação que alterou o model lê direto do banco até o seu commit e
+# nunca grava no cache: linhas de uma transação revertida (toda simulação)
+# não chegam a outro job. get, lookup e attach devolvem cópias; as
+# instâncias do cache nunca saem daqui.
+
+TTL = float(os.environ.get("NETBOX_REFERENCE_CACHE_TTL", "300"))
+KEY_PREFIX = "reference_cache"
+
+# Model -> select_related usado ao carregar a tabela
+CACHED_MODELS = {
+    DeviceRole: ('config_template',),
+    DeviceType: ('manufacturer',),
+    Tag: (),
+    ConfigTemplate: (),
+    Site: (),
+}
+
+_entries = {}
+_lock = threading.Lock()
+# Models alterados pela transação ainda aberta desta thread
+_local = threading.local()
+stats = {}
+
+
+def _label(model):
+    return model._meta.label_lower
+
+
+def _version_key(label):
+    return f"{KEY_PREFIX}:{label}:version"
+
+
+def _version(label):
+    return cache.get_or_set(_version_key(label), uuid.uuid4().hex, timeout=None)
+
+
+def _changed():
+    # {label: expiração}; a entrada some no commit. Após um rollback o
+    # on_commit é descartado, então ela também expira após o TTL
+    if not hasattr(_local, 'changed'):
+        _local.changed = {}
+    return _local.changed
+
+
+def _changed_here(label):
+    changed = _changed()
+    if not transaction.get_connection().in_atomic_block:
+        changed.clear()
+        return False
+    expires = changed.get(label)
+    if expires is not None and expires <= time.monotonic():
+        del changed[label]
+        return False
+    return expires is not None
+
+
+def _get(label, key, loader):
+    with _lock:
+        counters = stats.setdefault(label, {"hits": 0, "misses": 0})
+    if _changed_here(label):
+        # Alterado nesta transação: o banco é a única fonte correta
+        with _lock:
+            counters["misses"] += 1
+        return loader()
+
+    version = _version(label)
+    with _lock:
+        entry = _entries.get((label, key))
+        if entry and entry[0] == version and entry[1] > time.monotonic():
+            counters["hits"] += 1
+            return entry[2]
+    cache_key = f"{KEY_PREFIX}:{label}:{version}:{key}"
+    value = cache.get(cache_key)
+    if value is None:
+        value = loader()
+        cache.set(cache_key, value, timeout=TTL)
+        with _lock:
+            counters["misses"] += 1
+    else:
+        with _lock:
+            counters["hits"] += 1
+    with _lock:
+        _entries[(label, key)] = (version, time.monotonic() + TTL, value)
+    return value
+
+
+def table(model):
+    # Todos os objetos do model: {pk: objeto}, as próprias instâncias do cache
+    if model not in CACHED_MODELS:
+        raise ValueError(f"{_label(model)} is not a cached reference model")
+    return _get(_label(model), '__all__', lambda: {
+        obj.pk: obj for obj in model.objects.select_related(*CACHED_MODELS[model])
+    })
+
+
+def get(model, pk):
+    # Equivalente a model.objects.get(pk=pk), sem query em cache quente
+    objects = table(model)
+    if pk not in objects:
+        # Pode ter sido criado depois da carga: recarrega uma vez
+        invalidate(model)
+        objects = table(model)
+    try:
+        return copy.deepcopy(objects[pk])
+    except KeyError:
+        raise model.DoesNotExist(f"{model._meta.object_name} {pk} does not exist")
+
+
+def lookup(model, values, fields=('name', 'slug'), reload=True):
+    # Mesmo contrato do lookup_by_names dos scripts: {valor: objeto} para
+    # qualquer um dos campos
+    values = {value for value in values if value}
+    objects = {}
+    for obj in table(model).values():
+        for field in fields:
+            value = getattr(obj, field)
+            if value in values:
+                objects.setdefault(value, obj)
+    if reload and not values.issubset(objects):
+        # Valor desconhecido: pode ter sido criado depois da carga
+        invalidate(model)
+        return lookup(model, values, fields, reload=False)
+    # Uma cópia por objeto, a mesma para o name e o slug
+    copies = {}
+    for value, obj in objects.items():
+        if obj.pk not in copies:
+            copies[obj.pk] = copy.deepcopy(obj)
+        objects[value] = copies[obj.pk]
+    return objects
+
+
+def content_type(model):
+    # O ContentTypeManager já tem um cache próprio; passar por aqui mantém
+    # os contadores no mesmo lugar
+    return _get('contenttypes.contenttype', _label(model), lambda: ContentType.objects.get_for_model(model))
+
+
+def attach(obj, field):
+    # Preenche uma FK de um objeto já carregado (p.ex. o device_role do POP
+    # vindo de um ObjectVar) a partir do cache, em vez de buscar o objeto de novo
+    descriptor = obj._meta.get_field(field)
+    if descriptor.is_cached(obj):
+        return getattr(obj, field)
+    pk = getattr(obj, descriptor.attname)
+    if pk is None:
+        return None
+    related = get(descriptor.related_model, pk)
+    setattr(obj, field, related)
+    return related
+
+
+def invalidate(model=None):
+    # Uma versão nova torna as entradas antigas inalcançáveis em todos os processos
+    labels = [_label(model)] if model is not None else [_label(model) for model in CACHED_MODELS]
+    cache.set_many({_version_key(label): uuid.uuid4().hex for label in labels}, timeout=None)
+    with _lock:
+        for key in [key for key in _entries if key[0] in labels]:
+            del _entries[key]
+
+
+def _committed(model):
+    _changed().pop(_label(model), None)
+    invalidate(model)
+
+
+def _model_changed(sender, **kwargs):
+    # Até o commit esta transação lê o model direto do banco; no commit a
+    # versão é trocada para todos
+    if transaction.get_connection().in_atomic_block:
+        _changed()[_label(sender)] = time.monotonic() + TTL
+    transaction.on_commit(partial(_committed, sender))
+
+
+for _model in CACHED_MODELS:
+    post_save.connect(_model_changed, sender=_model, dispatch_uid=f'reference_cache.{_label(_model)}.saved')
+    post_delete.connect(_model_changed, sender=_model, dispatch_uid=f'reference_cache.{_label(_model)}.deleted')
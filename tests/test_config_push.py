@@ -0,0 +1,205 @@
+import threading
+import time
+
+import pytest
+
+from config_push import RESULT_GLOBAL, ConfigPusher, NotSentError, RouterOSAPITransport, TransportError, wrap_script
+
+
+class FakeTransport:
+
+    def __init__(self, device):
+        self.device = device
+
+    def apply(self, text):
+        self.device.apply(text)
+
+    def close(self):
+        pass
+
+
+class FakeDevice:
+    # Cada conexão e cada envio consomem o próximo item do roteiro: None para
+    # sucesso ou uma exceção a ser levantada
+    def __init__(self, connect=(), apply=(), delay=0.0):
+        self.connect_steps = list(connect)
+        self.apply_steps = list(apply)
+        self.delay = delay
+        self.connects = 0
+        self.applied = []
+
+    def connect(self):
+        self.connects += 1
+        if self.connect_steps:
+            step = self.connect_steps.pop(0)
+            if step is not None:
+                raise step
+        return FakeTransport(self)
+
+    def apply(self, text):
+        if self.delay:
+            time.sleep(self.delay)
+        if self.apply_steps:
+            step = self.apply_steps.pop(0)
+            if step is not None:
+                raise step
+        self.applied.append(text)
+
+
+def make_pusher(devices, **kwargs):
+    kwargs.setdefault("retries", 2)
+    return ConfigPusher(connect=lambda host: devices[host].connect(), **kwargs)
+
+
+def job(host, pop="pop-1"):
+    return {"device_id": host, "name": host, "host": host, "pop": pop, "text": f"/system identity set name={host}"}
+
+
+def test_retries_connection_errors():
+    devices = {"cpe-1": FakeDevice(connect=[ConnectionRefusedError("refused"), None])}
+    pusher = make_pusher(devices)
+    results, stats = pusher.push([job("cpe-1")])
+    assert results[0]["status"] == "ok"
+    assert results[0]["attempts"] == 2
+    assert devices["cpe-1"].applied == ["/system identity set name=cpe-1"]
+    assert stats["ok"] == 1
+    pusher.close()
+
+
+def test_retries_failures_before_the_config_is_sent():
+    devices = {"cpe-1": FakeDevice(apply=[NotSentError("upload failed"), None])}
+    results, _ = make_pusher(devices).push([job("cpe-1")])
+    assert results[0]["status"] == "ok"
+    assert results[0]["attempts"] == 2
+    assert devices["cpe-1"].connects == 2
+
+
+def test_does_not_retry_a_config_that_started_running():
+    devices = {"cpe-1": FakeDevice(apply=[TransportError("config script failed on the device"), None])}
+    results, stats = make_pusher(devices).push([job("cpe-1")])
+    assert results[0]["status"] == "failed"
+    assert results[0]["attempts"] == 1
+    assert results[0]["error"] == "config script failed on the device"
+    assert devices["cpe-1"].applied == []
+    assert stats["failed"] == 1
+
+
+def test_fails_after_retries_are_exhausted():
+    devices = {"cpe-1": FakeDevice(connect=[OSError("timed out")] * 5)}
+    results, _ = make_pusher(devices, retries=2).push([job("cpe-1")])
+    assert results[0]["status"] == "failed"
+    assert results[0]["attempts"] == 3
+    assert "timed out" in results[0]["error"]
+
+
+def test_reuses_sessions_and_drops_failed_ones():
+    devices = {"cpe-1": FakeDevice(apply=[None, TransportError("boom"), None])}
+    pusher = make_pusher(devices)
+    for _ in range(3):
+        pusher.push([job("cpe-1")])
+    # Segunda execução reaproveita a sessão; a que falhou é descartada
+    assert devices["cpe-1"].connects == 2
+    pusher.close()
+
+
+def test_limits_concurrent_pushes_per_pop():
+    active = {}
+    peak = {}
+    lock = threading.Lock()
+
+    class CountingDevice(FakeDevice):
+        def apply(self, text):
+            pop = self.pop
+            with lock:
+                active[pop] = active.get(pop, 0) + 1
+                peak[pop] = max(peak.get(pop, 0), active[pop])
+            time.sleep(0.02)
+            with lock:
+                active[pop] -= 1
+
+    devices = {}
+    jobs = []
+    for pop in ("pop-1", "pop-2"):
+        for index in range(6):
+            host = f"{pop}-cpe-{index}"
+            devices[host] = CountingDevice()
+            devices[host].pop = pop
+            jobs.append(job(host, pop))
+    results, stats = make_pusher(devices, workers=8, pop_concurrency=2).push(jobs)
+    assert stats["ok"] == 12
+    assert peak == {"pop-1": 2, "pop-2": 2}
+
+
+class FakePath:
+
+    def __init__(self, api, name):
+        self.api = api
+        self.name = name
+
+    def __iter__(self):
+        return iter(list(self.api.items[self.name].values()))
+
+    def add(self, **fields):
+        item_id = f"*{len(self.api.items[self.name]) + 1}"
+        self.api.items[self.name][item_id] = dict(fields, **{'.id': item_id})
+        return item_id
+
+    def remove(self, item_id):
+        del self.api.items[self.name][item_id]
+
+    def __call__(self, command, **kwargs):
+        # /system/script/run: o RouterOS só registra a variável global
+        assert command == 'run'
+        if self.api.run_error:
+            raise self.api.run_error
+        if self.api.outcome is not None:
+            self.api.items['environment']['*env'] = {'.id': '*env', 'name': RESULT_GLOBAL, 'value': self.api.outcome}
+        return iter(())
+
+
+class FakeAPI:
+
+    def __init__(self, outcome="ok", run_error=None, fail_on_path=False):
+        self.items = {'script': {}, 'environment': {}}
+        self.outcome = outcome
+        self.run_error = run_error
+        self.fail_on_path = fail_on_path
+
+    def path(self, *path):
+        if self.fail_on_path:
+            raise ConnectionResetError("connection reset")
+        return FakePath(self, 'environment' if path[-1] == 'environment' else 'script')
+
+
+def api_transport(api):
+    transport = RouterOSAPITransport.__new__(RouterOSAPITransport)
+    transport.api = api
+    return transport
+
+
+def test_api_transport_wraps_the_config_and_cleans_up():
+    api = FakeAPI(outcome="ok")
+    api_transport(api).apply("/system identity set name=cpe-1")
+    assert api.items == {'script': {}, 'environment': {}}
+    wrapped = wrap_script("/system identity set name=cpe-1")
+    assert wrapped.startswith(f':global {RESULT_GLOBAL} "running"')
+    assert "on-error=" in wrapped
+
+
+@pytest.mark.parametrize("outcome, message", [
+    ("failed", "config script failed on the device"),
+    ("running", "config script did not finish"),
+    (None, "config script did not finish"),
+])
+def test_api_transport_reports_script_errors(outcome, message):
+    api = FakeAPI(outcome=outcome)
+    with pytest.raises(TransportError) as error:
+        api_transport(api).apply("/bad command")
+    assert not isinstance(error.value, NotSentError)
+    assert str(error.value) == message
+    assert api.items['script'] == {}
+
+
+def test_api_transport_failures_before_run_are_retryable():
+    with pytest.raises(NotSentError):
+        api_transport(FakeAPI(fail_on_path=True)).apply("/system identity set name=cpe-1")
@@ -0,0 +1,92 @@
+import pytest
+
+from firewall_compiler import MAX_PORTS, aggregate_address_list, compile_file, compile_rules, merge_port_drops
+
+
+def drop(port, key="port", chain="input", protocol="tcp", comment=None):
+    rule = {"chain": chain, "protocol": protocol, key: str(port), "action": "drop"}
+    if comment:
+        rule["comment"] = comment
+    return rule
+
+
+def test_merges_single_port_drops_of_the_same_chain():
+    merged = merge_port_drops([drop(23, comment="Telnet"), drop(21, comment="FTP"), drop(23)])
+    assert merged == [
+        {"chain": "input", "protocol": "tcp", "port": "23,21", "action": "drop", "comment": "Telnet; FTP"},
+    ]
+
+
+def test_keeps_rules_that_differ_apart():
+    rules = [drop(23), drop(53, protocol="udp"), drop(80, key="dst-port"), drop(25, chain="forward")]
+    assert merge_port_drops(rules) == rules
+
+
+def test_does_not_merge_across_other_actions():
+    accept = {"chain": "input", "connection-state": "established,related", "action": "accept"}
+    merged = merge_port_drops([drop(23), accept, drop(21)])
+    assert merged == [drop(23), accept, drop(21)]
+
+
+def test_leaves_port_lists_and_ranges_alone():
+    rules = [drop("20,21"), drop(23)]
+    assert merge_port_drops(rules) == rules
+
+
+def test_splits_merged_ports_at_the_routeros_limit():
+    merged = merge_port_drops([drop(port) for port in range(1000, 1000 + MAX_PORTS + 2)])
+    assert [len(rule["port"].split(",")) for rule in merged] == [MAX_PORTS, 2]
+
+
+@pytest.mark.parametrize("addresses, expected", [
+    (["10.0.0.0/25", "10.0.0.128/25"], ["10.0.0.0/24"]),
+    (["10.0.0.0-10.0.0.255"], ["10.0.0.0/24"]),
+    (["10.0.1.0/24", "10.0.1.7"], ["10.0.1.0/24"]),
+    (["192.0.2.1/32"], ["192.0.2.1"]),
+    (["2001:db8::/33", "2001:db8:8000::/33", "10.0.0.0/24"], ["10.0.0.0/24", "2001:db8::/32"]),
+])
+def test_aggregates_cidrs_of_each_list(addresses, expected):
+    aggregated = aggregate_address_list([{"list": "blocked", "address": addresses, "comment": "Blocked"}])
+    assert [entry["address"] for entry in aggregated] == expected
+    assert all(entry == {"list": "blocked", "address": entry["address"], "comment": "Blocked"} for entry in aggregated)
+
+
+def test_keeps_lists_apart_and_leaves_names_and_extra_options_as_is():
+    entries = [
+        {"list": "a", "address": "10.0.0.0/25"},
+        {"list": "b", "address": "10.0.0.128/25"},
+        {"list": "a", "address": "example.com"},
+        {"list": "a", "address": "10.0.0.128/25", "timeout": "1d"},
+    ]
+    assert aggregate_address_list(entries) == [
+        {"list": "a", "address": "10.0.0.0/25"},
+        {"list": "b", "address": "10.0.0.128/25"},
+        {"list": "a", "address": "example.com"},
+        {"list": "a", "address": "10.0.0.128/25", "timeout": "1d"},
+    ]
+
+
+def test_compiles_the_yaml_into_routeros_commands():
+    compiled = compile_rules("""
+firewall:
+  filter:
+    - {chain: input, protocol: tcp, port: 23, action: drop, comment: Telnet}
+    - {chain: input, protocol: tcp, port: 21, action: drop, comment: FTP}
+    - {chain: input, connection-state: [established, related], action: accept}
+  address-list:
+    - {list: blocked, address: [10.0.0.0/25, 10.0.0.128/25]}
+""")
+    assert compiled.commands.splitlines() == [
+        "/ip firewall address-list",
+        "add list=blocked address=10.0.0.0/24",
+        "/ip firewall filter",
+        'add chain=input protocol=tcp port=23,21 action=drop comment="Telnet; FTP"',
+        "add chain=input connection-state=established,related action=accept",
+    ]
+    assert compiled.stats == {"filter_rules": (3, 2), "address_list_entries": (2, 1)}
+
+
+def test_compiles_the_repository_rules():
+    compiled = compile_file()
+    assert compiled is compile_file()
+    assert 'port=23,21 action=drop' in compiled.commands
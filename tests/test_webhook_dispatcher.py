@@ -0,0 +1,132 @@
+import threading
+
+import requests
+
+from webhook_dispatcher import WebhookDispatcher
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, text=""):
+        self.status_code = status_code
+        self.text = text
+
+
+class FakeSession:
+    # Responde cada POST com o próximo item do roteiro da URL: um status HTTP
+    # ou uma exceção a ser levantada
+    def __init__(self, script=None, default=200):
+        self.script = {url: list(steps) for url, steps in (script or {}).items()}
+        self.default = default
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        with self._lock:
+            self.calls.append((url, json, headers))
+            steps = self.script.get(url)
+            step = steps.pop(0) if steps else self.default
+        if isinstance(step, Exception):
+            raise step
+        return FakeResponse(step, f"status {step}")
+
+    def close(self):
+        pass
+
+
+def make_dispatcher(session, **kwargs):
+    kwargs.setdefault("backoff", 0.001)
+    kwargs.setdefault("max_backoff", 0.01)
+    return WebhookDispatcher(session=session, **kwargs)
+
+
+def run(dispatcher, events, timeout=5):
+    for event in events:
+        dispatcher.submit(event)
+    assert dispatcher.flush(timeout)
+    try:
+        return dispatcher.drain_results()
+    finally:
+        dispatcher.close(timeout)
+
+
+def test_delivers_on_first_attempt():
+    session = FakeSession()
+    delivered, dead_letter = run(make_dispatcher(session), [
+        {"id": index, "url": "http://hook/a", "payload": {"n": index}} for index in range(5)
+    ])
+    assert sorted(event["id"] for event in delivered) == list(range(5))
+    assert dead_letter == []
+    assert len(session.calls) == 5
+    assert all(event["attempts"] == 1 for event in delivered)
+
+
+def test_retries_retryable_status_and_connection_errors():
+    session = FakeSession({"http://hook/a": [503, requests.ConnectionError("refused"), 200]})
+    dispatcher = make_dispatcher(session, max_attempts=5)
+    delivered, dead_letter = run(dispatcher, [{"id": 1, "url": "http://hook/a", "payload": {}}])
+    assert [event["id"] for event in delivered] == [1]
+    assert delivered[0]["attempts"] == 3
+    assert dead_letter == []
+    metrics = dispatcher.metrics()
+    assert metrics["retried"] == 2
+    assert metrics["failed_attempts"] == 2
+
+
+def test_dead_letters_after_max_attempts():
+    session = FakeSession({"http://hook/a": [500] * 10})
+    dispatcher = make_dispatcher(session, max_attempts=3)
+    delivered, dead_letter = run(dispatcher, [{"id": 7, "url": "http://hook/a", "payload": {}}])
+    assert delivered == []
+    assert [event["id"] for event in dead_letter] == [7]
+    assert dead_letter[0]["attempts"] == 3
+    assert dead_letter[0]["last_error"].startswith("500")
+    assert len(session.calls) == 3
+    assert dispatcher.metrics()["dead_lettered"] == 1
+
+
+def test_non_retryable_status_goes_straight_to_dead_letter():
+    session = FakeSession({"http://hook/a": [400]})
+    delivered, dead_letter = run(make_dispatcher(session, max_attempts=5), [
+        {"id": 1, "url": "http://hook/a", "payload": {}}
+    ])
+    assert delivered == []
+    assert dead_letter[0]["attempts"] == 1
+    assert len(session.calls) == 1
+
+
+def test_batches_events_per_url():
+    session = FakeSession()
+    dispatcher = make_dispatcher(session, batch_size=10, max_workers=1)
+    # Segura o loop até todos os eventos estarem na fila
+    with dispatcher._condition:
+        for index in range(4):
+            dispatcher.submit({"id": index, "url": f"http://hook/{index % 2}", "payload": {"n": index}})
+    delivered, dead_letter = run(dispatcher, [])
+    assert sorted(event["id"] for event in delivered) == [0, 1, 2, 3]
+    for url, body, headers in session.calls:
+        assert "events" in body
+        assert all(event["event_id"] % 2 == int(url[-1]) for event in body["events"])
+
+
+def test_drain_results_by_id_keeps_other_results():
+    session = FakeSession()
+    dispatcher = make_dispatcher(session)
+    for index in range(3):
+        dispatcher.submit({"id": index, "url": "http://hook/a", "payload": {}})
+    assert dispatcher.flush(5)
+    delivered, _ = dispatcher.drain_results(ids=[1])
+    assert [event["id"] for event in delivered] == [1]
+    rest, _ = dispatcher.drain_results()
+    assert sorted(event["id"] for event in rest) == [0, 2]
+    dispatcher.close(5)
+
+
+def test_flush_times_out_while_retries_are_pending():
+    session = FakeSession({"http://hook/a": [503] * 10})
+    dispatcher = make_dispatcher(session, backoff=10, max_backoff=10, max_attempts=5)
+    dispatcher.submit({"id": 1, "url": "http://hook/a", "payload": {}})
+    assert dispatcher.flush(0.2) is False
+    assert dispatcher.metrics()["retry_depth"] == 1
+    assert dispatcher.drain_results() == ([], [])
+    dispatcher.close(0)
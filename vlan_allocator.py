@@ -0,0 +1,265 @@
+import threading
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from dcim.models import Site
+from ipam.models import VLAN, VLANGroup
+
+# Alocador de VIDs por site ou VLAN group. Cada escopo tem um bitmap de 4094
+# bits (um int do Python) montado com uma única query e atualizado
+# incrementalmente pelos sinais de VLAN. A próxima VID livre ou um bloco
+# contíguo saem de operações de bits sobre o bitmap, sem varrer VLANs.
+#
+# Entre workers diferentes a alocação é serializada com SELECT FOR UPDATE na
+# linha do site/grupo, e as VIDs escolhidas são reconfirmadas no banco antes
+# de criar as VLANs. O bitmap só é atualizado no commit da transação.
+
+VID_MIN = 1
+VID_MAX = 4094
+
+_bitmaps = {}
+_lock = threading.RLock()
+
+
+class VIDBitmap:
+
+    def __init__(self, vids=(), min_vid=VID_MIN, max_vid=VID_MAX):
+        self.min_vid = min_vid
+        self.max_vid = max_vid
+        # Bits fora da faixa permitida ficam marcados como usados
+        self.bits = ((1 << min_vid) - 1) | ~((1 << (max_vid + 1)) - 1)
+        for vid in vids:
+            self.mark(vid)
+
+    def copy(self):
+        bitmap = VIDBitmap(min_vid=self.min_vid, max_vid=self.max_vid)
+        bitmap.bits = self.bits
+        return bitmap
+
+    def is_used(self, vid):
+        return bool(self.bits >> vid & 1)
+
+    def mark(self, vid):
+        self.bits |= 1 << vid
+
+    def release(self, vid):
+        if self.min_vid <= vid <= self.max_vid:
+            self.bits &= ~(1 << vid)
+
+    def used_count(self):
+        return bin(self.bits & ((1 << (self.max_vid + 1)) - 1)).count('1') - self.min_vid
+
+    def next_free(self):
+        free = ~self.bits
+        if not free & ((1 << (self.max_vid + 1)) - 1):
+            return None
+        return (free & -free).bit_length() - 1
+
+    def next_block(self, size):
+        # Posição p onde os bits p..p+size-1 estão todos livres
+        runs = ~self.bits & ((1 << (self.max_vid + 1)) - 1)
+        step = 1
+        while step < size and runs:
+            shift = min(step, size - step)
+            runs &= runs >> shift
+            step += shift
+        if not runs:
+            return None
+        start = (runs & -runs).bit_length() - 1
+        return list(range(start, start + size))
+
+
+def _scope(site=None, group=None):
+    if group is not None:
+        return ('group', group.pk)
+    if site is not None:
+        return ('site', site.pk)
+    raise ValueError("A site or VLAN group is required")
+
+
+def _scopes_for(vlan):
+    scopes = []
+    if vlan.group_id:
+        scopes.append(('group', vlan.group_id))
+    if vlan.site_id:
+        scopes.append(('site', vlan.site_id))
+    return scopes
+
+
+def get_bitmap(site=None, group=None):
+    scope = _scope(site, group)
+    with _lock:
+        if scope in _bitmaps:
+            return _bitmaps[scope]
+
+    if group is not None:
+        vids = VLAN.objects.filter(group=group).values_list('vid', flat=True)
+        bitmap = VIDBitmap(
+            vids,
+            min_vid=getattr(group, 'min_vid', None) or VID_MIN,
+            max_vid=getattr(group, 'max_vid', None) or VID_MAX
+        )
+    else:
+        bitmap = VIDBitmap(VLAN.objects.filter(site=site).values_list('vid', flat=True))
+
+    with _lock:
+        return _bitmaps.setdefault(scope, bitmap)
+
+
+def _lock_scope(site=None, group=None):
+    # Serializa alocações concorrentes no mesmo escopo até o fim da transação
+    if group is not None:
+        VLANGroup.objects.select_for_update().filter(pk=group.pk).first()
+    else:
+        Site.objects.select_for_update().filter(pk=site.pk).first()
+
+
+def _taken(vids, site=None, group=None):
+    queryset = VLAN.objects.filter(group=group) if group is not None else VLAN.objects.filter(site=site)
+    return set(queryset.filter(vid__in=vids).values_list('vid', flat=True))
+
+
+def _mark_on_commit(scopes, vids, release=False):
+    # O bitmap do processo só reflete o que foi gravado: um rollback (inclusive
+    # o de toda simulação) não deixa VIDs presas até o worker reiniciar
+    def apply():
+        with _lock:
+            for scope in scopes:
+                bitmap = _bitmaps.get(scope)
+                if bitmap is None:
+                    continue
+                for vid in vids:
+                    if release:
+                        bitmap.release(vid)
+                    else:
+                        bitmap.mark(vid)
+    transaction.on_commit(apply)
+
+
+def allocate_vids(count=1, site=None, group=None, contiguous=False):
+    # Escolhe VIDs livres sem tocar no bitmap do processo; deve rodar dentro
+    # da transação que cria as VLANs para que o lock do escopo valha até o commit
+    with transaction.atomic():
+        _lock_scope(site, group)
+        with _lock:
+            # Cópia local: VIDs escolhidas ou ocupadas só valem para esta transação
+            local = get_bitmap(site, group).copy()
+        while True:
+            if contiguous:
+                vids = local.next_block(count)
+            else:
+                candidates = local.copy()
+                vids = []
+                for _ in range(count):
+                    vid = candidates.next_free()
+                    if vid is None:
+                        break
+                    candidates.mark(vid)
+                    vids.append(vid)
+                if len(vids) < count:
+                    vids = None
+            if not vids:
+                raise ValueError(f"No {'contiguous block of ' if contiguous else ''}{count} free VIDs left")
+
+            # Outro worker (ou esta mesma transação) pode ter criado VLANs
+            # depois que o bitmap foi montado
+            taken = _taken(vids, site, group)
+            if not taken:
+                return vids
+            for vid in taken:
+                local.mark(vid)
+
+
+def create_vlans(vids, site=None, group=None, name_template="VLAN {vid}", commit=True):
+    vlans = [
+        VLAN(name=name_template.format(vid=vid), vid=vid, site=site, group=group)
+        for vid in vids
+    ]
+    if commit:
+        # Mesma validação do save() pelo formulário; as VIDs já foram
+        # conferidas no escopo travado
+        for vlan in vlans:
+            vlan.full_clean(validate_unique=False)
+        with transaction.atomic():
+            VLAN.objects.bulk_create(vlans)
+            # O bulk_create não dispara sinais: change log e o bitmap (_vlan_saved)
+            for vlan in vlans:
+                post_save.send(sender=VLAN, instance=vlan, created=True, raw=False, using='default', update_fields=None)
+    return vlans
+
+
+def allocate_vlans(count=1, site=None, group=None, contiguous=False, name_template="VLAN {vid}", commit=True):
+    if not commit:
+        # Simulação: só consulta o bitmap, sem reservar
+        with _lock:
+            bitmap = get_bitmap(site, group)
+            if contiguous:
+                vids = bitmap.next_block(count) or []
+            else:
+                free = bitmap.copy()
+                vids = []
+                while len(vids) < count and free.next_free() is not None:
+                    vids.append(free.next_free())
+                    free.mark(vids[-1])
+        return create_vlans(vids, site, group, name_template, commit=False)
+
+    with transaction.atomic():
+        vids = allocate_vids(count, site, group, contiguous)
+        return create_vlans(vids, site, group, name_template, commit=True)
+
+
+def get_or_create_vlans(vids, site=None, group=None, name_template="VLAN {vid}", commit=True):
+    # Busca por vid dentro do escopo e cria apenas as que faltam, sob o lock do escopo
+    queryset = VLAN.objects.filter(group=group) if group is not None else VLAN.objects.filter(site=site)
+    with transaction.atomic():
+        if commit:
+            _lock_scope(site, group)
+        existing = {vlan.vid: vlan for vlan in queryset.filter(vid__in=vids)}
+        missing = [vid for vid in dict.fromkeys(vids) if vid not in existing]
+        created = create_vlans(missing, site, group, name_template, commit)
+    vlans = dict(existing)
+    vlans.update({vlan.vid: vlan for vlan in created})
+    return vlans, {vlan.vid for vlan in created}
+
+
+def invalidate(site=None, group=None):
+    with _lock:
+        if site is None and group is None:
+            _bitmaps.clear()
+        else:
+            _bitmaps.pop(_scope(site, group), None)
+
+
+def _vlan_pre_save(sender, instance, **kwargs):
+    # Guarda o escopo anterior: uma VLAN movida libera a VID no site/grupo antigo
+    instance._vlan_allocator_scopes = []
+    if instance.pk:
+        previous = VLAN.objects.filter(pk=instance.pk).values_list('group_id', 'site_id').first()
+        if previous:
+            instance._vlan_allocator_scopes = [
+                (kind, pk) for kind, pk in zip(('group', 'site'), previous) if pk
+            ]
+
+
+def _vlan_saved(sender, instance, created, **kwargs):
+    scopes = _scopes_for(instance)
+    if created:
+        _mark_on_commit(scopes, [instance.vid])
+        return
+    # A VID ou o escopo podem ter mudado: remontar os dois na próxima consulta
+    scopes += [scope for scope in getattr(instance, '_vlan_allocator_scopes', []) if scope not in scopes]
+
+    def invalidate_scopes():
+        with _lock:
+            for scope in scopes:
+                _bitmaps.pop(scope, None)
+    transaction.on_commit(invalidate_scopes)
+
+
+def _vlan_deleted(sender, instance, **kwargs):
+    _mark_on_commit(_scopes_for(instance), [instance.vid], release=True)
+
+
+pre_save.connect(_vlan_pre_save, sender=VLAN, dispatch_uid='vlan_allocator.vlan_pre_save')
+post_save.connect(_vlan_saved, sender=VLAN, dispatch_uid='vlan_allocator.vlan_saved')
+post_delete.connect(_vlan_deleted, sender=VLAN, dispatch_uid='vlan_allocator.vlan_deleted')
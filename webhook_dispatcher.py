@@ -0,0 +1,248 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Entregador de webhooks em background, sem dependência do Django para poder
+# ser testado contra um servidor HTTP local. Cada evento é um dict com
+# "id", "url" e "payload"; o resultado de cada entrega fica em delivered /
+# dead_letter até ser consumido com drain_results().
+
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+
+class WebhookDispatcher:
+
+    def __init__(self, max_workers=4, batch_size=1, max_attempts=5, backoff=0.5, max_backoff=30,
+                 timeout=(3.05, 10), pool_size=10, session=None):
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        # Sessão única com pool de conexões keep-alive compartilhado pelos workers
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+        self._queue = queue.Queue()
+        self._retries = []
+        self._sequence = itertools.count()
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='webhook')
+        self._condition = threading.Condition()
+        self._outstanding = 0
+        self._thread = None
+
+        self.delivered = []
+        self.dead_letter = []
+        self._metrics = {
+            "submitted": 0,
+            "delivered": 0,
+            "requests": 0,
+            "request_seconds": 0.0,
+            "failed_attempts": 0,
+            "retried": 0,
+            "dead_lettered": 0,
+        }
+        self._latencies = deque(maxlen=1000)
+        self._request_times = deque(maxlen=1000)
+        self._started_at = None
+
+    def start(self):
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name='webhook-dispatcher', daemon=True)
+                self._thread.start()
+        return self
+
+    def submit(self, event):
+        self.start()
+        event.setdefault("attempts", 0)
+        event.setdefault("submitted_at", time.monotonic())
+        with self._condition:
+            if self._started_at is None:
+                self._started_at = time.monotonic()
+            self._outstanding += 1
+            self._metrics["submitted"] += 1
+        self._queue.put(event)
+
+    def flush(self, timeout=None):
+        # Espera até todos os eventos submetidos serem entregues ou irem para o dead letter
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._outstanding:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
+        self.session.close()
+
+    def drain_results(self, ids=None):
+        # Sem ids consome todos os resultados; com ids apenas os desses eventos
+        with self._condition:
+            if ids is None:
+                delivered, self.delivered = self.delivered, []
+                dead_letter, self.dead_letter = self.dead_letter, []
+            else:
+                ids = set(ids)
+                delivered = [event for event in self.delivered if event["id"] in ids]
+                dead_letter = [event for event in self.dead_letter if event["id"] in ids]
+                self.delivered = [event for event in self.delivered if event["id"] not in ids]
+                self.dead_letter = [event for event in self.dead_letter if event["id"] not in ids]
+        return delivered, dead_letter
+
+    def metrics(self):
+        with self._condition:
+            metrics = dict(self._metrics)
+            latencies = sorted(self._latencies)
+            request_times = sorted(self._request_times)
+            metrics["queue_depth"] = self._queue.qsize()
+            metrics["retry_depth"] = len(self._retries)
+            metrics["outstanding"] = self._outstanding
+            elapsed = time.monotonic() - self._started_at if self._started_at else 0
+        metrics["request_seconds"] = round(metrics["request_seconds"], 4)
+        metrics["throughput_per_sec"] = round(metrics["delivered"] / elapsed, 2) if elapsed else 0.0
+        metrics["latency_p50_ms"] = _percentile(latencies, 50)
+        metrics["latency_p95_ms"] = _percentile(latencies, 95)
+        metrics["latency_max_ms"] = _percentile(latencies, 100)
+        metrics["request_p50_ms"] = _percentile(request_times, 50)
+        metrics["request_p95_ms"] = _percentile(request_times, 95)
+        return metrics
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            # Dormir até o próximo retry vencer ou chegar um evento novo
+            with self._condition:
+                wait = max(0, self._retries[0][0] - time.monotonic()) if self._retries else None
+            try:
+                event = self._queue.get(timeout=wait)
+            except queue.Empty:
+                event = _WAKEUP
+            if event is None:
+                break
+
+            ready = [] if event is _WAKEUP else [event]
+            with self._condition:
+                now = time.monotonic()
+                while self._retries and self._retries[0][0] <= now:
+                    ready.append(heapq.heappop(self._retries)[2])
+
+            # Juntar o que já está na fila até completar o lote
+            while len(ready) < self.batch_size:
+                try:
+                    event = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                if event is not _WAKEUP:
+                    ready.append(event)
+
+            for batch in self._batches(ready):
+                self._slots.acquire()
+                self._executor.submit(self._deliver, batch)
+
+    def _batches(self, events):
+        by_url = {}
+        for event in events:
+            by_url.setdefault(event["url"], []).append(event)
+        for events in by_url.values():
+            for start in range(0, len(events), self.batch_size):
+                yield events[start:start + self.batch_size]
+
+    def _deliver(self, batch):
+        try:
+            url = batch[0]["url"]
+            if self.batch_size > 1:
+                body = {"events": [dict(event["payload"], event_id=event["id"]) for event in batch]}
+            else:
+                body = batch[0]["payload"]
+            headers = {"X-Event-Id": ",".join(str(event["id"]) for event in batch)}
+
+            error = None
+            retry = False
+            started = time.monotonic()
+            try:
+                response = self.session.post(url, json=body, headers=headers, timeout=self.timeout)
+                if 200 <= response.status_code < 300:
+                    error = None
+                else:
+                    error = f"{response.status_code} - {response.text[:200]}"
+                    retry = response.status_code in RETRY_STATUS
+            except requests.RequestException as e:
+                error = str(e)
+                retry = True
+            finished = time.monotonic()
+
+            with self._condition:
+                self._metrics["requests"] += 1
+                self._metrics["request_seconds"] += finished - started
+                self._request_times.append((finished - started) * 1000)
+
+            for event in batch:
+                event["attempts"] += 1
+                event["last_error"] = error
+            if error is None:
+                self._finish(batch, delivered=True)
+            elif retry and batch[0]["attempts"] < self.max_attempts:
+                delay = min(self.max_backoff, self.backoff * 2 ** (batch[0]["attempts"] - 1))
+                with self._condition:
+                    self._metrics["failed_attempts"] += 1
+                    self._metrics["retried"] += len(batch)
+                    for event in batch:
+                        heapq.heappush(self._retries, (time.monotonic() + delay, next(self._sequence), event))
+                # Acordar o loop para recalcular o tempo de espera
+                self._queue.put(_WAKEUP)
+            else:
+                with self._condition:
+                    self._metrics["failed_attempts"] += 1
+                self._finish(batch, delivered=False)
+        finally:
+            self._slots.release()
+
+    def _finish(self, batch, delivered):
+        now = time.monotonic()
+        with self._condition:
+            for event in batch:
+                if delivered:
+                    self._metrics["delivered"] += 1
+                    self._latencies.append((now - event["submitted_at"]) * 1000)
+                    self.delivered.append(event)
+                else:
+                    self._metrics["dead_lettered"] += 1
+                    self.dead_letter.append(event)
+            self._outstanding -= len(batch)
+            self._condition.notify_all()
+
+
+# Sentinela usada apenas para acordar o loop quando um retry é agendado
+_WAKEUP = object()
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values))) - 1))
+    return round(values[index], 2)
@@ -0,0 +1,148 @@
+import json
+import re
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+from django_rq import get_queue
+from extras.choices import JournalEntryKindChoices
+from extras.models import JournalEntry
+from webhook_dispatcher import WebhookDispatcher
+from instrumentation import ScriptMetrics
+
+# Outbox de webhooks: cada evento é gravado como um JournalEntry do device na
+# mesma transação do device.save(). Só depois do commit um job do RQ é
+# enfileirado e a entrega é feita pelo WebhookDispatcher no worker, sem
+# segurar o job que criou o device.
+#
+# Cada entrega reivindica as entradas com SELECT ... FOR UPDATE SKIP LOCKED e
+# as marca como "sending"; um worker nunca pega entradas em andamento em
+# outro. Entradas que não terminarem (worker reiniciado, flush expirado)
+# voltam a ser elegíveis após CLAIM_TIMEOUT e são reenviadas pelo próximo deliver().
+
+OUTBOX_PREFIX = "[webhook-outbox]"
+FLUSH_TIMEOUT = 15
+# Uma entrada "sending" mais antiga que isto é considerada abandonada
+CLAIM_TIMEOUT = 4 * FLUSH_TIMEOUT
+QUEUE_NAME = "default"
+# URL do webhook (substitua pela URL real do seu webhook). Planos de mudança
+# só gravam eventos para esta URL
+WEBHOOK_URL = "https://seu-endpoint-webhook.com"
+
+def _comments(status, url, payload, error=None):
+    header = f"{OUTBOX_PREFIX} {status} {url}"
+    if error:
+        header += "\nerror: " + " ".join(str(error).split())
+    return f"{header}\n{json.dumps(payload, default=str)}"
+
+
+def _parse_comments(comments):
+    header, _, body = comments.partition("\n")
+    while body.startswith("error: "):
+        _, _, body = body.partition("\n")
+    url = header.split(" ", 2)[2]
+    return url, json.loads(body)
+
+
+def claim(pks=None, limit=500):
+    # Reivindica as entradas pendentes (as informadas ou as abandonadas) e as
+    # marca como "sending" na mesma transação; devolve [(entry, url, payload)]
+    queryset = JournalEntry.objects.filter(kind=JournalEntryKindChoices.KIND_INFO)
+    if pks is not None:
+        queryset = queryset.filter(pk__in=pks, comments__startswith=f"{OUTBOX_PREFIX} pending")
+    else:
+        queryset = queryset.filter(
+            comments__regex=rf"^{re.escape(OUTBOX_PREFIX)} (pending|sending) ",
+            last_updated__lt=timezone.now() - timedelta(seconds=CLAIM_TIMEOUT)
+        )
+    claimed = []
+    with transaction.atomic():
+        now = timezone.now()
+        for entry in queryset.select_for_update(skip_locked=True).order_by('pk')[:limit]:
+            url, payload = _parse_comments(entry.comments)
+            entry.comments = _comments("sending", url, payload)
+            entry.last_updated = now
+            claimed.append((entry, url, payload))
+        if claimed:
+            JournalEntry.objects.bulk_update([entry for entry, _, _ in claimed], ['comments', 'last_updated'])
+    return claimed
+
+
+def deliver(pks=None, redrive_pending=True, timeout=FLUSH_TIMEOUT, dispatcher_options=None):
+    # Job do RQ: entrega as entradas informadas e, opcionalmente, as abandonadas.
+    # Cada chamada tem o seu dispatcher: o flush só espera pelos eventos desta
+    # entrega e o que não terminar no prazo é descartado junto com ele
+    claimed = claim(pks) if pks else []
+    if redrive_pending:
+        claimed += claim()
+    entries = {entry.pk: (entry, payload) for entry, _, payload in claimed}
+    dispatcher = WebhookDispatcher(**(dispatcher_options or {}))
+    try:
+        with ScriptMetrics("webhook_outbox.deliver") as script_metrics:
+            for entry, url, payload in claimed:
+                dispatcher.submit({"id": entry.pk, "url": url, "payload": payload})
+            dispatcher.flush(timeout)
+            # As requisições rodam nas threads do dispatcher: o tempo HTTP vem
+            # dos contadores dele
+            metrics = dispatcher.metrics()
+            script_metrics.record_http(metrics["request_seconds"], count=metrics["requests"], phase="http")
+        delivered, dead_letter = dispatcher.drain_results()
+    finally:
+        # Sem nova espera: eventos ainda em retry ficam "sending" no journal
+        dispatcher.close(timeout=0)
+
+    # Atualizar o status no journal em lote; o que não terminou continua
+    # "sending" e volta pelo redrive após o CLAIM_TIMEOUT
+    updated = []
+    for event, status, kind in (
+        *((event, "delivered", JournalEntryKindChoices.KIND_SUCCESS) for event in delivered),
+        *((event, "dead-letter", JournalEntryKindChoices.KIND_DANGER) for event in dead_letter),
+    ):
+        entry, payload = entries.pop(event["id"])
+        entry.kind = kind
+        entry.comments = _comments(status, event["url"], payload, event.get("last_error"))
+        updated.append(entry)
+    if updated:
+        JournalEntry.objects.bulk_update(updated, ['kind', 'comments'])
+
+    return {
+        "delivered": [event["id"] for event in delivered],
+        "dead_letter": [{"id": event["id"], "attempts": event["attempts"], "last_error": event.get("last_error")} for event in dead_letter],
+        "pending": list(entries),
+        "metrics": metrics,
+    }
+
+
+class WebhookOutbox:
+
+    def __init__(self, url, callback=None, redrive_pending=True, queue_name=QUEUE_NAME):
+        self.url = url
+        self.redrive_pending = redrive_pending
+        self.callback = callback
+        self.queue_name = queue_name
+        self._unsent = []
+        self._registered = False
+
+    def record(self, obj, payload):
+        # Deve ser chamado dentro da transação que cria o objeto
+        entry = JournalEntry(
+            assigned_object=obj,
+            kind=JournalEntryKindChoices.KIND_INFO,
+            comments=_comments("pending", self.url, payload)
+        )
+        entry.save()
+        self._unsent.append(entry.pk)
+
+        if not self._registered:
+            transaction.on_commit(self.dispatch)
+            self._registered = True
+        return entry
+
+    def dispatch(self):
+        # Roda após o commit: só enfileira a entrega, sem esperar por ela
+        pks, self._unsent = self._unsent, []
+        self._registered = False
+        job = get_queue(self.queue_name).enqueue(deliver, pks, redrive_pending=self.redrive_pending)
+        if self.callback:
+            self.callback({"queued": pks, "job_id": job.id})
+        return job